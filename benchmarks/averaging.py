@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""
+Microbenchmark: AveragingSensor against the deque based implementation it
+replaced, with the window summed when it is read and with a running sum
+(see AveragingSensor.running_sum_from).
+
+The window column is the cost of filling the window once and reading it
+once, which is how a data file uses an average.
+
+usage: benchmarks/averaging.py [num_samples ...]
+"""
+from collections import deque
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cchrc
+from cchrc.sensors import AveragingSensor, _my_sum
+
+class ConstantSensor(cchrc.sensors.SensorBase):
+    valid_kwargs = []
+
+    def get_reading(self):
+        return 21.5
+
+class DequeAveragingSensor(object):
+    """The AveragingSensor as it was before the ring buffer"""
+    def __init__(self, sensor, num_samples=12):
+        self.readings = deque([], num_samples)
+
+    def get_reading(self):
+        if not self.readings:
+            return None
+
+        readings = list(self.readings)
+        return _my_sum(readings)/float(len(readings))
+
+    def add_reading(self, reading):
+        self.readings.append(reading)
+
+class SummedAveragingSensor(AveragingSensor):
+    """Sums the window when it is read, whatever its size"""
+    running_sum_from = sys.maxint
+
+class RunningAveragingSensor(AveragingSensor):
+    """Keeps a running sum, whatever the size of its window"""
+    running_sum_from = 0
+
+def bench(klass, num_samples, number):
+    avs = klass(ConstantSensor('bench'), num_samples)
+    for x in xrange(num_samples):
+        avs.add_reading(None if x % 10 == 0 else float(x))
+    add = min(timeit.repeat(lambda: avs.add_reading(1.5),
+                            repeat=7, number=number)) / number
+    get = min(timeit.repeat(avs.get_reading, repeat=7, number=number)) / number
+    return add, get
+
+def main():
+    sizes = [int(x) for x in sys.argv[1:]] or [12, 120, 1200, 12000]
+    print '%10s %-24s %12s %12s %14s' % ('samples', 'implementation',
+                                          'add (usec)', 'read (usec)',
+                                          'window (usec)')
+    for n in sizes:
+        number = max(1000, 200000 // n)
+        for klass in (DequeAveragingSensor, SummedAveragingSensor,
+                      RunningAveragingSensor):
+            add, get = bench(klass, n, number)
+            print '%10d %-24s %12.3f %12.3f %14.1f' % (n, klass.__name__,
+                                                      add * 1e6, get * 1e6,
+                                                      (n * add + get) * 1e6)
+
+if __name__ == '__main__':
+    main()
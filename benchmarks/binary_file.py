@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""
+Benchmark: the size of a day of rows in CSV and binary data files, and the
+time taken to read them back.
+
+usage: benchmarks/binary_file.py [num_columns ...]
+"""
+import csv
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cchrc.common.binfile import BinaryEncoder, BinaryReader
+from cchrc.common.encoder import RowEncoder
+
+ROWS = 17280 # A day of 5 second rows
+
+def write(path, encoder, header, rows):
+    f = open(path, 'wb')
+    f.write(encoder.encode_header(header))
+    for ts, values in rows:
+        f.write(encoder.encode(ts, values))
+    f.close()
+    return os.path.getsize(path)
+
+def read_csv(path):
+    f = open(path, 'rb')
+    reader = csv.reader(f)
+    reader.next()
+    for row in reader:
+        [float(v) for v in row[1:] if v != 'N/A']
+    f.close()
+
+def read_binary(path):
+    reader = BinaryReader(path)
+    for row in reader:
+        pass
+    reader.close()
+
+def timed(fn, *a):
+    start = time.time()
+    fn(*a)
+    return time.time() - start
+
+def bench(temp_dir, num_columns):
+    header = ['Timestamp'] + ['T%d_avg' % x for x in xrange(num_columns)]
+    rows = [(1287446400 + 5 * x,
+             [random.uniform(-40, 40) for _ in xrange(num_columns)])
+            for x in xrange(ROWS)]
+    results = []
+    csv_path = os.path.join(temp_dir, 'csv')
+    csv_rows = [('2010-10-19 00:00:00', values) for ts, values in rows]
+    for name, fmt in (('csv', None), ('csv %.3f', '%.3f')):
+        size = write(csv_path, RowEncoder([fmt] * num_columns), header, csv_rows)
+        results.append((name, size, timed(read_csv, csv_path)))
+    bin_path = os.path.join(temp_dir, 'binary')
+    for value_type in ('float64', 'float32'):
+        size = write(bin_path, BinaryEncoder([value_type] * num_columns), header, rows)
+        results.append(('binary ' + value_type, size, timed(read_binary, bin_path)))
+    return results
+
+def main():
+    sizes = [int(x) for x in sys.argv[1:]] or [10, 100]
+    temp_dir = tempfile.mkdtemp()
+    try:
+        print '%8s %-16s %12s %12s' % ('columns', 'format', 'bytes', 'read (s)')
+        for n in sizes:
+            for name, size, t in bench(temp_dir, n):
+                print '%8d %-16s %12d %12.3f' % (n, name, size, t)
+    finally:
+        shutil.rmtree(temp_dir)
+
+if __name__ == '__main__':
+    main()
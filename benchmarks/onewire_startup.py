@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""
+Benchmark: the time taken to open the OneWire sensors of a large network
+of hubs, walking the bus and with the device cache, against the fake ow
+module with a delay for each bus operation.
+
+usage: benchmarks/onewire_startup.py [hubs [devices_per_branch [delay_ms]]]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cchrc.sensors.onewire as onewire
+from cchrc.tests import fake_ow
+
+CONFIGURED = 20 # Sensors in the configuration
+
+def network(hubs, per_branch):
+    devices = {}
+    ids = []
+    for h in xrange(hubs):
+        hub = '/1F.%012X' % h
+        devices[hub] = {}
+        for branch in ('main', 'aux'):
+            for d in xrange(per_branch):
+                sensor_id = '28.%012X' % (h * 1000 + d + (500 if branch == 'aux' else 0))
+                devices['%s/%s/%s' % (hub, branch, sensor_id)] = {'temperature': 20.0}
+                ids.append(sensor_id)
+    return devices, ids
+
+def start(devices, ids, delay, cache):
+    fake_ow.reset(devices)
+    fake_ow.delays[None] = delay
+    onewire.Sensor.buses = {}
+    kwargs = {'connection': 'u'}
+    if cache:
+        kwargs['device_cache'] = cache
+    begin = time.time()
+    for sensor_id in ids[:CONFIGURED]:
+        onewire.Sensor(sensor_id, sensor_id, **kwargs)
+    return time.time() - begin
+
+def main():
+    hubs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    per_branch = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    delay = (float(sys.argv[3]) if len(sys.argv) > 3 else 5) / 1000.0
+    onewire.ow = fake_ow
+    devices, ids = network(hubs, per_branch)
+    temp_dir = tempfile.mkdtemp()
+    try:
+        cache = os.path.join(temp_dir, 'ow.json')
+        print "%d devices on %d hubs, %d configured, %.0f ms a bus operation" % (
+            len(ids), hubs, CONFIGURED, delay * 1000)
+        print "%-20s %8.2f s" % ('no cache', start(devices, ids, delay, None))
+        print "%-20s %8.2f s" % ('first (cache miss)', start(devices, ids, delay, cache))
+        print "%-20s %8.2f s" % ('cached', start(devices, ids, delay, cache))
+    finally:
+        shutil.rmtree(temp_dir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""
+Microbenchmark: RowEncoder against the csv.DictWriter rows it replaced.
+
+usage: benchmarks/row_encoding.py [num_columns ...]
+"""
+import csv
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cchrc.common.encoder import RowEncoder
+
+class NullFile(object):
+    def __init__(self):
+        self.bytes = 0
+
+    def write(self, data):
+        self.bytes += len(data)
+
+def bench(num_columns, number):
+    header = ['Timestamp'] + ['T%d_avg' % x for x in xrange(num_columns)]
+    values = [random.uniform(-40, 40) for _ in xrange(num_columns)]
+    values[0] = None
+    ts = '2010-12-15 00:00:00'
+
+    dict_out = NullFile()
+    writer = csv.DictWriter(dict_out, header)
+    def dict_writer():
+        data = dict(zip(header[1:], values))
+        data['Timestamp'] = ts
+        writer.writerow(data)
+
+    results = []
+    for name, fmt in (('RowEncoder', None), ('RowEncoder %.3f', '%.3f')):
+        encoder = RowEncoder([fmt] * num_columns)
+        out = NullFile()
+        t = min(timeit.repeat(lambda: out.write(encoder.encode(ts, values)),
+                              repeat=3, number=number)) / number
+        results.append((name, t, out.bytes / (3 * number)))
+    t = min(timeit.repeat(dict_writer, repeat=3, number=number)) / number
+    results.insert(0, ('csv.DictWriter', t, dict_out.bytes / (3 * number)))
+    return results
+
+def main():
+    sizes = [int(x) for x in sys.argv[1:]] or [10, 100, 500]
+    print '%8s %-18s %14s %12s' % ('columns', 'implementation',
+                                   'row (usec)', 'row bytes')
+    for n in sizes:
+        for name, t, size in bench(n, max(200, 20000 // n)):
+            print '%8d %-18s %14.2f %12d' % (n, name, t * 1e6, size)
+
+if __name__ == '__main__':
+    main()
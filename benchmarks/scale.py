@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+"""
+Benchmark: CDC with 10 to 10,000 synthetic sensors and 1 to 50 data files,
+of mixed intervals and modes, each scenario run for a while in a process of
+its own.
+
+Reports the lateness of the ticks, the time from a tick to its readings
+being averaged and its rows written, reads per second, rows written, CPU,
+peak RSS and the most threads in use, as JSON (to compare across versions)
+on stdout or in the --output file, and as a table on stderr.
+
+With --simulate each scenario runs on a simulated clock, so --duration is
+simulated time (a day is fine) and the reads take no real time: this
+measures the CPU cost of the collector, and the lateness is zero.
+
+usage: benchmarks/scale.py [options] [scenario ...]
+
+A scenario is one of the names in SCENARIOS, or SENSORSxFILES (e.g. 500x8).
+"""
+import json
+import logging
+import optparse
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import configobj
+
+import cchrc
+from cchrc.common import stats
+from cchrc.common.clock import SimulatedClock, set_clock
+
+SCENARIOS = [('small', 10, 1),
+             ('medium', 100, 5),
+             ('large', 1000, 20),
+             ('huge', 10000, 50)]
+# The files' sampling times, in turn
+INTERVALS = [5, 10, 15, 30, 60]
+# The files' modes, in turn
+MODES = ['SAMPLE', 'AVERAGE']
+
+def get_opts():
+    parser = optparse.OptionParser(usage='usage: %prog [options] [scenario ...]')
+    a = parser.add_option
+    a('-d', '--duration', type='float', default=60,
+      help='Seconds to run each scenario for. Default: %default')
+    a('-l', '--latency', type='float', default=0.002,
+      help='Mean (or median) seconds a sensor takes to read. Default: %default')
+    a('--distribution', default='lognormal',
+      help='Distribution of the read latency. Default: %default')
+    a('-f', '--failure-rate', type='float', default=0.01,
+      help='Fraction of reads which fail. Default: %default')
+    a('-b', '--bus-size', type='int', default=50,
+      help='Sensors read together on each bus. Default: %default')
+    a('-t', '--threads', type='int', default=8,
+      help='CollectionThreads. Default: %default')
+    a('-s', '--simulate', action='store_true',
+      help='Run on a simulated clock, as fast as the collector can go')
+    a('-o', '--output', help='Write the JSON results here instead of stdout')
+    a('--child', action='store_true', help=optparse.SUPPRESS_HELP)
+    opts, args = parser.parse_args()
+    return opts, args or [name for name, _, _ in SCENARIOS]
+
+def scenario(name):
+    for n, sensors, files in SCENARIOS:
+        if n == name:
+            return sensors, files
+    sensors, files = name.lower().split('x')
+    return int(sensors), int(files)
+
+def config(num_sensors, num_files, opts, base_dir):
+    cfg = configobj.ConfigObj()
+    cfg['Main'] = {'BaseDirectory': base_dir,
+                   'CollectionThreads': str(opts.threads)}
+    cfg['Names'] = {}
+    cfg['SensorGroups'] = {}
+    names = []
+    for b in xrange(0, num_sensors, opts.bus_size):
+        group = 'Bus%d' % (b / opts.bus_size)
+        sensors = dict([('S%d' % i, 'S%d' % i)
+                        for i in xrange(b, min(b + opts.bus_size, num_sensors))])
+        cfg['SensorGroups'][group] = {
+            'SensorType': ('synthetic/bus=%s;latency=%s;distribution=%s;'
+                           'failure_rate=%s;generator=random'
+                           % (group, opts.latency, opts.distribution,
+                              opts.failure_rate)),
+            'Sensors': sensors}
+        names.extend(['%s.%s' % (group, s) for s in sorted(sensors)])
+    cfg['Files'] = {}
+    per_file = max(1, num_sensors / num_files)
+    for f in xrange(num_files):
+        cfg['Files']['F%d' % f] = {
+            'FileName': 'F%d.csv' % f,
+            'SamplingTime': str(INTERVALS[f % len(INTERVALS)]),
+            'DefaultGroup': 'Bus0',
+            'DefaultMode': MODES[f % len(MODES)],
+            'Sensors': names[(f * per_file) % num_sensors:][:per_file]}
+    return cfg
+
+def summary(histograms):
+    s = stats.merge(histograms).stats()
+    return dict([(k, s[k]) for k in ('count', 'mean', 'p50', 'p90', 'p99', 'max')])
+
+def run(name, opts):
+    """Runs one scenario, in this process"""
+    num_sensors, num_files = scenario(name)
+    base_dir = tempfile.mkdtemp()
+    clock = None
+    if opts.simulate:
+        clock = SimulatedClock(int(time.time()))
+        set_clock(clock)
+    try:
+        cfg = config(num_sensors, num_files, opts, base_dir)
+        begin = time.time()
+        sc = cchrc.common.construct_sensor_collection(cfg)
+        dfr = cchrc.common.construct_data_file_runner(cfg, False, sc)
+        setup = time.time() - begin
+        cpu = sum(os.times()[:2])
+        begin = time.time()
+        threads = 0
+        if clock:
+            with clock.held():
+                sc.start_averaging_sensors()
+                dfr.start_data_files()
+            clock.sleep(opts.duration)
+            threads = threading.active_count()
+            elapsed = opts.duration
+        else:
+            sc.start_averaging_sensors()
+            dfr.start_data_files()
+            while time.time() - begin < opts.duration:
+                time.sleep(1)
+                threads = max(threads, threading.active_count())
+            elapsed = time.time() - begin
+        s = stats.runtime_stats(sc, dfr)
+        real = time.time() - begin
+        cpu = sum(os.times()[:2]) - cpu
+        for stop, thread in ((sc.stop_averaging_sensors, sc),
+                             (dfr.stop_data_files, dfr)):
+            stop()
+            thread.join()
+    finally:
+        shutil.rmtree(base_dir)
+    reads = sum([h['count'] for h in s['sensors']['read_time'].values()])
+    jobs = (s['sensors']['scheduler']['jobs'].values() +
+            s['files']['scheduler']['jobs'].values())
+    files = s['files']['files'].values()
+    return {'scenario': name,
+            'sensors': num_sensors,
+            'files': num_files,
+            'duration': elapsed,
+            'real_seconds': real,
+            'setup_seconds': setup,
+            'reads': reads,
+            'reads_per_second': reads / elapsed,
+            'rows': sum([f['rows_written'] for f in files]),
+            'bytes': sum([f['bytes_written'] for f in files]),
+            'tick_lateness': summary([j['lateness'] for j in jobs]),
+            'sensor_tick_duration': summary(s['sensors']['tick_duration'].values()),
+            'file_tick_duration': summary(s['files']['tick_duration'].values()),
+            'timeouts': sum([t['timeouts'] for t in s['files']['timeouts']['types'].values()]),
+            'cpu_seconds': cpu,
+            'cpu_percent': 100 * cpu / real,
+            'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'threads': threads}
+
+def commit():
+    try:
+        return subprocess.Popen(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE,
+                                stderr=open(os.devnull, 'w'),
+                                cwd=os.path.dirname(os.path.abspath(__file__))
+                                ).communicate()[0].strip() or None
+    except OSError:
+        return None
+
+def main():
+    opts, names = get_opts()
+    logging.basicConfig(level=100)
+    if opts.child:
+        print json.dumps(run(names[0], opts))
+        sys.stdout.flush()
+        # Don't wait for (or complain about) the reads still going on
+        os._exit(0)
+    argv = [a for a in sys.argv[1:] if a not in names]
+    results = []
+    fmt = '%-10s %7s %5s %10s %9s %9s %9s %7s %9s %7s'
+    print >> sys.stderr, fmt % ('scenario', 'sensors', 'files', 'reads/s', 'late p50',
+                                'late p99', 'write p99', 'cpu %', 'rss MB', 'threads')
+    for name in names:
+        out = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--child',
+                                name] + argv, stdout=subprocess.PIPE).communicate()[0]
+        r = json.loads(out.strip().splitlines()[-1])
+        results.append(r)
+        print >> sys.stderr, fmt % (
+            name, r['sensors'], r['files'], '%.1f' % r['reads_per_second'],
+            '%.4f' % (r['tick_lateness']['p50'] or 0),
+            '%.4f' % (r['tick_lateness']['p99'] or 0),
+            '%.4f' % (r['file_tick_duration']['p99'] or 0),
+            '%.1f' % r['cpu_percent'], '%.1f' % (r['max_rss_kb'] / 1024.0),
+            r['threads'])
+    doc = json.dumps({'benchmark': 'scale',
+                      'time': time.time(),
+                      'commit': commit(),
+                      'python': sys.version.split()[0],
+                      'options': {'duration': opts.duration, 'latency': opts.latency,
+                                  'distribution': opts.distribution,
+                                  'failure_rate': opts.failure_rate,
+                                  'bus_size': opts.bus_size, 'threads': opts.threads,
+                                  'simulate': opts.simulate},
+                      'results': results}, indent=1, sort_keys=True)
+    if opts.output:
+        open(opts.output, 'w').write(doc + '\n')
+    else:
+        print doc
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,7 @@ import logging
 
 import cchrc
 import datafile
+import partition
 
 def parse_sensor_info(info_string):
     major_param, minor_params_string = info_string.split('/')
@@ -32,7 +33,9 @@ def listify(v):
     return v
 
 def construct_sensor_collection(cfg):
-    sc = cchrc.sensors.SensorContainer()
+    sc = cchrc.sensors.SensorContainer(
+        catch_up=cfg['Main'].get('CatchUp', 'latest').lower(),
+        workers=int(cfg['Main'].get('CollectionThreads', 8)))
     log = logging.getLogger('cchrc.common.construct_sensor_collection')
 
     for group in cfg['SensorGroups']:
@@ -76,7 +79,9 @@ def construct_sensor_collection(cfg):
 def construct_data_file_runner(cfg, test, sc):
     DF = datafile.DataFile
     log = logging.getLogger('cchrc.common.construct_data_file_runner')
-    dfr = datafile.DataFileRunner()
+    dfr = datafile.DataFileRunner(
+        catch_up=cfg['Main'].get('CatchUp', 'latest').lower(),
+        workers=int(cfg['Main'].get('CollectionThreads', 8)))
 
     for data_file in cfg['Files']:
         fcfg = cfg['Files'][data_file]
@@ -88,5 +93,18 @@ def construct_data_file_runner(cfg, test, sc):
                   data_file, sampling_time)
         dfr.put(DF(data_file, fcfg['FileName'], cfg['Main']['BaseDirectory'],
                    fcfg['DefaultGroup'], sampling_time,
-                   fcfg['DefaultMode'], listify(fcfg['Sensors']), sc))
+                   fcfg['DefaultMode'], listify(fcfg['Sensors']), sc,
+                   flush_rows=int(fcfg.get('FlushRows', 1)),
+                   flush_interval=float(fcfg.get('FlushInterval', 0)),
+                   fsync=fcfg.get('Fsync', 'none').lower(),
+                   value_format=fcfg.get('ValueFormat'),
+                   formats=dict(fcfg.get('Formats', {})),
+                   file_format=fcfg.get('Format', 'csv').lower(),
+                   value_type=fcfg.get('ValueType', 'float64').lower(),
+                   rotate=fcfg.get('Rotate', 'none').lower(),
+                   max_size=partition.parse_size(fcfg.get('MaxSize', 0)),
+                   compress=fcfg.get('Compress', 'none').lower(),
+                   index_every=int(fcfg.get('IndexEvery', 100)),
+                   rollups=[r.lower() for r in listify(fcfg.get('Rollups', []))],
+                   rollup_checkpoint=float(fcfg.get('RollupCheckpoint', 60))))
     return dfr
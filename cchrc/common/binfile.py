@@ -0,0 +1,202 @@
+"""
+The binary data file format, for files with Format = binary.
+
+A binary data file is a header followed by fixed-width records:
+
+  magic      8 bytes, 'CDCBIN' and the format version as two bytes
+  length     uint32, the length of the JSON description which follows
+  JSON       {"columns": [...], "types": [...]}, padded with spaces so the
+             records start at a multiple of 8 bytes
+
+Each record is, little-endian and without padding:
+
+  timestamp  float64, seconds since the epoch
+  nulls      one bit per column, set when the reading was not available
+  values     one float64 or float32 per column, NaN when not available
+
+Because every record is the same size, a file can be memory mapped and
+any row read without reading the rows before it.
+"""
+import datetime
+import json
+import math
+import mmap
+import optparse
+import struct
+import sys
+
+from cchrc.common.encoder import RowEncoder
+from cchrc.common.exceptions import MalformedConfigFile, NotABinaryFile
+
+MAGIC = 'CDCBIN\x00\x01'
+TYPE_FLOAT64 = 'float64'
+TYPE_FLOAT32 = 'float32'
+VALUE_TYPES = {TYPE_FLOAT64: 'd', TYPE_FLOAT32: 'f'}
+
+_length = struct.Struct('<I')
+_NAN = float('nan')
+
+def _record_struct(types):
+    nulls = (len(types) + 7) // 8
+    return struct.Struct('<d%ds%s' % (nulls, ''.join([VALUE_TYPES[t] for t in types])))
+
+def decode(record):
+    """Turns an unpacked record into (timestamp, [values])"""
+    ts, nulls, values = record[0], record[1], list(record[2:])
+    if nulls.strip('\x00'):
+        nulls = bytearray(nulls)
+        for i in xrange(len(values)):
+            if nulls[i >> 3] & (1 << (i & 7)):
+                values[i] = None
+    return ts, values
+
+def read_header(f):
+    """
+    Reads the header of the binary data file f (a file, at its start),
+    and returns (columns, types, offset of the first record)
+    """
+    if f.read(len(MAGIC)) != MAGIC:
+        raise NotABinaryFile("'%s' is not a binary data file" % f.name)
+    length = f.read(_length.size)
+    if len(length) != _length.size:
+        raise NotABinaryFile("'%s' has a truncated header" % f.name)
+    length, = _length.unpack(length)
+    try:
+        desc = json.loads(f.read(length))
+    except ValueError:
+        raise NotABinaryFile("'%s' has a malformed header" % f.name)
+    return ([c.encode('utf-8') for c in desc['columns']],
+            [str(t) for t in desc['types']],
+            len(MAGIC) + _length.size + length)
+
+class BinaryEncoder(object):
+    """
+    Encodes the header and rows of a binary data file. The counterpart of
+    cchrc.common.encoder.RowEncoder, but each row is given the epoch time
+    rather than the formatted timestamp.
+    """
+    def __init__(self, types):
+        """types is a list with one value type (float64 or float32) per column"""
+        for t in types:
+            if t not in VALUE_TYPES:
+                raise MalformedConfigFile("Invalid value type '%s'" % t)
+        self.types = list(types)
+        self.record = _record_struct(types)
+        self.__no_nulls = '\x00' * ((len(types) + 7) // 8)
+
+    def encode_header(self, header):
+        """header is the data file's header row, starting with Timestamp"""
+        desc = json.dumps({'columns': header[1:], 'types': self.types})
+        used = len(MAGIC) + _length.size + len(desc)
+        desc += ' ' * (-used % 8)
+        return MAGIC + _length.pack(len(desc)) + desc
+
+    def encode(self, ts, values):
+        try:
+            record = self.record.pack(ts, self.__no_nulls, *values)
+            # The sum is NaN if any value is, and NaN is written as null
+            total = sum(values)
+            if total == total:
+                return record
+        except (struct.error, TypeError, OverflowError):
+            # A None, or something else that isn't a number
+            pass
+        nulls = bytearray(self.__no_nulls)
+        packed = []
+        for i, v in enumerate(values):
+            try:
+                v = float(v)
+                if self.types[i] == TYPE_FLOAT32:
+                    struct.pack('<f', v)
+            except (TypeError, ValueError, OverflowError, struct.error):
+                v = None
+            if v is None or math.isnan(v):
+                nulls[i >> 3] |= 1 << (i & 7)
+                v = _NAN
+            packed.append(v)
+        return self.record.pack(ts, str(nulls), *packed)
+
+class BinaryReader(object):
+    """
+    Reads a binary data file through a read-only memory map. Rows are
+    (timestamp, [values]), with None for readings which were not
+    available. A partly written last record is ignored.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.__file = open(path, 'rb')
+        try:
+            self.columns, self.types, self.offset = read_header(self.__file)
+        except Exception:
+            self.__file.close()
+            raise
+        self.header = ['Timestamp'] + self.columns
+        self.record = _record_struct(self.types)
+        self.__map = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.__len = (len(self.__map) - self.offset) // self.record.size
+
+    def __len__(self):
+        return self.__len
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.__len
+        if not 0 <= i < self.__len:
+            raise IndexError('row index out of range')
+        return decode(self.record.unpack_from(self.__map,
+                                              self.offset + i * self.record.size))
+
+    def __iter__(self):
+        unpack_from, size = self.record.unpack_from, self.record.size
+        for pos in xrange(self.offset, self.offset + self.__len * size, size):
+            yield decode(unpack_from(self.__map, pos))
+
+    def timestamp(self, i):
+        """The timestamp of row i, without decoding the rest of the row"""
+        return struct.unpack_from('<d', self.__map,
+                                  self.offset + i * self.record.size)[0]
+
+    def close(self):
+        self.__map.close()
+        self.__file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def to_csv(reader, out, value_format=None):
+    """Writes the rows of reader, a BinaryReader, to out as CSV"""
+    encoder = RowEncoder([value_format] * len(reader.columns))
+    out.write(encoder.encode_header(reader.header))
+    fromtimestamp = datetime.datetime.fromtimestamp
+    for ts, values in reader:
+        out.write(encoder.encode(fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S'),
+                                 values))
+
+def main():
+    usage = 'usage: %prog [options] binary-data-file [output-file]'
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option('-f', '--format', dest='value_format',
+                      help="printf-style format of the values, e.g. '%.3f'")
+    opts, args = parser.parse_args()
+    if len(args) not in (1, 2):
+        parser.error("Must provide a binary data file on the command line")
+
+    try:
+        reader = BinaryReader(args[0])
+    except (IOError, NotABinaryFile), ex:
+        print >> sys.stderr, "Could not read '%s': %s" % (args[0], str(ex))
+        sys.exit(1)
+
+    out = open(args[1], 'wb') if len(args) == 2 else sys.stdout
+    try:
+        to_csv(reader, out, opts.value_format)
+    finally:
+        reader.close()
+        if out is not sys.stdout:
+            out.close()
+
+if __name__ == '__main__':
+    main()
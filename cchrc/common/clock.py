@@ -0,0 +1,267 @@
+"""
+The clock the collector runs on: the time of day, a monotonic clock,
+sleeping, and waiting for futures.
+
+By default this is the real clock. Tests and benchmarks can set a
+SimulatedClock instead (with set_clock()), whose time only moves when
+every thread taking part is waiting on it, and then jumps straight to the
+earliest deadline. A day of collection then runs in seconds, and as the
+ticks are run one at a time, in order, the output is the same every time.
+
+Threads take part by waiting through the clock: schedulers sleep with a
+sleeper(), work submitted to a CollectionExecutor counts as busy until it
+is done (unless it is queued behind other work which is waiting), and
+waits for other threads' work go through result(). Anything
+else, such as the thread starting the collector, holds the time still
+with held() while it runs.
+"""
+import contextlib
+import ctypes
+import ctypes.util
+import itertools
+import os
+import select
+import threading
+import time
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+def _get_monotonic():
+    """
+    Returns a monotonic clock function. Python 2 does not have one, so
+    we use clock_gettime(CLOCK_MONOTONIC) from librt, and fall back to
+    time.time() if that is not available.
+    """
+    if hasattr(time, 'monotonic'): # pragma: no cover
+        return time.monotonic
+    try:
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1',
+                            use_errno=True)
+        clock_gettime = librt.clock_gettime
+    except (OSError, AttributeError): # pragma: no cover
+        return time.time
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+    CLOCK_MONOTONIC = 1
+    def monotonic():
+        t = _timespec()
+        clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t))
+        return t.tv_sec + t.tv_nsec * 1e-9
+    return monotonic
+
+monotonic = _get_monotonic()
+
+class _PipeSleeper(object):
+    """Sleeps until a timeout, or until woken up from another thread"""
+    def __init__(self):
+        self.__pipe = os.pipe()
+
+    def wait(self, timeout):
+        r, _, _ = select.select([self.__pipe[0]], [], [], timeout)
+        if r:
+            os.read(self.__pipe[0], 4096)
+
+    def wake(self):
+        os.write(self.__pipe[1], 'x')
+
+    def close(self):
+        os.close(self.__pipe[0])
+        os.close(self.__pipe[1])
+
+class Clock(object):
+    """The real clock"""
+    simulated = False
+
+    def time(self):
+        return time.time()
+
+    def monotonic(self):
+        return monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def result(self, future, timeout=None):
+        """The result of future, waiting for it for up to timeout seconds"""
+        return future.result(timeout)
+
+    def sleeper(self):
+        """Something to sleep on which other threads can wake (for a Scheduler)"""
+        return _PipeSleeper()
+
+    @contextlib.contextmanager
+    def held(self):
+        """Keeps the time still in the body, e.g. while starting threads"""
+        yield
+
+    # Called by CollectionExecutor: n more items are ready to run (or fewer,
+    # if n is negative), and whether the calling thread is running one
+    def busy(self, n):
+        pass
+
+    def working(self, working):
+        pass
+
+class _Waiter(object):
+    def __init__(self, deadline, seq, working):
+        self.deadline = deadline
+        self.seq = seq
+        self.working = working
+        self.waiting = False
+        self.pending = False
+        # Set when released; each waiter has its own, so a release wakes
+        # only the thread released
+        self.event = threading.Event()
+
+class _SimulatedSleeper(object):
+    def __init__(self, clock):
+        self.clock = clock
+        self.waiter = clock._open()
+
+    def wait(self, timeout):
+        self.clock._wait(self.waiter, timeout)
+
+    def wake(self):
+        self.clock._wake(self.waiter)
+
+    def close(self):
+        self.clock._close(self.waiter)
+
+class SimulatedClock(object):
+    """
+    A clock whose time moves only when every thread taking part is waiting
+    on it, straight to the earliest deadline. Waiters due at the same time
+    are released one at a time, each once the work set off by the one
+    before is done, in the order they were made (so schedulers due together
+    always run in the order they were opened, not whichever got back to
+    waiting first).
+    """
+    simulated = True
+
+    def __init__(self, start=0.0):
+        self.__now = float(start)
+        self.__lock = threading.RLock()
+        self.__seq = itertools.count()
+        # Work ready to run or running, less the work waiting on the clock
+        self.__busy = 0
+        # Sleepers taking part, and everything waiting
+        self.__sleepers = []
+        self.__waiting = []
+        self.__local = threading.local()
+        self.advances = 0
+
+    def time(self):
+        return self.__now
+
+    def monotonic(self):
+        return self.__now
+
+    def sleep(self, seconds):
+        self._wait(_Waiter(None, next(self.__seq), self.__working()), seconds)
+
+    def result(self, future, timeout=None):
+        if not future.done():
+            waiter = _Waiter(None, next(self.__seq), self.__working())
+            # Before waiting, so the thread finishing the future releases
+            # the waiter before it stops being busy
+            future.add_done_callback(lambda f: self.__release(waiter))
+            if self.__enter(waiter, timeout, future):
+                waiter.event.wait()
+        return future.result(0)
+
+    def sleeper(self):
+        return _SimulatedSleeper(self)
+
+    @contextlib.contextmanager
+    def held(self):
+        self.busy(1)
+        try:
+            yield
+        finally:
+            self.busy(-1)
+
+    def busy(self, n):
+        with self.__lock:
+            self.__busy += n
+            self.__advance()
+
+    def working(self, working):
+        self.__local.working = working
+
+    def __working(self):
+        return getattr(self.__local, 'working', False)
+
+    def _open(self):
+        with self.__lock:
+            waiter = _Waiter(None, next(self.__seq), False)
+            self.__sleepers.append(waiter)
+            return waiter
+
+    def _close(self, waiter):
+        with self.__lock:
+            self.__sleepers.remove(waiter)
+            self.__advance()
+
+    def _wake(self, waiter):
+        with self.__lock:
+            if waiter.waiting:
+                self.__release(waiter)
+            else:
+                waiter.pending = True
+
+    def _wait(self, waiter, timeout):
+        if self.__enter(waiter, timeout):
+            waiter.event.wait()
+
+    def __enter(self, waiter, timeout, future=None):
+        """Starts waiter waiting, unless it needn't; True if it did"""
+        with self.__lock:
+            if waiter.pending:
+                waiter.pending = False
+                return False
+            if timeout is not None and timeout <= 0:
+                return False
+            if future is not None and future.done():
+                return False
+            waiter.deadline = None if timeout is None else self.__now + timeout
+            waiter.waiting = True
+            waiter.event.clear()
+            if waiter.working:
+                self.__busy -= 1
+            self.__waiting.append(waiter)
+            self.__advance()
+            return True
+
+    def __release(self, waiter):
+        with self.__lock:
+            if not waiter.waiting:
+                return
+            waiter.waiting = False
+            self.__waiting.remove(waiter)
+            if waiter.working:
+                self.__busy += 1
+            waiter.event.set()
+
+    def __advance(self):
+        """Moves the time on, if every thread taking part is waiting"""
+        if self.__busy or [s for s in self.__sleepers if not s.waiting]:
+            return
+        due = [w for w in self.__waiting if w.deadline is not None]
+        if not due:
+            return
+        waiter = min(due, key=lambda w: (w.deadline, w.seq))
+        if waiter.deadline > self.__now:
+            self.__now = waiter.deadline
+            self.advances += 1
+        self.__release(waiter)
+
+_clock = Clock()
+
+def get_clock():
+    """The clock in use"""
+    return _clock
+
+def set_clock(clock):
+    """Sets the clock in use; None sets the real clock back"""
+    global _clock
+    _clock = clock or Clock()
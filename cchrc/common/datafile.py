@@ -1,21 +1,38 @@
-from collections import defaultdict
+from collections import defaultdict, deque
 import csv
-import datetime
 import functools
 import logging
-import math
 import os
 import threading
-import time
-
-import futures
 
 import cchrc
+from cchrc.common.clock import get_clock
+from cchrc.common.binfile import BinaryEncoder, read_header, TYPE_FLOAT64
+from cchrc.common.encoder import RowEncoder
+from cchrc.common.executor import CollectionExecutor
+from cchrc.common.index import IndexWriter, first_row_time, SUFFIX as INDEX_SUFFIX
+from cchrc.common.partition import (archive_file, compress_later, period_key,
+                                    ROTATE_NONE, ROTATE_PERIODS, COMPRESS_NONE,
+                                    COMPRESS_METHODS)
+from cchrc.common.rollup import Rollup
+from cchrc.common.snapshot import TickSnapshot
+from cchrc.common import tracing
+from cchrc.common.stats import Histogram
+from cchrc.common.writer import BufferedFile
+from cchrc.common.scheduler import (Scheduler, CATCH_UP_LATEST, CATCH_UP_SKIP,
+                                    CATCH_UP_POLICIES)
 from cchrc.common.exceptions import (InvalidSensorMode, InvalidObject,
                                      DuplicateObject, BaseDirDoesNotExist,
-                                     MalformedConfigFile)
+                                     MalformedConfigFile, InvalidSchedulerPolicy,
+                                     NotABinaryFile)
 
-VALID_MODES = ('SAMPLE', 'AVERAGE')
+# Besides SAMPLE, the modes are the aggregates of an AveragingSensor
+# (see cchrc.sensors.AGGREGATE_MODES)
+VALID_MODES = ('SAMPLE', 'AVERAGE', 'MIN', 'MAX', 'STDDEV', 'MEDIAN', 'COUNT',
+               'LAST')
+FORMAT_CSV = 'csv'
+FORMAT_BINARY = 'binary'
+VALID_FORMATS = (FORMAT_CSV, FORMAT_BINARY)
 
 def _split_sensor_info(s, default_group, default_mode):
     """Takes the sensor string from the ini, derive the group
@@ -56,44 +73,148 @@ def _rotate_files(full_path):
             old_path = full_path + '.' + str(count)
 
         os.rename(old_path, new_path)
+        if os.path.exists(old_path + INDEX_SUFFIX):
+            os.rename(old_path + INDEX_SUFFIX, new_path + INDEX_SUFFIX)
 
 class DataFileRunner(threading.Thread):
-    def __init__(self):
+    def __init__(self, catch_up=CATCH_UP_LATEST, workers=8):
+        """
+        catch_up is the scheduler's policy for missed ticks
+        workers is the most threads writing files for any one sampling time
+        """
         self.log = logging.getLogger('cchrc.common.datafile.DataFileRunner')
-        self.__end_thread = False
         self.__data_files = defaultdict(list)
-        self.__dflr = defaultdict(int) # data files for interval k were run at v seconnds
-        threading.Thread.__init__(self)
+        if catch_up not in CATCH_UP_POLICIES:
+            raise InvalidSchedulerPolicy("Invalid catch up policy '%s'" % catch_up)
+        self.__catch_up = catch_up
+        self.__scheduler = Scheduler('DataFileRunner', dispatch=self.__dispatch)
+        self.__prepare_jobs = set()
+        self.__flush_jobs = set()
+        self.__tick_durations = defaultdict(Histogram)
+        # The ticks each file has still to write, oldest first
+        self.__pending = defaultdict(deque)
+        self.__pending_lock = threading.Lock()
+        self.__executor = CollectionExecutor('DataFileRunner', workers)
+        threading.Thread.__init__(self, name='DataFileRunner')
 
     def run(self):
+        for rt in self.__data_files:
+            self.__scheduler.add(rt, functools.partial(self.__run_tick,
+                                                       intervals=[rt]),
+                                 catch_up=self.__catch_up,
+                                 name="%s second files" % rt)
+            lead = cchrc.sensors.lead_time(self.__sensors([rt]))
+            if 0 < lead < rt:
+                # A prepare that is late is no use, so it is skipped
+                self.__prepare_jobs.add(self.__scheduler.add(
+                    rt, None, offset=rt - lead, catch_up=CATCH_UP_SKIP,
+                    name="%s second files prepare" % rt))
+        for fi in set([df.flush_interval for df in self.__files()]):
+            if fi:
+                # Rows are otherwise only flushed when the next is written
+                self.__flush_jobs.add(self.__scheduler.add(
+                    fi, None, name="%s second flush" % fi))
+        self.__scheduler.run()
+        # Writing out the buffered rows must not wait for a hung read, so
+        # the files are closed first; a row still waiting for its readings
+        # is dropped
+        for df in self.__files():
+            df.close()
+        self.__executor.shutdown(wait=False)
+
+    def __dispatch(self, fired):
+        """Runs all the files that are due at the same tick together"""
+        by_tick = defaultdict(list)
+        prepare = []
+        flush = []
+        for job, ts in fired:
+            if job in self.__prepare_jobs:
+                prepare.append(job.interval)
+            elif job in self.__flush_jobs:
+                flush.append(job.interval)
+            else:
+                by_tick[ts].append(job.interval)
+        for df in self.__files():
+            if df.flush_interval in flush:
+                self.__executor.submit('flush', df.flush)
+        if prepare:
+            # Sensors due at several intervals are prepared once
+            cchrc.sensors.prepare_sensors(self.__sensors(prepare), self.__executor,
+                                          'prepare')
+        for ts in sorted(by_tick):
+            try:
+                self.__run_tick(ts, sorted(by_tick[ts]))
+            except Exception:
+                self.log.exception("Error running files for tick %s", ts)
+
+    def __files(self):
+        return [df for rt in self.__data_files for df in self.__data_files[rt]]
+
+    def __sensors(self, intervals):
+        """The sensors of the files of intervals"""
+        return [s for rt in intervals for df in self.__data_files[rt]
+                for s in df.sensors]
+
+    def __run_tick(self, ts, intervals):
+        """
+        Reads every sensor needed by the files of intervals once, into a
+        snapshot, and writes all of the files from it.
+        """
+        self.log.debug("Running '%s' files for tick %s",
+                       ', '.join([str(rt) for rt in intervals]), ts)
+        files = [(rt, df) for rt in intervals for df in self.__data_files[rt]]
+        snapshot = TickSnapshot(ts, [s for _, df in files for s in df.sensors])
+        # The readings are queued before the writes that wait for them, and
+        # may not run into the next tick
+        snapshot.acquire(self.__executor, intervals[0], max_wait=intervals[0])
+        for rt, df in files:
+            # A file writes one tick at a time, in order, so a file already
+            # writing picks this tick up when it is done
+            with self.__pending_lock:
+                self.__pending[df].append((ts, snapshot))
+                writing = len(self.__pending[df]) > 1
+            if not writing:
+                self.__executor.submit(rt, self.__write, rt, df)
+
+    def __write(self, rt, df):
+        """Writes the ticks pending for df until there are none left"""
         while True:
-            if self.__end_thread:
-                return # pragma: no cover
-            cur_time = int(time.time())
-            for rt in self.__data_files:
-                if ((cur_time % rt == 0) or
-                    (self.__dflr[rt] != 0 and
-                        ((cur_time - self.__dflr[rt]) > rt))):
-                    self.log.debug("Running '%s' files; "
-                                   "last run %s seconds ago",
-                                   rt, cur_time - self.__dflr[rt])
-                    self.__dflr[rt] = cur_time
-                    to_run = [functools.partial(df.collect_data, cur_time)
-                              for df in self.__data_files[rt]]
-                    with futures.ThreadPoolExecutor(len(self.__data_files[rt])) as executor:
-                        for t in to_run:
-                            fs = executor.submit(t)
-            # Sleep to the top of the next second
-            cur_time = time.time()
-            time.sleep(math.ceil(cur_time) - cur_time)
+            with self.__pending_lock:
+                ts, snapshot = self.__pending[df][0]
+            try:
+                df.collect_data(ts, snapshot)
+                self.__tick_durations[rt].record(get_clock().time() - ts)
+            except Exception:
+                self.log.exception("Error writing '%s' for tick %s", df.file_id, ts)
+            with self.__pending_lock:
+                self.__pending[df].popleft()
+                if not self.__pending[df]:
+                    return
+
+    def queue_depths(self):
+        return self.__executor.queue_depths()
+
+    def stats(self):
+        sensors = set(self.__sensors(self.__data_files.keys()))
+        return {'scheduler': self.__scheduler.stats(),
+                'executor': self.__executor.stats(),
+                'timeouts': cchrc.sensors.timeout_stats(sensors),
+                'breakers': cchrc.sensors.breaker_stats(sensors),
+                # From the tick to each file's row being written, by interval
+                'tick_duration': dict([(str(rt), h.stats())
+                                       for rt, h in self.__tick_durations.items()]),
+                'files': dict([(df.file_id, df.stats())
+                               for rt in self.__data_files
+                               for df in self.__data_files[rt]])}
 
     def start_data_files(self):
         self.log.info('Starting')
+        self.__scheduler.open()
         self.start()
 
     def stop_data_files(self):
         self.log.info('Ending')
-        self.__end_thread = True
+        self.__scheduler.stop()
 
     def put(self, df_object):
         if not isinstance(df_object, DataFile):
@@ -107,7 +228,11 @@ class DataFileRunner(threading.Thread):
 
 class DataFile(object):
     def __init__(self, file_id, file_name, base_dir, default_group, sampling_time,
-                 default_mode, sensor_list, sensor_collection):
+                 default_mode, sensor_list, sensor_collection, flush_rows=1,
+                 flush_interval=0, fsync='none', value_format=None, formats=None,
+                 file_format=FORMAT_CSV, value_type=TYPE_FLOAT64,
+                 rotate=ROTATE_NONE, max_size=0, compress=COMPRESS_NONE,
+                 index_every=100, rollups=None, rollup_checkpoint=60):
         """
         file_id is the name of the file's section in the config file
         base_dir is the path to which the file will be written
@@ -116,11 +241,55 @@ class DataFile(object):
         default_mode is the default mode of the sensors
         sensor_list is a list of sensor names to be pulled from the SensorCollection
         sensor_collection is a SensorCollection object
+        flush_rows is how many rows are buffered before they are written
+        flush_interval is how many seconds a row may be buffered (0 for no limit)
+        fsync is the durability policy: none, interval or every-row
+        value_format is the printf-style format of the values (e.g. '%.3f')
+        formats is a dict of column name to format, overriding value_format
+        file_format is csv, or binary (see cchrc.common.binfile)
+        value_type is the type of the values in a binary file: float64 or float32
+        rotate is when to start a new partition: none, hourly, daily or monthly
+        max_size is the most bytes in a partition (0 for no limit)
+        compress is how closed partitions are compressed: none, gzip or xz
+        index_every is how many rows of a CSV file there are between entries
+        in its index (0 for no index; see cchrc.common.index)
+        rollups is a list of the summaries to keep: hourly, daily or monthly
+        rollup_checkpoint is the most seconds between checkpoints of the summaries
         """
         self.file_id = file_id
         self.file_name = file_name
         self.base_dir = base_dir
         self.sampling_time = sampling_time
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        if file_format not in VALID_FORMATS:
+            raise MalformedConfigFile("Invalid Format '%s' for file '%s'" %
+                                      (file_format, file_id))
+        self.file_format = file_format
+        if rotate not in ROTATE_PERIODS:
+            raise MalformedConfigFile("Invalid Rotate '%s' for file '%s'" %
+                                      (rotate, file_id))
+        if compress not in COMPRESS_METHODS:
+            raise MalformedConfigFile("Invalid Compress '%s' for file '%s'" %
+                                      (compress, file_id))
+        self.rotate = rotate
+        self.max_size = max_size
+        self.compress = compress
+        self.index_every = index_every
+        self.index = None
+        self.rollup = None
+        self.partitions = 0
+        # Seconds from the tick to its readings being ready
+        self.latency = None
+        self.max_latency = None
+        # Last good readings written in place of reads which took too long
+        self.stale_values = 0
+        self.full_path = os.path.join(base_dir, file_name)
+        self.__partition_start = None
+        self.__size = 0
+        self.__lock = threading.Lock()
+        self.out = None
         self.sensors = []
         self.log = logging.getLogger('cchrc.common.datafile.DataFile')
         AS = cchrc.sensors.AveragingSensor
@@ -142,49 +311,196 @@ class DataFile(object):
                                                           self.file_id))
             if mode == 'SAMPLE':
                 self.sensors.append(sensor_collection.get(group, name))
-            elif mode == 'AVERAGE':
+            else:
+                # All the aggregates of a sensor over sampling_time share
+                # one averaging sensor
                 if sensor_collection.contains(group, name, sampling_time):
-                    self.sensors.append(sensor_collection.get(group, name,
-                                                              sampling_time))
+                    avs = sensor_collection.get(group, name, sampling_time)
                 else:
-                    new_sensor = AS(sensor_collection.get(group, name))
-                    sensor_collection.put(new_sensor, group, sampling_time)
-                    self.sensors.append(new_sensor)
+                    avs = AS(sensor_collection.get(group, name))
+                    sensor_collection.put(avs, group, sampling_time)
+                if mode == 'AVERAGE':
+                    self.sensors.append(avs)
+                else:
+                    self.sensors.append(avs.view(mode))
 
         self.header = ['Timestamp'] + [s.display_name for s in self.sensors]
+        if self.file_format == FORMAT_BINARY:
+            self.encoder = BinaryEncoder([value_type] * len(self.sensors))
+        else:
+            formats = formats or {}
+            self.encoder = RowEncoder([formats.get(c, value_format)
+                                       for c in self.header[1:]])
 
         self.open_file()
+        if rollups:
+            self.rollup = Rollup(self.full_path, self.header[1:], rollups,
+                                 getattr(self.encoder, 'formats', None),
+                                 rollup_checkpoint, fsync)
+
+    @property
+    def partitioned(self):
+        return self.rotate != ROTATE_NONE or bool(self.max_size)
 
     def open_file(self):
         file_exists = False
-        full_path = os.path.join(self.base_dir, self.file_name)
+        full_path = self.full_path
         self.log.info("Opening '%s' for '%s'" %(full_path, self.file_id))
         if not os.path.exists(self.base_dir):
             raise BaseDirDoesNotExist("Base Directory '%s' does not exist" % self.base_dir)
 
         if os.path.exists(full_path):
             file_exists = True
-            tf = open(full_path)
-            test_header = csv.reader(tf).next()
-            tf.close()
-            if self.header != test_header:
-                _rotate_files(full_path)
+            if self.file_format == FORMAT_BINARY:
+                file_exists = self.__check_binary_file(full_path)
+            else:
+                tf = open(full_path)
+                try:
+                    test_header = csv.reader(tf).next()
+                except csv.Error:
+                    # e.g. a binary file
+                    test_header = None
+                tf.close()
+                if self.header != test_header:
+                    file_exists = False
+            if not file_exists:
+                if self.partitioned:
+                    self.__archive(first_row_time(full_path) or
+                                   os.path.getmtime(full_path))
+                else:
+                    _rotate_files(full_path)
+            else:
+                self.__partition_start = first_row_time(full_path)
+
+        self.__open(file_exists)
 
-        self.csv = csv.DictWriter(open(full_path, mode='a', buffering=0),
-                                  self.header)
+    def __open(self, file_exists):
+        self.out = BufferedFile(self.full_path, self.flush_rows, self.flush_interval,
+                                self.fsync)
         if not file_exists:
             # Only need a header row if it's a new file
-            self.csv.writer.writerow(self.header)
+            self.out.write(self.encoder.encode_header(self.header))
+            self.out.flush()
+        self.__size = self.out.tell()
+        if self.file_format == FORMAT_CSV and self.index_every:
+            self.index = IndexWriter(self.full_path, self.__size, self.index_every)
+
+    def __archive(self, ts):
+        """Renames the file to its partition name, and compresses it"""
+        path = archive_file(self.full_path, ts)
+        self.log.info("Closed partition '%s' of '%s'", path, self.file_id)
+        if os.path.exists(self.full_path + INDEX_SUFFIX):
+            if self.compress == COMPRESS_NONE:
+                os.rename(self.full_path + INDEX_SUFFIX, path + INDEX_SUFFIX)
+            else:
+                # Offsets in the uncompressed file are no use
+                os.unlink(self.full_path + INDEX_SUFFIX)
+        compress_later(path, self.compress)
+
+    def __partition_due(self, ts, row_size):
+        """Whether a row for time ts, of row_size bytes, starts a new partition"""
+        if self.__partition_start is None:
+            # Only rows are partitioned; never leave a file with just a header
+            return False
+        if (self.rotate != ROTATE_NONE and
+            period_key(ts, self.rotate) != period_key(self.__partition_start,
+                                                      self.rotate)):
+            return True
+        return bool(self.max_size) and self.__size + row_size > self.max_size
+
+    def __new_partition(self):
+        self.out.close()
+        if self.index is not None:
+            self.index.close()
+        self.__archive(self.__partition_start)
+        self.partitions += 1
+        self.__partition_start = None
+        self.__open(False)
+
+    def __check_binary_file(self, full_path):
+        """
+        Returns True if the binary file at full_path has the same columns
+        and types as this one, first cutting off any partly written record
+        """
+        tf = open(full_path, 'rb')
+        try:
+            columns, types, offset = read_header(tf)
+        except NotABinaryFile:
+            return False
+        finally:
+            tf.close()
+        if columns != self.header[1:] or types != self.encoder.types:
+            return False
+        size = os.path.getsize(full_path)
+        torn = (size - offset) % self.encoder.record.size
+        if torn:
+            self.log.warning("Removing %d bytes of a partly written row from '%s'",
+                             torn, full_path)
+            tf = open(full_path, 'r+b')
+            tf.truncate(size - torn)
+            tf.close()
+        return True
+
+    def flush(self):
+        """Writes out any buffered rows"""
+        with self.__lock:
+            if self.out is not None:
+                self.out.flush_waiting()
+
+    def close(self):
+        """Writes out any buffered rows and closes the file"""
+        with self.__lock:
+            if self.out is not None:
+                self.out.close()
+            if self.index is not None:
+                self.index.close()
+            if self.rollup is not None:
+                self.rollup.close()
 
-    def collect_data(self, ts=None):
+    def stats(self):
+        stats = self.out.stats()
+        stats['partitions'] = self.partitions
+        stats['latency'] = {'last': self.latency, 'max': self.max_latency}
+        stats['stale_values'] = self.stale_values
+        if self.rollup is not None:
+            stats['rollup'] = self.rollup.stats()
+        return stats
+
+    def collect_data(self, ts=None, snapshot=None):
+        """
+        Writes a row for time ts (default: now). The readings come from
+        snapshot, a TickSnapshot shared with the other files due at ts, or
+        are taken now if there isn't one.
+        """
         self.log.debug("Collecting data for '%s'" % self.file_id)
-        # TODO: Convert 'None' to N/A.
-        data = dict([(s.display_name, s.get_reading())
-                     for s in self.sensors])
-        if ts:
-            cur_time = datetime.datetime.fromtimestamp(ts)
-        else:
-            cur_time = datetime.datetime.now()
-        data['Timestamp'] = cur_time.strftime('%Y-%m-%d %H:%M:%S')
-        self.csv.writerow(data)
+        with tracing.span('write', 'file', file=self.file_id):
+            if snapshot is None:
+                snapshot = TickSnapshot(ts or get_clock().time(), self.sensors)
+                snapshot.read()
+            if self.file_format == FORMAT_BINARY:
+                stamp = snapshot.ts
+            else:
+                stamp = snapshot.timestamp
+            readings = snapshot.readings(self.sensors)
+            stale = len([r for r in readings
+                         if isinstance(r, cchrc.sensors.StaleReading)])
+            self.latency = get_clock().time() - snapshot.ts
+            self.max_latency = max(self.max_latency, self.latency)
+            row = self.encoder.encode(stamp, readings)
+            with self.__lock:
+                if self.out.closed:
+                    self.log.warning("Dropping the row for %s of '%s', which is closed",
+                                     snapshot.timestamp, self.file_id)
+                    return
+                if self.partitioned and self.__partition_due(snapshot.ts, len(row)):
+                    self.__new_partition()
+                if self.__partition_start is None:
+                    self.__partition_start = snapshot.ts
+                if self.index is not None:
+                    self.index.add_row(snapshot.ts, self.__size)
+                self.out.write(row)
+                self.__size += len(row)
+                self.stale_values += stale
+                if self.rollup is not None:
+                    self.rollup.add(snapshot.ts, readings)
         self.log.debug("Done collecting data for '%s'" % self.file_id)
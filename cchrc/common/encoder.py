@@ -0,0 +1,77 @@
+"""
+Turning data file rows into CSV lines.
+"""
+from cchrc.common.exceptions import MalformedConfigFile
+
+NULL = 'N/A'
+
+def quote(field):
+    """Quotes a CSV field the way the csv module's QUOTE_MINIMAL does"""
+    if ',' in field or '"' in field or '\r' in field or '\n' in field:
+        return '"' + field.replace('"', '""') + '"'
+    return field
+
+def _default_encoder(value):
+    if value is None:
+        return NULL
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, (int, long)):
+        return str(value)
+    return quote(str(value))
+
+def _format_encoder(fmt):
+    def encode(value):
+        if value is None:
+            return NULL
+        try:
+            return fmt % value
+        except TypeError:
+            return _default_encoder(value)
+    return encode
+
+class RowEncoder(object):
+    """
+    Encodes rows of a data file: a timestamp followed by one value per
+    column. It is compiled once from the columns' formats, so encoding a
+    row is one string formatting operation when every column has a format
+    and every value is present and a number, and one call per column
+    otherwise. None is written as N/A, whatever the column's format.
+    """
+    lineterminator = '\r\n'
+
+    def __init__(self, formats):
+        """
+        formats is a list with one printf-style format (e.g. '%.3f') per
+        column, or None for the default: repr() for floats, str() for
+        everything else.
+        """
+        for fmt in formats:
+            if fmt is None:
+                continue
+            try:
+                fmt % 1.0
+            except (TypeError, ValueError):
+                raise MalformedConfigFile("Invalid column format '%s'" % fmt)
+        self.formats = list(formats)
+        self.__encoders = [fmt and _format_encoder(fmt) or _default_encoder
+                           for fmt in formats]
+        if formats and None not in formats:
+            self.__template = ('%s,' + ','.join(formats) + self.lineterminator)
+        else:
+            self.__template = None
+
+    def encode_header(self, header):
+        return ','.join([quote(h) for h in header]) + self.lineterminator
+
+    def encode(self, timestamp, values):
+        # %s or %r would write None as 'None', so missing readings always
+        # take the per column path
+        if self.__template is not None and None not in values:
+            try:
+                return self.__template % ((timestamp,) + tuple(values))
+            except TypeError:
+                # Something that isn't a number
+                pass
+        return (','.join([timestamp] + [e(v) for e, v in zip(self.__encoders, values)])
+                + self.lineterminator)
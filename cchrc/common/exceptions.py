@@ -21,3 +21,9 @@ class SensorNotDefined(Exception):
 
 class BaseDirDoesNotExist(Exception):
     pass
+
+class InvalidSchedulerPolicy(Exception):
+    pass
+
+class NotABinaryFile(Exception):
+    pass
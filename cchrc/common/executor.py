@@ -0,0 +1,149 @@
+"""
+A long-lived pool of collection threads.
+
+Work is submitted to a named lane (in practice, a collection interval).
+Each lane has its own queue and its own workers, so a backlog in the 3600
+second lane never delays the 5 second lane. Workers are started as they
+are needed, up to the configured number per lane, and are reused from one
+tick to the next.
+
+Work counts as busy on the clock (see cchrc.common.clock) from being
+submitted until it is done, as long as there is a worker to run it.
+"""
+import logging
+import Queue
+import threading
+
+import futures
+
+from cchrc.common.clock import get_clock
+
+class _WorkItem(object):
+    def __init__(self, future, fn, args, kwargs):
+        self.future = future
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+
+    def run(self):
+        if not self.future.set_running_or_notify_cancel():
+            return
+        try:
+            result = self.fn(*self.args, **self.kwargs)
+        except BaseException, ex:
+            self.future.set_exception(ex)
+        else:
+            self.future.set_result(result)
+
+class _Lane(object):
+    def __init__(self, name, max_workers, clock):
+        self.name = name
+        self.max_workers = max_workers
+        self.clock = clock
+        self.queue = Queue.Queue()
+        self.threads = []
+        # Items submitted and not yet done, whether queued or running
+        self.outstanding = 0
+        self.running = 0
+        self.completed = 0
+        self.max_queued = 0
+        self.lock = threading.Lock()
+        self.log = logging.getLogger('cchrc.common.executor.CollectionExecutor')
+
+    def submit(self, item):
+        with self.lock:
+            self.outstanding += 1
+            if self.outstanding <= self.max_workers:
+                self.clock.busy(1)
+            self.queue.put(item)
+            queued = self.queue.qsize()
+            if queued > self.max_queued:
+                self.max_queued = queued
+            # A worker that has taken an item may not have counted itself
+            # as running yet, so compare against all work not yet done
+            if (self.outstanding > len(self.threads) and
+                len(self.threads) < self.max_workers):
+                t = threading.Thread(target=self.work,
+                                     name='%s-%s' % (self.name, len(self.threads)))
+                t.daemon = True
+                self.threads.append(t)
+                t.start()
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            with self.lock:
+                self.running += 1
+            self.clock.working(True)
+            try:
+                item.run()
+            except Exception: # pragma: no cover
+                self.log.exception("Lane '%s' worker failed", self.name)
+            finally:
+                self.clock.working(False)
+                with self.lock:
+                    self.running -= 1
+                    self.completed += 1
+                    # If more is queued than there are workers, this
+                    # worker goes on to the next item, and stays busy
+                    if self.outstanding <= self.max_workers:
+                        self.clock.busy(-1)
+                    self.outstanding -= 1
+
+    def shutdown(self, wait):
+        for _ in self.threads:
+            self.queue.put(None)
+        if wait:
+            for t in self.threads:
+                t.join()
+
+    def stats(self):
+        return {'queued': self.queue.qsize(),
+                'max_queued': self.max_queued,
+                'running': self.running,
+                'completed': self.completed,
+                'threads': len(self.threads)}
+
+class CollectionExecutor(object):
+    def __init__(self, name, workers_per_lane=8, clock=None):
+        """
+        name is used to name the worker threads
+        workers_per_lane is the most threads a single lane will use
+        clock is the cchrc.common.clock to run on (default: the one in use)
+        """
+        self.name = name
+        self.workers_per_lane = workers_per_lane
+        self.clock = clock or get_clock()
+        self.__lanes = {}
+        self.__lock = threading.Lock()
+        self.__shutdown = False
+
+    def __lane(self, lane):
+        with self.__lock:
+            if self.__shutdown:
+                raise RuntimeError("CollectionExecutor '%s' is shut down" % self.name)
+            if lane not in self.__lanes:
+                self.__lanes[lane] = _Lane('%s-%s' % (self.name, lane),
+                                           self.workers_per_lane, self.clock)
+            return self.__lanes[lane]
+
+    def submit(self, lane, fn, *args, **kwargs):
+        """Runs fn(*args, **kwargs) on lane, and returns a Future"""
+        future = futures.Future()
+        self.__lane(lane).submit(_WorkItem(future, fn, args, kwargs))
+        return future
+
+    def queue_depths(self):
+        """Number of submitted, not yet started, items in each lane"""
+        return dict((k, l.queue.qsize()) for k, l in self.__lanes.items())
+
+    def shutdown(self, wait=True):
+        with self.__lock:
+            self.__shutdown = True
+        for lane in self.__lanes.values():
+            lane.shutdown(wait)
+
+    def stats(self):
+        return dict((str(k), l.stats()) for k, l in self.__lanes.items())
@@ -0,0 +1,299 @@
+"""
+Sparse timestamp indexes of data files, and extracting time ranges from
+data files and their partitions.
+
+A CSV data file FileName has a sidecar FileName.idx, which holds the time
+and byte offset of every IndexEvery'th row as fixed-width records (a
+float64 and a uint64, little-endian). Finding the first row of a range is
+a binary search of the index followed by a short scan of the data file.
+Binary data files need no index, as their records are themselves fixed
+width.
+"""
+import datetime
+import gzip
+import mmap
+import optparse
+import os
+import re
+import struct
+import subprocess
+import sys
+import time
+
+from cchrc.common.binfile import (BinaryReader, MAGIC, decode, read_header,
+                                  _record_struct)
+from cchrc.common.encoder import RowEncoder
+from cchrc.common.partition import STAMP_FORMAT, SUFFIXES
+
+SUFFIX = '.idx'
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+_entry = struct.Struct('<dQ')
+_stamp_re = re.compile(r'\.(\d{8}-\d{6})(-\d+)?(\.gz|\.xz)?$')
+
+def _format(ts):
+    return datetime.datetime.fromtimestamp(ts).strftime(TIMESTAMP_FORMAT)
+
+class IndexWriter(object):
+    """Appends entries to the index of a data file"""
+    def __init__(self, data_path, data_size, every=100):
+        """
+        data_path is the data file; entries at or beyond data_size (rows
+        which were lost, e.g. when CDC stopped with rows buffered) are removed
+        every is how many rows there are between index entries
+        """
+        self.path = data_path + SUFFIX
+        self.every = every
+        self.entries = 0
+        self.__rows = 0
+        self.__fd = os.open(self.path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0644)
+        valid = len(read_index(self.path, data_size))
+        if os.fstat(self.__fd).st_size != valid * _entry.size:
+            os.ftruncate(self.__fd, valid * _entry.size)
+
+    def add_row(self, ts, offset):
+        """Notes that the row for time ts starts at offset"""
+        if self.__rows % self.every == 0:
+            os.write(self.__fd, _entry.pack(ts, offset))
+            self.entries += 1
+        self.__rows += 1
+
+    def close(self):
+        if self.__fd is not None:
+            os.close(self.__fd)
+            self.__fd = None
+
+def read_index(path, data_size=None):
+    """
+    Reads the index at path, returning a list of (time, offset); entries at
+    or beyond data_size are left out
+    """
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return []
+    try:
+        data = f.read()
+    finally:
+        f.close()
+    entries = []
+    for pos in xrange(0, len(data) - len(data) % _entry.size, _entry.size):
+        ts, offset = _entry.unpack_from(data, pos)
+        if data_size is not None and offset >= data_size:
+            break
+        entries.append((ts, offset))
+    return entries
+
+def seek_offset(path, start):
+    """
+    The offset in the CSV data file at path from which to scan for rows at
+    or after start, using its index; None to scan from the first row
+    """
+    size = os.path.getsize(path)
+    if not os.path.exists(path + SUFFIX) or os.path.getsize(path + SUFFIX) < _entry.size:
+        return None
+    f = open(path + SUFFIX, 'rb')
+    m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        # Find the last entry before start, in the data file
+        lo, hi = 0, len(m) // _entry.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            ts, offset = _entry.unpack_from(m, mid * _entry.size)
+            if ts < start and offset < size:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == 0:
+            return None
+        return _entry.unpack_from(m, (lo - 1) * _entry.size)[1]
+    finally:
+        m.close()
+        f.close()
+
+def _open(path):
+    """Opens a data file or partition, compressed or not"""
+    if path.endswith(SUFFIXES['gzip']):
+        return gzip.open(path, 'rb')
+    if path.endswith(SUFFIXES['xz']):
+        return subprocess.Popen(['xz', '-dc', path], stdout=subprocess.PIPE).stdout
+    return open(path, 'rb')
+
+def _is_compressed(path):
+    return any([path.endswith(s) for s in SUFFIXES.values()])
+
+def first_row_time(path):
+    """The time of the first row of a data file or partition; None if it has none"""
+    m = _stamp_re.search(path)
+    if m:
+        return time.mktime(time.strptime(m.group(1), STAMP_FORMAT))
+    f = _open(path)
+    try:
+        if f.read(len(MAGIC)) == MAGIC:
+            if _is_compressed(path):
+                return None
+            reader = BinaryReader(path)
+            try:
+                return reader.timestamp(0) if len(reader) else None
+            finally:
+                reader.close()
+        f.readline()
+        row = f.readline()
+    finally:
+        f.close()
+    try:
+        return time.mktime(time.strptime(row[:19], TIMESTAMP_FORMAT))
+    except ValueError:
+        return None
+
+def partitions(full_path):
+    """
+    The data file full_path and its partitions (FileName.N, and
+    FileName.STAMP, compressed or not) which have rows, as a list of
+    (time of first row, path) in time order
+    """
+    base_dir, name = os.path.split(full_path)
+    found = []
+    for f in os.listdir(base_dir or '.'):
+        if f != name and not f.startswith(name + '.'):
+            continue
+        rest = f[len(name):]
+        if (rest and not _stamp_re.match(rest) and
+            not re.match(r'^\.\d+$', rest)):
+            continue
+        path = os.path.join(base_dir, f)
+        ts = first_row_time(path)
+        if ts is not None:
+            found.append((ts, path))
+    found.sort()
+    return found
+
+def _csv_rows(path, start, end):
+    """The header line and the lines of the rows in [start, end) of a CSV file"""
+    start_s = _format(start)
+    # '~' sorts after any timestamp
+    end_s = _format(end) if end is not None else '~'
+    offset = None if _is_compressed(path) else seek_offset(path, start)
+    f = _open(path)
+    try:
+        yield f.readline()
+        if offset is not None:
+            f.seek(offset)
+        for line in f:
+            stamp = line[:19]
+            if stamp < start_s:
+                continue
+            if stamp >= end_s:
+                break
+            yield line
+    finally:
+        f.close()
+
+def _binary_rows(path, start, end):
+    """The header line and the lines of the rows in [start, end) of a binary file"""
+    if _is_compressed(path):
+        f = _open(path)
+        try:
+            columns, types, _ = read_header(f)
+            record = _record_struct(types)
+            rows = _decode_stream(f, record)
+            encoder = RowEncoder([None] * len(columns))
+            yield encoder.encode_header(['Timestamp'] + columns)
+            for ts, values in rows:
+                if ts < start:
+                    continue
+                if end is not None and ts >= end:
+                    break
+                yield encoder.encode(_format(ts), values)
+        finally:
+            f.close()
+        return
+    reader = BinaryReader(path)
+    try:
+        encoder = RowEncoder([None] * len(reader.columns))
+        yield encoder.encode_header(reader.header)
+        lo, hi = 0, len(reader)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if reader.timestamp(mid) < start:
+                lo = mid + 1
+            else:
+                hi = mid
+        for i in xrange(lo, len(reader)):
+            ts, values = reader[i]
+            if end is not None and ts >= end:
+                break
+            yield encoder.encode(_format(ts), values)
+    finally:
+        reader.close()
+
+def _decode_stream(f, record):
+    """The rows of a binary file being read from f, after its header"""
+    while True:
+        data = f.read(record.size)
+        if len(data) < record.size:
+            return
+        yield decode(record.unpack(data))
+
+def extract(full_path, start, end=None):
+    """
+    Yields the CSV lines of the rows of the data file full_path, and its
+    partitions, from time start up to (not including) time end, or to the
+    last row if end is None. A header line comes first, and again wherever
+    the columns change.
+    """
+    parts = partitions(full_path)
+    header = None
+    for i, (first, path) in enumerate(parts):
+        if end is not None and first >= end:
+            break
+        if i + 1 < len(parts) and parts[i + 1][0] <= start:
+            continue
+        f = _open(path)
+        is_binary = f.read(len(MAGIC)) == MAGIC
+        f.close()
+        rows = (_binary_rows if is_binary else _csv_rows)(path, start, end)
+        part_header = rows.next()
+        for line in rows:
+            if part_header != header:
+                header = part_header
+                yield header
+            yield line
+
+def parse_time(s):
+    """Parses a local time given as YYYY-mm-dd[ HH:MM[:SS]]"""
+    for fmt in (TIMESTAMP_FORMAT, '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return time.mktime(time.strptime(s, fmt))
+        except ValueError:
+            pass
+    raise ValueError("Invalid time '%s'" % s)
+
+def main():
+    usage = ("usage: %prog [options] data-file start end\n\n"
+             "Prints the rows of data-file, and its partitions, from start up to\n"
+             "end, given as 'YYYY-mm-dd[ HH:MM[:SS]]' local time")
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option('-o', '--output', dest='output',
+                      help="write the rows to OUTPUT instead of the standard output")
+    opts, args = parser.parse_args()
+    if len(args) != 3:
+        parser.error("Must provide a data file, start and end on the command line")
+    try:
+        start, end = parse_time(args[1]), parse_time(args[2])
+    except ValueError, ex:
+        parser.error(str(ex))
+
+    out = open(opts.output, 'wb') if opts.output else sys.stdout
+    try:
+        for line in extract(args[0], start, end):
+            out.write(line)
+    except (IOError, OSError), ex:
+        print >> sys.stderr, "Could not read '%s': %s" % (args[0], str(ex))
+        sys.exit(1)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""
+Partitioning data files by time and size, and compressing the closed
+partitions.
+
+The file being written always has the configured FileName. When it is
+partitioned, it is renamed to FileName.YYYYmmdd-HHMMSS, the time of its
+first row, so starting a partition is one rename whatever the number of
+old partitions. Closed partitions are then compressed, one at a time, by a
+background thread which the collection threads never wait for.
+"""
+import datetime
+import gzip
+import logging
+import os
+import shutil
+import subprocess
+import threading
+import time
+
+from cchrc.common.executor import CollectionExecutor
+from cchrc.common.exceptions import MalformedConfigFile
+
+ROTATE_NONE = 'none'
+ROTATE_HOURLY = 'hourly'
+ROTATE_DAILY = 'daily'
+ROTATE_MONTHLY = 'monthly'
+# How much of time.localtime() identifies a partition
+ROTATE_PERIODS = {ROTATE_NONE: 0, ROTATE_HOURLY: 4, ROTATE_DAILY: 3,
+                  ROTATE_MONTHLY: 2}
+
+COMPRESS_NONE = 'none'
+COMPRESS_GZIP = 'gzip'
+COMPRESS_XZ = 'xz'
+COMPRESS_METHODS = (COMPRESS_NONE, COMPRESS_GZIP, COMPRESS_XZ)
+SUFFIXES = {COMPRESS_GZIP: '.gz', COMPRESS_XZ: '.xz'}
+
+STAMP_FORMAT = '%Y%m%d-%H%M%S'
+_SIZE_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+_compressor = None
+_compressor_lock = threading.Lock()
+
+def parse_size(size):
+    """Parses a size in bytes, with an optional K, M or G suffix"""
+    size = str(size).strip().upper()
+    try:
+        if size and size[-1] in _SIZE_UNITS:
+            return int(float(size[:-1]) * _SIZE_UNITS[size[-1]])
+        return int(size)
+    except ValueError:
+        raise MalformedConfigFile("Invalid size '%s'" % size)
+
+def period_key(ts, rotate):
+    """Identifies the partition of time ts; None if files are not rotated by time"""
+    if not ROTATE_PERIODS[rotate]:
+        return None
+    return time.localtime(ts)[:ROTATE_PERIODS[rotate]]
+
+def period_start(key):
+    """The time at which the period identified by key (see period_key) starts"""
+    parts = list(key)
+    while len(parts) < 4:
+        # The first day of the month, the first hour of the day
+        parts.append(1 if len(parts) == 2 else 0)
+    return time.mktime(tuple(parts) + (0, 0, 0, 0, -1))
+
+def archive_file(full_path, ts):
+    """
+    Renames full_path to full_path.STAMP, the local time ts, and returns the
+    new path. A -N is added to the stamp if that name is already taken.
+    """
+    stamp = datetime.datetime.fromtimestamp(ts).strftime(STAMP_FORMAT)
+    new_path = full_path + '.' + stamp
+    count = 0
+    while any([os.path.exists(new_path + s) for s in [''] + SUFFIXES.values()]):
+        count += 1
+        new_path = '%s.%s-%d' % (full_path, stamp, count)
+    os.rename(full_path, new_path)
+    return new_path
+
+def _gzip(path):
+    tmp_path = path + '.gz.tmp'
+    src = open(path, 'rb')
+    try:
+        dst = gzip.open(tmp_path, 'wb')
+        try:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        finally:
+            dst.close()
+    finally:
+        src.close()
+    os.rename(tmp_path, path + '.gz')
+    os.unlink(path)
+
+def _xz(path):
+    # xz only replaces path with path.xz once it has been written in full
+    subprocess.check_call(['xz', '-q', '-f', path],
+                          preexec_fn=lambda: os.nice(10))
+
+def compress(path, method):
+    """Compresses path, replacing it with path.gz or path.xz"""
+    log = logging.getLogger('cchrc.common.partition')
+    start = time.time()
+    try:
+        if method == COMPRESS_GZIP:
+            _gzip(path)
+        elif method == COMPRESS_XZ:
+            _xz(path)
+    except Exception, ex:
+        log.error("Could not compress '%s' with %s: '%s'", path, method, str(ex))
+        raise
+    log.info("Compressed '%s' with %s in %.1f seconds", path, method,
+             time.time() - start)
+    return path + SUFFIXES[method]
+
+def compressor():
+    """The executor which compresses closed partitions, in one thread"""
+    global _compressor
+    with _compressor_lock:
+        if _compressor is None:
+            _compressor = CollectionExecutor('Compressor', 1)
+        return _compressor
+
+def compress_later(path, method):
+    """
+    Compresses path in the background, and returns a future for the
+    compressed file's path; None if method is none.
+    """
+    if method == COMPRESS_NONE:
+        return None
+    return compressor().submit('compress', compress, path, method)
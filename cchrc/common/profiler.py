@@ -0,0 +1,131 @@
+"""
+A sampling profiler for every thread of a running collector.
+
+cProfile only sees the thread it was started in, and the collection
+threads are started long before anyone wants to profile them, so instead
+the stacks of all threads are sampled at a fixed interval (with
+sys._current_frames) for a bounded window. Nothing is hooked into the
+collection code: when no Profiler is running there is no cost at all.
+
+Samples are wall-clock: a thread waiting on a lock or a bus read counts
+where it waits, which is what we want when looking for missed rows.
+"""
+from collections import defaultdict
+import logging
+import os
+import re
+import sys
+import threading
+import time
+
+# How often the stacks are sampled, in seconds
+INTERVAL = 0.01
+# Functions listed in each report
+TOP = 40
+
+def _location(code):
+    return '%s:%s(%s)' % (code.co_filename, code.co_firstlineno, code.co_name)
+
+class ThreadProfile(object):
+    """The samples of one thread"""
+    def __init__(self, name):
+        self.name = name
+        self.samples = 0
+        # function -> samples where it was running (self) / on the stack (total)
+        self.own = defaultdict(int)
+        self.total = defaultdict(int)
+        # collapsed stack (outermost first, ';' separated) -> samples
+        self.stacks = defaultdict(int)
+
+    def add(self, frame):
+        stack = []
+        while frame is not None:
+            stack.append(_location(frame.f_code))
+            frame = frame.f_back
+        self.samples += 1
+        self.own[stack[0]] += 1
+        for loc in set(stack):
+            self.total[loc] += 1
+        self.stacks[';'.join(reversed(stack))] += 1
+
+    def merge(self, other):
+        self.samples += other.samples
+        for attr in ('own', 'total', 'stacks'):
+            mine = getattr(self, attr)
+            for k, v in getattr(other, attr).items():
+                mine[k] += v
+
+def report(profile, title, top=TOP):
+    """A text report of the functions a profile spent the most samples in"""
+    lines = [title, 'Samples: %s' % profile.samples, '',
+             '%8s %8s  %s' % ('self%', 'total%', 'function')]
+    n = float(profile.samples or 1)
+    hot = sorted(profile.own.items(), key=lambda x: (-x[1], x[0]))[:top]
+    for loc, count in hot:
+        lines.append('%8.2f %8.2f  %s' % (100 * count / n,
+                                          100 * profile.total[loc] / n, loc))
+    lines.extend(['', 'By time on the stack:', ''])
+    hot = sorted(profile.total.items(), key=lambda x: (-x[1], x[0]))[:top]
+    for loc, count in hot:
+        lines.append('%8.2f %8.2f  %s' % (100 * profile.own.get(loc, 0) / n,
+                                          100 * count / n, loc))
+    return '\n'.join(lines) + '\n'
+
+class Profiler(threading.Thread):
+    """
+    Samples every other thread for duration seconds, then writes a report
+    and the collapsed stacks (as used by flamegraph.pl) of each thread, and
+    a report of all threads merged, to out_dir.
+    """
+    def __init__(self, duration, out_dir, interval=INTERVAL):
+        threading.Thread.__init__(self, name='Profiler')
+        self.daemon = True
+        self.duration = duration
+        self.out_dir = out_dir
+        self.interval = interval
+        self.log = logging.getLogger('cchrc.common.profiler.Profiler')
+        self.profiles = {}
+        self.__stop = threading.Event()
+
+    def sample(self):
+        names = dict((t.ident, t.name) for t in threading.enumerate())
+        for ident, frame in sys._current_frames().items():
+            if ident == self.ident:
+                continue
+            if ident not in self.profiles:
+                self.profiles[ident] = ThreadProfile(names.get(ident, str(ident)))
+            self.profiles[ident].add(frame)
+
+    def run(self):
+        self.log.info("Profiling all threads for %s seconds", self.duration)
+        end = time.time() + self.duration
+        while not self.__stop.is_set() and time.time() < end:
+            self.sample()
+            self.__stop.wait(self.interval)
+        try:
+            self.write()
+        except Exception:
+            self.log.exception("Could not write the profile to '%s'", self.out_dir)
+        else:
+            self.log.info("Profile written to '%s'", self.out_dir)
+
+    def stop(self):
+        """Ends the profile early; it is still written"""
+        self.__stop.set()
+        self.join()
+
+    def write(self):
+        if not os.path.exists(self.out_dir):
+            os.makedirs(self.out_dir)
+        merged = ThreadProfile('all threads')
+        for ident, profile in sorted(self.profiles.items()):
+            base = 'thread-%s-%s' % (re.sub(r'[^\w.-]+', '_', profile.name), ident)
+            with open(os.path.join(self.out_dir, base + '.txt'), 'w') as f:
+                f.write(report(profile, 'Thread: %s (%s)' % (profile.name, ident)))
+            with open(os.path.join(self.out_dir, base + '.folded'), 'w') as f:
+                for stack, count in sorted(profile.stacks.items()):
+                    f.write('%s %s\n' % (stack, count))
+            merged.merge(profile)
+        with open(os.path.join(self.out_dir, 'merged.txt'), 'w') as f:
+            f.write(report(merged, 'All threads (%s), sampled every %s seconds'
+                           % (len(self.profiles), self.interval)))
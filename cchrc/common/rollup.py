@@ -0,0 +1,244 @@
+"""
+Hourly, daily and monthly summaries of data files.
+
+A Rollup is given every row its data file writes, and keeps the count,
+sum, minimum and maximum of each column for the current hour, day or
+month. When a period closes, a row with its minimum, mean and maximum is
+written to the companion file FileName.hourly (.daily, .monthly). Only the
+shortest period is built from the rows themselves; each longer one is
+built from the closed buckets of the period below it.
+
+The open buckets are checkpointed to FileName.rollup. When the Rollup is
+created again, it loads the checkpoint, and replays any rows written to
+the data file after it (see cchrc.common.index.extract), so a restart
+loses nothing.
+"""
+import csv
+import datetime
+import json
+import logging
+import math
+import os
+import time
+
+from cchrc.common.encoder import RowEncoder, NULL
+from cchrc.common.exceptions import MalformedConfigFile
+from cchrc.common.index import extract
+from cchrc.common.partition import (archive_file, period_start,
+                                    ROTATE_PERIODS, ROTATE_NONE)
+from cchrc.common.clock import get_clock
+from cchrc.common.writer import BufferedFile, FSYNC_NONE
+
+CHECKPOINT_SUFFIX = '.rollup'
+STATISTICS = ('min', 'mean', 'max')
+
+class _Bucket(object):
+    """The aggregates of each column over one period"""
+    def __init__(self, key, num_columns):
+        self.key = tuple(key)
+        self.rows = 0
+        self.counts = [0] * num_columns
+        self.sums = [0.0] * num_columns
+        self.mins = [None] * num_columns
+        self.maxs = [None] * num_columns
+
+    def add(self, values):
+        self.rows += 1
+        counts, sums, mins, maxs = self.counts, self.sums, self.mins, self.maxs
+        for i, v in enumerate(values):
+            if v is None:
+                continue
+            try:
+                v = float(v)
+            except (TypeError, ValueError):
+                continue
+            if math.isnan(v):
+                continue
+            counts[i] += 1
+            sums[i] += v
+            if mins[i] is None or v < mins[i]:
+                mins[i] = v
+            if maxs[i] is None or v > maxs[i]:
+                maxs[i] = v
+
+    def merge(self, other):
+        """Adds the aggregates of other, a bucket of a shorter period"""
+        self.rows += other.rows
+        for i in xrange(len(self.counts)):
+            if not other.counts[i]:
+                continue
+            self.counts[i] += other.counts[i]
+            self.sums[i] += other.sums[i]
+            if self.mins[i] is None or other.mins[i] < self.mins[i]:
+                self.mins[i] = other.mins[i]
+            if self.maxs[i] is None or other.maxs[i] > self.maxs[i]:
+                self.maxs[i] = other.maxs[i]
+
+    def summary(self):
+        values = [self.rows]
+        for i in xrange(len(self.counts)):
+            if self.counts[i]:
+                values.extend([self.mins[i], self.sums[i] / self.counts[i],
+                               self.maxs[i]])
+            else:
+                values.extend([None, None, None])
+        return values
+
+    def to_dict(self):
+        return {'key': self.key, 'rows': self.rows, 'counts': self.counts,
+                'sums': self.sums, 'mins': self.mins, 'maxs': self.maxs}
+
+    @classmethod
+    def from_dict(klass, d):
+        bucket = klass(d['key'], len(d['counts']))
+        bucket.rows = d['rows']
+        bucket.counts, bucket.sums = d['counts'], d['sums']
+        bucket.mins, bucket.maxs = d['mins'], d['maxs']
+        return bucket
+
+class Rollup(object):
+    def __init__(self, full_path, columns, periods, formats=None,
+                 checkpoint_interval=60, fsync=FSYNC_NONE):
+        """
+        full_path is the data file being summarized
+        columns is the data file's columns, without the Timestamp
+        periods is a list of hourly, daily and monthly
+        formats is a list with a printf-style format per column, or None
+        checkpoint_interval is the most seconds between checkpoints
+        fsync is the fsync policy of the summary files
+        """
+        for p in periods:
+            if p not in ROTATE_PERIODS or p == ROTATE_NONE:
+                raise MalformedConfigFile("Invalid rollup period '%s' for '%s'" %
+                                          (p, full_path))
+        self.full_path = full_path
+        self.columns = list(columns)
+        # Shortest period first
+        self.periods = sorted(set(periods), key=lambda p: -ROTATE_PERIODS[p])
+        self.checkpoint_path = full_path + CHECKPOINT_SUFFIX
+        self.checkpoint_interval = checkpoint_interval
+        self.log = logging.getLogger('cchrc.common.rollup.Rollup')
+        formats = formats or [None] * len(self.columns)
+        self.header = ['Timestamp', 'Rows'] + ['%s_%s' % (c, s) for c in self.columns
+                                               for s in STATISTICS]
+        self.encoder = RowEncoder([None] + [f for f in formats for s in STATISTICS])
+        self.rows_written = dict([(p, 0) for p in self.periods])
+        self.checkpoints = 0
+        self.__buckets = dict([(p, None) for p in self.periods])
+        self.__last_ts = None
+        self.__last_checkpoint = get_clock().monotonic()
+        self.__files = {}
+        for p in self.periods:
+            self.__files[p] = self.__open(full_path + '.' + p, fsync)
+        self.__restore()
+
+    def __open(self, path, fsync):
+        header = self.encoder.encode_header(self.header)
+        if os.path.exists(path):
+            tf = open(path, 'rb')
+            existing = tf.readline()
+            tf.close()
+            if existing != header:
+                archive_file(path, os.path.getmtime(path))
+        out = BufferedFile(path, fsync=fsync)
+        if not out.tell():
+            out.write(header)
+        return out
+
+    def add(self, ts, values):
+        """Adds the row for time ts; rows no later than the last one are ignored"""
+        if self.__last_ts is not None and ts <= self.__last_ts:
+            return
+        tm = time.localtime(ts)
+        closed = None
+        for p in self.periods:
+            key = tm[:ROTATE_PERIODS[p]]
+            bucket = self.__buckets[p]
+            if closed is not None:
+                # Longer periods are built from the buckets of shorter ones
+                if bucket is None:
+                    bucket = self.__buckets[p] = _Bucket(closed.key[:ROTATE_PERIODS[p]],
+                                                         len(self.columns))
+                bucket.merge(closed)
+            if bucket is not None and bucket.key != key:
+                self.__write(p, bucket)
+                self.__buckets[p] = None
+                closed = bucket
+            else:
+                closed = None
+        finest = self.periods[0]
+        if self.__buckets[finest] is None:
+            self.__buckets[finest] = _Bucket(tm[:ROTATE_PERIODS[finest]],
+                                             len(self.columns))
+        self.__buckets[finest].add(values)
+        self.__last_ts = ts
+        if get_clock().monotonic() - self.__last_checkpoint >= self.checkpoint_interval:
+            self.checkpoint()
+
+    def __write(self, period, bucket):
+        stamp = datetime.datetime.fromtimestamp(period_start(bucket.key))
+        self.__files[period].write(self.encoder.encode(
+            stamp.strftime('%Y-%m-%d %H:%M:%S'), bucket.summary()))
+        self.rows_written[period] += 1
+
+    def checkpoint(self):
+        """Saves the open buckets"""
+        state = {'columns': self.columns, 'last_ts': self.__last_ts,
+                 'buckets': dict([(p, b.to_dict()) for p, b in self.__buckets.items()
+                                  if b is not None])}
+        tmp_path = self.checkpoint_path + '.tmp'
+        f = open(tmp_path, 'wb')
+        try:
+            json.dump(state, f)
+        finally:
+            f.close()
+        os.rename(tmp_path, self.checkpoint_path)
+        self.__last_checkpoint = get_clock().monotonic()
+        self.checkpoints += 1
+
+    def __restore(self):
+        """Loads the checkpoint, and replays the rows written since it was taken"""
+        try:
+            f = open(self.checkpoint_path, 'rb')
+        except IOError:
+            return
+        try:
+            state = json.load(f)
+        except ValueError, ex:
+            self.log.error("Ignoring unreadable rollup checkpoint '%s': '%s'",
+                           self.checkpoint_path, str(ex))
+            return
+        finally:
+            f.close()
+        if ([c.encode('utf-8') for c in state['columns']] != self.columns or
+            state['last_ts'] is None):
+            self.log.info("Columns of '%s' have changed; starting new rollups",
+                          self.full_path)
+            return
+        for p, b in state['buckets'].items():
+            if p in self.__buckets:
+                self.__buckets[p] = _Bucket.from_dict(b)
+        self.__last_ts = state['last_ts']
+
+        header, replayed = None, 0
+        expected = ['Timestamp'] + self.columns
+        for row in csv.reader(extract(self.full_path, self.__last_ts)):
+            if row[0] == 'Timestamp':
+                header = row
+                continue
+            if header != expected:
+                continue
+            ts = time.mktime(time.strptime(row[0], '%Y-%m-%d %H:%M:%S'))
+            self.add(ts, [None if v == NULL else v for v in row[1:]])
+            replayed += 1
+        self.log.info("Restored rollups of '%s', replaying %d rows",
+                      self.full_path, replayed)
+
+    def close(self):
+        self.checkpoint()
+        for f in self.__files.values():
+            f.close()
+
+    def stats(self):
+        return {'rows_written': dict(self.rows_written),
+                'checkpoints': self.checkpoints}
@@ -0,0 +1,273 @@
+"""
+Deadline driven scheduler shared by the SensorContainer and the
+DataFileRunner.
+
+Jobs are kept in a min-heap ordered by their next deadline on a monotonic
+clock, and the scheduler thread sleeps until the earliest one is due (or
+until it is woken up to stop). Ticks are aligned to epoch boundaries: a job
+with an interval of 300 fires at wall-clock times where
+``ts % 300 == offset``, and each job remembers the index of its next tick,
+so a tick is never run twice, even if the wall clock is stepped.
+
+The time comes from cchrc.common.clock, so a schedule can be run on a
+simulated clock, faster than real time.
+"""
+import heapq
+import itertools
+import logging
+import math
+import threading
+
+from cchrc.common.clock import get_clock
+from cchrc.common.exceptions import InvalidSchedulerPolicy
+from cchrc.common import tracing
+from cchrc.common.stats import Histogram
+
+# Catch-up policies for ticks whose deadline passed while the scheduler
+# was busy (or the machine was suspended, or the clock was stepped).
+# latest: run once, for the most recent missed tick
+# all: run every missed tick, oldest first (at most max_catch_up of them)
+# skip: drop ticks which are more than one grace period late
+CATCH_UP_LATEST = 'latest'
+CATCH_UP_ALL = 'all'
+CATCH_UP_SKIP = 'skip'
+CATCH_UP_POLICIES = (CATCH_UP_LATEST, CATCH_UP_ALL, CATCH_UP_SKIP)
+
+# Longest time we sleep without looking at the wall clock. This bounds how
+# long it takes to notice the wall clock being stepped.
+MAX_SLEEP = 60.0
+# A change in the wall/monotonic offset larger than this is a clock step
+CLOCK_STEP = 1.0
+# Deadlines are recomputed when the wall clock drifts this far
+CLOCK_RESYNC = 0.01
+
+def _tick_index(ts, interval, offset=0):
+    """Index of the last tick at or before wall-clock time ts"""
+    return int(math.floor((ts - offset) / float(interval)))
+
+def _due_ticks(next_tick, cur_tick, policy, max_catch_up, late_ticks=0):
+    """
+    Given the index of the next tick a job should run and the index of the
+    current tick, returns (ticks_to_run, number_of_ticks_dropped).
+    late_ticks is how many whole grace periods the current tick is late;
+    it is only used by the skip policy.
+    """
+    if cur_tick < next_tick:
+        cur_tick = next_tick
+    missed = cur_tick - next_tick
+    if policy == CATCH_UP_ALL:
+        first = max(next_tick, cur_tick - max_catch_up + 1)
+        return range(first, cur_tick + 1), first - next_tick
+    elif policy == CATCH_UP_SKIP and late_ticks > 0:
+        return [], missed + 1
+    else:
+        return [cur_tick], missed
+
+class Job(object):
+    """
+    A periodic job. callback is called with the epoch timestamp of the tick
+    it is running for.
+    """
+    def __init__(self, interval, callback, offset=0, run_at_start=False,
+                 catch_up=CATCH_UP_LATEST, max_catch_up=10, name=None):
+        if catch_up not in CATCH_UP_POLICIES:
+            raise InvalidSchedulerPolicy("Invalid catch up policy '%s'" % catch_up)
+        self.interval = interval
+        self.callback = callback
+        self.offset = offset
+        self.run_at_start = run_at_start
+        self.catch_up = catch_up
+        self.max_catch_up = max_catch_up
+        self.name = name or str(interval)
+        self.next_tick = None
+        self.cancelled = False
+        self.runs = 0
+        self.dropped = 0
+        self.last_lateness = 0.0
+        self.max_lateness = 0.0
+        self.total_lateness = 0.0
+        self.lateness = Histogram()
+
+    def tick_time(self, tick):
+        return tick * self.interval + self.offset
+
+    def cancel(self):
+        self.cancelled = True
+
+    def stats(self):
+        return {'interval': self.interval,
+                'runs': self.runs,
+                'dropped': self.dropped,
+                'last_lateness': self.last_lateness,
+                'max_lateness': self.max_lateness,
+                'mean_lateness': (self.total_lateness / self.runs
+                                  if self.runs else 0.0),
+                'lateness': self.lateness.stats()}
+
+class Scheduler(object):
+    def __init__(self, name='scheduler', dispatch=None, clock=None):
+        """
+        name is used for logging
+        dispatch, if given, is called with a list of (job, ts) tuples for
+        all the ticks that became due at the same time. By default each
+        job's callback is called in turn.
+        clock is the cchrc.common.clock to run on (default: the one in use)
+        """
+        self.name = name
+        self.clock = clock or get_clock()
+        self.log = logging.getLogger('cchrc.common.scheduler.Scheduler')
+        self.__dispatch = dispatch or self._run_callbacks
+        self.__heap = []
+        self.__seq = itertools.count()
+        self.__jobs = []
+        self.__lock = threading.Lock()
+        self.__stopped = False
+        self.__running = False
+        self.__wakeup = None
+        self.__offset = None
+        self.wakeups = 0
+
+    def add(self, interval, callback, **kwargs):
+        """
+        Adds a periodic job. Keyword arguments are passed on to Job.
+        Returns the Job.
+        """
+        job = Job(interval, callback, **kwargs)
+        with self.__lock:
+            self.__jobs.append(job)
+            if self.__running:
+                self.__arm(job, self.clock.time(), self.clock.monotonic())
+        self._wake()
+        return job
+
+    def jobs(self):
+        return list(self.__jobs)
+
+    def __arm(self, job, now_wall, now_mono):
+        if job.run_at_start:
+            job.next_tick = _tick_index(now_wall, job.interval, job.offset)
+            deadline = now_mono
+        else:
+            job.next_tick = _tick_index(now_wall, job.interval, job.offset) + 1
+            deadline = self.__deadline(job)
+        heapq.heappush(self.__heap, (deadline, next(self.__seq), job))
+
+    def __deadline(self, job):
+        """
+        The monotonic time of the job's next tick. Jobs due at the same
+        wall-clock time get exactly the same deadline, so they are
+        dispatched together.
+        """
+        return job.tick_time(job.next_tick) - self.__offset
+
+    def __check_clock(self, now_wall, now_mono):
+        """
+        Follows the wall clock: when the difference between the wall and
+        the monotonic clock drifts (NTP slewing) or jumps (a step), all
+        deadlines are recomputed. Ticks skipped by a forward step are
+        handled by the job's catch up policy; a backward step just delays
+        the next tick.
+        """
+        drift = (now_wall - now_mono) - self.__offset
+        if abs(drift) <= CLOCK_RESYNC:
+            return
+        if abs(drift) > CLOCK_STEP:
+            self.log.warning("%s: wall clock stepped by %.3f seconds",
+                             self.name, drift)
+        self.__offset = now_wall - now_mono
+        heap = [(self.__deadline(job), seq, job) for _, seq, job in self.__heap]
+        heapq.heapify(heap)
+        self.__heap = heap
+
+    def __fire(self, job, deadline, now_wall, now_mono):
+        """Works out which ticks to run for a due job, and re-arms it"""
+        cur_tick = _tick_index(now_wall, job.interval, job.offset)
+        lateness = now_mono - deadline
+        grace = min(job.interval, 1.0)
+        late_ticks = int(lateness // grace) if not job.run_at_start else 0
+        ticks, dropped = _due_ticks(job.next_tick, cur_tick, job.catch_up,
+                                    job.max_catch_up, late_ticks)
+        job.run_at_start = False
+        job.dropped += dropped
+        if dropped:
+            self.log.warning("%s: job '%s' missed %s tick(s)",
+                             self.name, job.name, dropped)
+        job.last_lateness = lateness
+        job.max_lateness = max(job.max_lateness, lateness)
+        job.total_lateness += lateness
+        job.lateness.record(lateness)
+        job.runs += len(ticks)
+        job.next_tick = max(cur_tick, job.next_tick) + 1
+        heapq.heappush(self.__heap,
+                       (self.__deadline(job), next(self.__seq), job))
+        return [(job, job.tick_time(t)) for t in ticks]
+
+    def _run_callbacks(self, fired):
+        for job, ts in fired:
+            try:
+                job.callback(ts)
+            except Exception:
+                self.log.exception("%s: job '%s' failed for tick %s",
+                                   self.name, job.name, ts)
+
+    def _wake(self):
+        with self.__lock:
+            if self.__wakeup is not None:
+                self.__wakeup.wake()
+
+    def __sleep(self, timeout):
+        self.wakeups += 1
+        self.__wakeup.wait(timeout)
+
+    def open(self):
+        """
+        Gets ready to run. run() does this, but a thread which is going to
+        call run() should do it before the thread is started, so a
+        simulated clock doesn't move on without this scheduler.
+        """
+        with self.__lock:
+            if self.__wakeup is None:
+                self.__wakeup = self.clock.sleeper()
+
+    def run(self):
+        """Runs jobs until stop() is called. Blocks the calling thread."""
+        self.open()
+        now_wall, now_mono = self.clock.time(), self.clock.monotonic()
+        with self.__lock:
+            self.__running = True
+            self.__offset = now_wall - now_mono
+            for job in self.__jobs:
+                self.__arm(job, now_wall, now_mono)
+        try:
+            while not self.__stopped:
+                now_wall, now_mono = self.clock.time(), self.clock.monotonic()
+                fired = []
+                with self.__lock:
+                    self.__check_clock(now_wall, now_mono)
+                    while self.__heap and self.__heap[0][0] <= now_mono:
+                        deadline, _, job = heapq.heappop(self.__heap)
+                        if job.cancelled:
+                            continue
+                        fired.extend(self.__fire(job, deadline, now_wall, now_mono))
+                    if self.__heap:
+                        timeout = min(self.__heap[0][0] - now_mono, MAX_SLEEP)
+                    else:
+                        timeout = MAX_SLEEP
+                if fired:
+                    with tracing.span(self.name, 'scheduler', fired=fired):
+                        self.__dispatch(fired)
+                    continue
+                self.__sleep(max(timeout, 0))
+        finally:
+            with self.__lock:
+                self.__running = False
+                self.__wakeup.close()
+                self.__wakeup = None
+
+    def stop(self):
+        self.__stopped = True
+        self._wake()
+
+    def stats(self):
+        return {'wakeups': self.wakeups,
+                'jobs': dict((j.name, j.stats()) for j in self.__jobs)}
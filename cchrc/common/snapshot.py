@@ -0,0 +1,89 @@
+"""
+The readings taken for one tick of the DataFileRunner.
+
+Every file due at the same second writes from the same TickSnapshot, so
+each sensor is read only once per tick, and files written at the same
+time agree on the values.
+"""
+import datetime
+import logging
+import threading
+
+import futures
+
+import cchrc
+
+class _Done(object):
+    """A read which has already finished, like cchrc.sensors.GroupRead"""
+    def __init__(self, future):
+        self.future = future
+
+    def wait(self):
+        pass
+
+    def readings(self):
+        return self.future.result()
+
+class TickSnapshot(object):
+    def __init__(self, ts, sensors):
+        """
+        ts is the epoch time of the tick
+        sensors is every sensor needed by the files due at this tick
+        """
+        self.ts = ts
+        self.timestamp = datetime.datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')
+        self.sensors = []
+        seen = set()
+        for s in sensors:
+            if s not in seen:
+                seen.add(s)
+                self.sensors.append(s)
+        self.log = logging.getLogger('cchrc.common.snapshot.TickSnapshot')
+        self.__groups = []
+        self.__readings = None
+        self.__lock = threading.Lock()
+
+    def acquire(self, executor, lane, max_wait=None):
+        """
+        Starts reading the sensors, in parallel, a group at a time (see
+        cchrc.sensors.group_sensors). No read is waited for longer than its
+        sensors' timeout, or max_wait seconds.
+        """
+        for group in cchrc.sensors.group_sensors(self.sensors):
+            self.__groups.append((group, cchrc.sensors.GroupRead(group, executor, lane,
+                                                                 max_wait)))
+
+    def read(self):
+        """Reads the sensors in the calling thread"""
+        for group in cchrc.sensors.group_sensors(self.sensors):
+            f = futures.Future()
+            try:
+                f.set_result(cchrc.sensors.read_group(group))
+            except Exception, ex:
+                f.set_exception(ex)
+            self.__groups.append((group, _Done(f)))
+
+    def wait(self):
+        """Waits for the readings started by acquire()"""
+        # Each caller waits for the reads itself, not just on the lock, so
+        # a simulated clock (see cchrc.common.clock) knows what it is doing
+        for group, read in self.__groups:
+            read.wait()
+        with self.__lock:
+            if self.__readings is not None:
+                return
+            readings = {}
+            for group, read in self.__groups:
+                try:
+                    readings.update(zip(group, read.readings()))
+                except Exception, ex:
+                    self.log.error("Error reading sensors %s for tick %s: '%s'",
+                                   ', '.join([s.name for s in group]),
+                                   self.timestamp, str(ex))
+                    readings.update([(s, None) for s in group])
+            self.__readings = readings
+
+    def readings(self, sensors):
+        """The readings of sensors, in order"""
+        self.wait()
+        return [self.__readings[s] for s in sensors]
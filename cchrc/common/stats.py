@@ -0,0 +1,165 @@
+"""
+Runtime statistics: latency histograms, and serving the stats() of the
+running components on SIGUSR1 and over a Unix domain socket.
+
+Each component keeps its own counters and histograms, and reports them
+from its stats() method; runtime_stats() puts them all together. Recording
+a value into a Histogram is a handful of arithmetic operations, so it can
+be done on every read and every row.
+"""
+import errno
+import json
+import logging
+import math
+import os
+import socket
+import threading
+import time
+
+# Bucket i of a Histogram counts values in [2 ** (i + MIN_EXPONENT - 1),
+# 2 ** (i + MIN_EXPONENT)), about 1us up to 17 minutes; values outside go in
+# the first or last bucket
+MIN_EXPONENT = -19
+NUM_BUCKETS = 30
+
+class Histogram(object):
+    """Counts, and the distribution in powers of two, of a latency in seconds"""
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.buckets = [0] * NUM_BUCKETS
+        self.__lock = threading.Lock()
+
+    def record(self, value):
+        i = math.frexp(value)[1] - MIN_EXPONENT if value > 0 else 0
+        if i < 0:
+            i = 0
+        elif i >= NUM_BUCKETS:
+            i = NUM_BUCKETS - 1
+        with self.__lock:
+            self.count += 1
+            self.total += value
+            self.buckets[i] += 1
+            if self.max is None or value > self.max:
+                self.max = value
+            if self.min is None or value < self.min:
+                self.min = value
+
+    def percentile(self, p):
+        """
+        The upper bound of the bucket holding the p'th percentile (0 to 100);
+        None if nothing has been recorded
+        """
+        wanted = self.count * p / 100.0
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= wanted:
+                return min(2.0 ** (i + MIN_EXPONENT), self.max)
+        return None
+
+    def stats(self):
+        with self.__lock:
+            buckets = dict([('%.6g' % 2.0 ** (i + MIN_EXPONENT), n)
+                            for i, n in enumerate(self.buckets) if n])
+            return {'count': self.count,
+                    'mean': self.total / self.count if self.count else None,
+                    'min': self.min, 'max': self.max,
+                    'p50': self.percentile(50), 'p90': self.percentile(90),
+                    'p99': self.percentile(99),
+                    'buckets': buckets}
+
+def merge(histograms):
+    """Puts the stats() of several Histograms together, as one Histogram"""
+    h = Histogram()
+    for s in histograms:
+        if not s['count']:
+            continue
+        h.count += s['count']
+        h.total += s['mean'] * s['count']
+        h.min = s['min'] if h.min is None else min(h.min, s['min'])
+        h.max = s['max'] if h.max is None else max(h.max, s['max'])
+        for bound, n in s['buckets'].items():
+            h.buckets[int(round(math.log(float(bound), 2))) - MIN_EXPONENT] += n
+    return h
+
+def runtime_stats(sensor_container, data_file_runner):
+    """The stats of the SensorContainer and the DataFileRunner, together"""
+    return {'time': time.time(),
+            'pid': os.getpid(),
+            'sensors': sensor_container.stats(),
+            'files': data_file_runner.stats()}
+
+def to_json(stats):
+    return json.dumps(stats, indent=1, sort_keys=True, default=str)
+
+def dump(stats, path):
+    """Writes stats, as JSON, to path"""
+    tmp_path = path + '.tmp'
+    f = open(tmp_path, 'wb')
+    try:
+        f.write(to_json(stats))
+    finally:
+        f.close()
+    os.rename(tmp_path, path)
+
+class StatsServer(threading.Thread):
+    """
+    Serves stats as JSON on a Unix domain socket: each client that connects
+    is sent the output of collect(), and the connection is closed, so
+    e.g. ``socat - UNIX-CONNECT:/var/run/cdc.sock`` prints them.
+    """
+    def __init__(self, path, collect):
+        threading.Thread.__init__(self, name='StatsServer')
+        self.daemon = True
+        self.path = path
+        self.collect = collect
+        self.log = logging.getLogger('cchrc.common.stats.StatsServer')
+        self.__stopped = False
+        try:
+            os.unlink(path)
+        except OSError, ex:
+            if ex.errno != errno.ENOENT:
+                raise
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        os.chmod(path, 0600)
+        self.sock.listen(5)
+
+    def run(self):
+        while not self.__stopped:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.error, ex:
+                if self.__stopped:
+                    break
+                if ex.args[0] == errno.EINTR:
+                    continue
+                raise
+            if self.__stopped:
+                conn.close()
+                break
+            try:
+                conn.sendall(to_json(self.collect()))
+            except Exception:
+                self.log.exception("Could not send stats")
+            finally:
+                conn.close()
+
+    def stop(self):
+        self.__stopped = True
+        # Wake up accept()
+        try:
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            s.connect(self.path)
+            s.close()
+        except socket.error:
+            pass
+        self.join()
+        self.sock.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
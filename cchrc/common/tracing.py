@@ -0,0 +1,190 @@
+"""
+Tracing of the collection loops, in the Chrome trace event format.
+
+The scheduler loops, the sensor reads, the averaging and the file writes
+are wrapped in spans:
+
+    with tracing.span('read', 'sensor', sensors=to_read):
+        ...
+
+When tracing is off (the default) span() returns a shared object which
+does nothing. When it is on, each thread appends its events to its own
+list, without a lock, and a background thread moves them to a JSON file
+every second, so writing the trace doesn't hold up the collection. The
+file is rotated when it gets too big; it (and any rotated file) can be
+loaded in chrome://tracing or https://ui.perfetto.dev.
+
+Times are wall-clock, so the spans line up with the timestamps of the
+rows they produced.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+# Events are moved to the file this often, in seconds
+FLUSH_INTERVAL = 1.0
+
+_tracer = None
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+class _Span(object):
+    __slots__ = ('tracer', 'name', 'cat', 'args', 'start')
+
+    def __init__(self, tracer, name, cat, args):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        end = time.time()
+        self.tracer.add((self.name, self.cat, self.start, end - self.start, self.args))
+        return False
+
+def span(name, cat, **args):
+    """
+    A context manager recording a span, of category cat, around its body.
+    args are shown with the span; objects with a name (sensors, jobs) are
+    shown by name.
+    """
+    tracer = _tracer
+    if tracer is None:
+        return _NULL_SPAN
+    return _Span(tracer, name, cat, args)
+
+def _render(o):
+    name = getattr(o, 'name', None)
+    return name if isinstance(name, basestring) else str(o)
+
+class Tracer(threading.Thread):
+    """Moves the events of every thread to a rotating trace file"""
+    def __init__(self, path, max_bytes=10 * 1024 * 1024, backups=5,
+                 flush_interval=FLUSH_INTERVAL):
+        threading.Thread.__init__(self, name='Tracer')
+        self.daemon = True
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self.log = logging.getLogger('cchrc.common.tracing.Tracer')
+        self.pid = os.getpid()
+        self.events = 0
+        self.rotations = 0
+        self.__local = threading.local()
+        # (thread, its event list) of every thread which traced something
+        self.__buffers = []
+        self.__lock = threading.Lock()
+        self.__stop = threading.Event()
+        self.__file = None
+        self.__size = 0
+        self.__named = set()
+
+    def add(self, event):
+        try:
+            events = self.__local.events
+        except AttributeError:
+            events = self.__local.events = []
+            with self.__lock:
+                self.__buffers.append((threading.current_thread(), events))
+        events.append(event)
+
+    def __open(self):
+        self.__file = open(self.path, 'wb')
+        self.__file.write('[\n')
+        self.__size = 2
+        self.__named = set()
+
+    def __close(self):
+        self.__file.write('\n]\n')
+        self.__file.close()
+        self.__file = None
+
+    def __rotate(self):
+        self.__close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists('%s.%s' % (self.path, i)):
+                os.rename('%s.%s' % (self.path, i), '%s.%s' % (self.path, i + 1))
+        if self.backups:
+            os.rename(self.path, self.path + '.1')
+        self.rotations += 1
+        self.__open()
+
+    def __write(self, event):
+        data = json.dumps(event, default=_render)
+        if self.__size > 2:
+            data = ',\n' + data
+        self.__file.write(data)
+        self.__size += len(data)
+
+    def flush(self):
+        """Writes out the events recorded so far"""
+        with self.__lock:
+            buffers = list(self.__buffers)
+        for thread, events in buffers:
+            # Other threads only ever append, so the first n are ours
+            n = len(events)
+            chunk = events[:n]
+            del events[:n]
+            if not thread.is_alive() and not events:
+                with self.__lock:
+                    self.__buffers.remove((thread, events))
+            if not chunk:
+                continue
+            if self.__size > self.max_bytes:
+                self.__rotate()
+            if thread.ident not in self.__named:
+                self.__named.add(thread.ident)
+                self.__write({'name': 'thread_name', 'ph': 'M', 'pid': self.pid,
+                              'tid': thread.ident, 'args': {'name': thread.name}})
+            for name, cat, ts, dur, args in chunk:
+                self.__write({'name': name, 'cat': cat, 'ph': 'X', 'pid': self.pid,
+                              'tid': thread.ident, 'ts': ts * 1e6, 'dur': dur * 1e6,
+                              'args': args})
+            self.events += n
+        self.__file.flush()
+
+    def run(self):
+        self.__open()
+        while not self.__stop.is_set():
+            self.__stop.wait(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                self.log.exception("Could not write to the trace file '%s'", self.path)
+        self.__close()
+
+    def stop(self):
+        self.__stop.set()
+        self.join()
+
+    def stats(self):
+        return {'events': self.events, 'rotations': self.rotations}
+
+def start(path, max_bytes=10 * 1024 * 1024, backups=5):
+    """Starts tracing to path"""
+    global _tracer
+    tracer = Tracer(path, max_bytes, backups)
+    tracer.start()
+    _tracer = tracer
+    return tracer
+
+def stop():
+    """Stops tracing, writing out the events recorded so far"""
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is not None:
+        tracer.stop()
@@ -0,0 +1,137 @@
+"""
+Buffered, group-committed writing of data file rows.
+"""
+import logging
+import os
+import threading
+
+from cchrc.common.exceptions import MalformedConfigFile
+from cchrc.common.clock import get_clock, monotonic
+
+# When to fsync() the file
+# none: never; leave it to the operating system
+# interval: after a flush, if the last fsync was at least fsync_interval ago
+# every-row: after every row (this also flushes every row)
+FSYNC_NONE = 'none'
+FSYNC_INTERVAL = 'interval'
+FSYNC_EVERY_ROW = 'every-row'
+FSYNC_POLICIES = (FSYNC_NONE, FSYNC_INTERVAL, FSYNC_EVERY_ROW)
+
+class BufferedFile(object):
+    """
+    A file opened for appending which keeps rows in memory, and writes
+    them out with one system call once flush_rows rows are waiting, or
+    the oldest waiting row is flush_interval seconds old. Each call to
+    write() is one row. The age of the oldest row is only checked when a
+    row is written, so the owner should call flush_waiting() every
+    flush_interval seconds too.
+    """
+    def __init__(self, path, flush_rows=1, flush_interval=0, fsync=FSYNC_NONE,
+                 fsync_interval=60):
+        if fsync not in FSYNC_POLICIES:
+            raise MalformedConfigFile("Invalid Fsync policy '%s' for '%s'" %
+                                      (fsync, path))
+        self.path = path
+        self.flush_rows = max(1, flush_rows)
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.log = logging.getLogger('cchrc.common.writer.BufferedFile')
+        self.__fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        self.__rows = []
+        self.__first_row_time = None
+        self.__last_fsync = get_clock().monotonic()
+        self.__lock = threading.Lock()
+        self.bytes_written = 0
+        self.rows_written = 0
+        self.flushes = 0
+        self.fsyncs = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self.total_flush_latency = 0.0
+
+    @property
+    def closed(self):
+        return self.__fd is None
+
+    def tell(self):
+        """The size of the file, including rows not yet flushed"""
+        with self.__lock:
+            return (os.fstat(self.__fd).st_size +
+                    sum([len(r) for r in self.__rows]))
+
+    def write(self, row):
+        with self.__lock:
+            self.__rows.append(row)
+            now = get_clock().monotonic()
+            if self.__first_row_time is None:
+                self.__first_row_time = now
+            if (self.fsync == FSYNC_EVERY_ROW or
+                len(self.__rows) >= self.flush_rows or
+                (self.flush_interval and
+                 now - self.__first_row_time >= self.flush_interval)):
+                self.__flush()
+
+    def flush(self, sync=False):
+        """Writes out waiting rows; fsync()s too if sync is True"""
+        with self.__lock:
+            self.__flush(sync)
+
+    def flush_waiting(self):
+        """Writes out waiting rows, if there are any"""
+        with self.__lock:
+            if self.__rows:
+                self.__flush()
+
+    def __flush(self, sync=False):
+        """The caller must hold the lock"""
+        if self.__fd is None:
+            return
+        start = monotonic()
+        if self.__rows:
+            data = ''.join(self.__rows)
+            while data:
+                written = os.write(self.__fd, data)
+                data = data[written:]
+                self.bytes_written += written
+            self.rows_written += len(self.__rows)
+            self.__rows = []
+            self.__first_row_time = None
+            self.flushes += 1
+        now = get_clock().monotonic()
+        if (sync or self.fsync == FSYNC_EVERY_ROW or
+            (self.fsync == FSYNC_INTERVAL and
+             now - self.__last_fsync >= self.fsync_interval)):
+            os.fsync(self.__fd)
+            self.__last_fsync = now
+            self.fsyncs += 1
+        latency = monotonic() - start
+        self.last_flush_latency = latency
+        self.max_flush_latency = max(self.max_flush_latency, latency)
+        self.total_flush_latency += latency
+
+    def close(self):
+        """Flushes waiting rows and closes the file"""
+        with self.__lock:
+            if self.__fd is None:
+                return
+            self.__flush(sync=self.fsync != FSYNC_NONE)
+            os.close(self.__fd)
+            self.__fd = None
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception: # pragma: no cover
+            pass
+
+    def stats(self):
+        return {'bytes_written': self.bytes_written,
+                'rows_written': self.rows_written,
+                'rows_waiting': len(self.__rows),
+                'flushes': self.flushes,
+                'fsyncs': self.fsyncs,
+                'last_flush_latency': self.last_flush_latency,
+                'max_flush_latency': self.max_flush_latency,
+                'mean_flush_latency': (self.total_flush_latency / self.flushes
+                                       if self.flushes else 0.0)}
@@ -1,8 +1,11 @@
-from collections import defaultdict, deque
+from collections import defaultdict, deque, namedtuple
+from fractions import gcd
+import functools
 import logging
 import math
 import threading
-import time
+
+import futures
 
 import cchrc.common.mod
 
@@ -15,48 +18,469 @@ def list_all():
 def get(name):
     return cchrc.common.mod.get(__name__, name)
 
+# The aggregates of an AveragingSensor, besides the average
+AGGREGATE_MODES = ('MIN', 'MAX', 'STDDEV', 'MEDIAN', 'COUNT', 'LAST')
+
+TIMEOUT_NONE = 'none'
+TIMEOUT_STALE = 'stale'
+ON_TIMEOUT_POLICIES = (TIMEOUT_NONE, TIMEOUT_STALE)
+
+_INF = float('inf')
+_NAN = float('nan')
+# sum, count, min, max, M2, last, readings
+_EMPTY_BUCKET = (0.0, 0, _INF, -_INF, 0.0, 0.0, ())
+
+def _median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.0
+
+def _bucket(reading):
+    """The bucket of one reading; a missing reading gives an empty bucket"""
+    try:
+        v = float(reading)
+    except (TypeError, ValueError):
+        return _EMPTY_BUCKET
+    if v != v: # NaN
+        return _EMPTY_BUCKET
+    return (v, 1, v, v, 0.0, v, (v,))
+
 def _my_sum(values):
     # Yes, I know I could do this in-line, but it is more
     # easily testable this way.
     return sum([x for x in values if (x is not None and not math.isnan(x))])
 
-import futures
+def group_sensors(sensors):
+    """
+    Splits sensors into lists which can each be read with a single call
+    to get_readings(): one list for each sensor type and group_key(), and a
+    list of one for every sensor without a group key.
+    """
+    groups = defaultdict(list)
+    singles = []
+    for s in sensors:
+        key = s.group_key()
+        if key is None:
+            singles.append([s])
+        else:
+            groups[(type(s), key)].append(s)
+    return groups.values() + singles
+
+# A sensor's value, and the epoch time it was read at
+Reading = namedtuple('Reading', 'value time')
+
+def read_group(sensors, max_age=None):
+    """
+    Reads a list of sensors returned by group_sensors(), and returns their
+    values. See SensorBase.read() for max_age.
+    """
+    return [r.value for r in read_group_readings(sensors, max_age)]
+
+def read_group_readings(sensors, max_age=None):
+    """
+    Reads a list of sensors returned by group_sensors(), and returns their
+    Readings. Only the sensors without a fresh enough reading, and not
+    already being read by another thread, are read; the rest share the
+    other thread's read.
+    """
+    now = get_clock().time()
+    readings, waiting, mine = {}, [], []
+    for s in sensors:
+        reading, flight = s._start_read(now, max_age)
+        if reading is not None:
+            readings[s] = reading
+        elif flight is not None:
+            waiting.append((s, flight))
+        else:
+            mine.append(s)
+    if mine:
+        readings.update(_read_now(mine, now))
+    for s, flight in waiting:
+        readings[s] = get_clock().result(flight)
+    return [readings[s] for s in sensors]
+
+def _read_now(sensors, now):
+    """
+    Reads sensors whose reads were started by _start_read(). Sensors whose
+    circuit is open aren't read, and give None.
+    """
+    clock = get_clock()
+    mono = clock.monotonic()
+    to_read = [s for s in sensors if s.breaker is None or s.breaker.allow(mono)]
+    readings = {}
+    for s in sensors:
+        if s not in to_read:
+            readings[s] = Reading(None, now)
+            s._finish_read(readings[s], cache=False)
+    if not to_read:
+        return readings
+    start = clock.monotonic()
+    try:
+        with tracing.span('read', 'sensor', sensors=to_read):
+            values = type(to_read[0]).get_readings(to_read)
+    except Exception, ex:
+        for s in to_read:
+            if s.breaker is not None:
+                s.breaker.failure()
+            s._finish_read(error=ex)
+        raise
+    for s, value in zip(to_read, values):
+        if value is not None:
+            s.last_good_reading = value
+        if s.breaker is not None:
+            if value is None:
+                s.breaker.failure()
+            else:
+                s.breaker.success()
+        readings[s] = Reading(value, now)
+        s._finish_read(readings[s])
+    took = clock.monotonic() - start
+    for s in to_read:
+        s.read_time.record(took)
+    return readings
+
+BREAKER_CLOSED = 'closed'
+BREAKER_OPEN = 'open'
+BREAKER_HALF_OPEN = 'half_open'
+
+class CircuitBreaker(object):
+    """
+    Tracks the failed reads (None, or an error) of a sensor. After
+    threshold failures in a row the circuit opens, and the sensor isn't
+    read at all until backoff seconds have passed. Then one read is let
+    through (half open): if it works the circuit closes, otherwise it opens
+    again for twice as long, up to max_backoff seconds. Only the circuit
+    opening and closing are logged.
+    """
+    def __init__(self, name, threshold=3, backoff=5.0, max_backoff=300.0):
+        self.name = name
+        self.threshold = threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.state = BREAKER_CLOSED
+        self.failures = 0 # in a row
+        self.total_failures = 0
+        self.skipped = 0
+        self.opened = 0
+        self.log = logging.getLogger('cchrc.sensors.CircuitBreaker')
+        self.__wait = backoff
+        self.__retry_at = None
+        self.__lock = threading.Lock()
+
+    def allow(self, now=None):
+        """Whether the sensor may be read now"""
+        with self.__lock:
+            if self.state == BREAKER_CLOSED:
+                return True
+            if self.state == BREAKER_OPEN and (now or get_clock().monotonic()) >= self.__retry_at:
+                self.state = BREAKER_HALF_OPEN
+                return True
+            self.skipped += 1
+            return False
+
+    def success(self):
+        with self.__lock:
+            if self.state != BREAKER_CLOSED:
+                self.log.warning("Sensor '%s' is working again after %d failed reads",
+                                 self.name, self.failures)
+            self.state = BREAKER_CLOSED
+            self.failures = 0
+            self.__wait = self.backoff
+
+    def failure(self):
+        with self.__lock:
+            self.failures += 1
+            self.total_failures += 1
+            if self.state == BREAKER_HALF_OPEN:
+                self.__wait = min(self.__wait * 2, self.max_backoff)
+            elif self.state == BREAKER_CLOSED and self.failures >= self.threshold:
+                self.log.error("Sensor '%s' failed %d reads in a row; trying it "
+                               "again less often until it works", self.name,
+                               self.failures)
+                self.opened += 1
+            else:
+                return
+            self.state = BREAKER_OPEN
+            self.__retry_at = get_clock().monotonic() + self.__wait
 
+    def stats(self):
+        with self.__lock:
+            retry_in = None
+            if self.state == BREAKER_OPEN:
+                retry_in = max(0.0, self.__retry_at - get_clock().monotonic())
+            return {'state': self.state, 'failures': self.failures,
+                    'total_failures': self.total_failures, 'skipped': self.skipped,
+                    'opened': self.opened, 'retry_in': retry_in}
+
+def breaker_stats(sensors):
+    """The state of the circuit breaker of each of sensors which has one"""
+    return dict([(s.name, s.breaker.stats()) for s in sensors
+                 if s.breaker is not None])
+
+class StaleReading(float):
+    """
+    The last good reading of a sensor, standing in for a read which did
+    not finish in time (see SensorBase.on_timeout). It is written like any
+    other reading, so it is logged when it is made, and counted by the
+    sensor (stale_readings) and by each data file it is written to.
+    """
+    stale = True
+
+def timeout_stats(sensors):
+    """
+    How many reads of sensors took too long (timeouts), how many weren't
+    started because the last one was still running (still_reading), and
+    how many times the last good reading stood in for them (stale), by
+    sensor type and by sensor
+    """
+    by_type = defaultdict(lambda: {'timeouts': 0, 'still_reading': 0, 'stale': 0})
+    by_sensor = {}
+    for s in sensors:
+        by_type[s.sensor_type]['timeouts'] += s.timeouts
+        by_type[s.sensor_type]['still_reading'] += s.still_reading
+        by_type[s.sensor_type]['stale'] += s.stale_readings
+        if s.timeouts or s.still_reading:
+            by_sensor[s.name] = {'timeouts': s.timeouts,
+                                 'still_reading': s.still_reading,
+                                 'stale': s.stale_readings}
+    return {'types': dict(by_type), 'sensors': by_sensor}
+
+class GroupRead(object):
+    """
+    A read of a list of sensors returned by group_sensors(), on an
+    executor, with a deadline. Sensors already being read share that read
+    (see SensorBase.read()), and the rest are read together. Whatever
+    hasn't finished by the deadline is not waited for, its result is
+    thrown away when it does, and readings() returns what the sensors'
+    on_timeout asks for instead. A sensor whose read has run past its own
+    deadline is not read again until it finishes, so a hung sensor holds on
+    to one worker thread at most.
+    """
+    def __init__(self, sensors, executor, lane, max_wait=None):
+        """
+        The read may take as long as the longest timeout of sensors, but
+        no more than max_wait seconds
+        """
+        self.sensors = sensors
+        self.log = logging.getLogger('cchrc.sensors.GroupRead')
+        self.timeout = max([s.timeout for s in sensors])
+        if max_wait is not None:
+            self.timeout = min(self.timeout, max_wait)
+        self.clock = get_clock()
+        now, mono = self.clock.time(), self.clock.monotonic()
+        self.deadline = mono + self.timeout
+        # The sensors' Readings, or the futures they will come from
+        self.__readings = {}
+        self.__flights = {}
+        mine = []
+        for s in sensors:
+            reading, flight = s._start_read(now, deadline=self.deadline)
+            if reading is not None:
+                self.__readings[s] = reading
+            elif flight is None:
+                mine.append(s)
+            elif flight.deadline is not None and flight.deadline <= mono:
+                s.still_reading += 1
+            else:
+                self.__flights[s] = flight
+        # The read of the sensors no one else was reading
+        self.future = None
+        if mine:
+            try:
+                self.future = executor.submit(lane, _read_now, mine, now)
+            except Exception, ex:
+                for s in mine:
+                    s._finish_read(error=ex)
+                raise
+
+    def __remaining(self):
+        return max(0.0, self.deadline - self.clock.monotonic())
+
+    def __waited(self):
+        """The futures to wait for, and the sensors read by each"""
+        waited = [(f, [s]) for s, f in self.__flights.items()]
+        if self.future is not None:
+            waited.append((self.future, [s for s in self.sensors
+                                         if s not in self.__readings
+                                         and s not in self.__flights]))
+        return waited
+
+    def wait(self):
+        """Waits for the read until the deadline, leaving its result for readings()"""
+        for future, sensors in self.__waited():
+            try:
+                self.clock.result(future, self.__remaining())
+            except Exception:
+                pass
+
+    def readings(self):
+        """
+        Waits for the readings until the deadline. Errors from the read
+        are raised.
+        """
+        readings = dict(self.__readings)
+        late = []
+        for future, sensors in self.__waited():
+            try:
+                result = self.clock.result(future, self.__remaining())
+            except futures.TimeoutError:
+                late.extend(sensors)
+                continue
+            if future is self.future:
+                readings.update(result)
+            else:
+                readings[sensors[0]] = result
+        if late:
+            for s in late:
+                s.timeouts += 1
+            self.log.warning("Reading %s took more than %.1f seconds",
+                             ', '.join([s.name for s in late]), self.timeout)
+        values, stale = [], []
+        for s in self.sensors:
+            if s in readings:
+                values.append(readings[s].value)
+                continue
+            values.append(s.timed_out_reading())
+            if values[-1] is not None:
+                stale.append(s.name)
+        if stale:
+            self.log.warning("Recording the last good reading of %s, marked stale",
+                             ', '.join(stale))
+        return values
+
+def lead_time(sensors):
+    """The longest lead time of sensors"""
+    return max([s.lead_time for s in sensors] + [0])
+
+def prepare_group(sensors):
+    """Prepares a list of sensors returned by group_sensors() to be read"""
+    try:
+        type(sensors[0]).prepare(sensors)
+    except Exception, ex:
+        logging.getLogger('cchrc.sensors').error(
+            "Error preparing sensors %s: '%s'",
+            ', '.join([s.name for s in sensors]), str(ex))
+
+def prepare_sensors(sensors, executor, lane):
+    """Starts preparing the sensors which have a lead time, a group at a time"""
+    for group in group_sensors(set([s for s in sensors if s.lead_time])):
+        executor.submit(lane, prepare_group, group)
+
+def read_sensors(sensors):
+    """
+    Reads all sensors, a group at a time, and returns the readings in the
+    same order as sensors.
+    """
+    readings = {}
+    for group in group_sensors(sensors):
+        readings.update(zip(group, read_group(group)))
+    return [readings[s] for s in sensors]
+
+from cchrc.common.executor import CollectionExecutor
+from cchrc.common import tracing
+from cchrc.common.stats import Histogram
+from cchrc.common.clock import get_clock
+from cchrc.common.scheduler import (Scheduler, CATCH_UP_LATEST,
+                                    CATCH_UP_SKIP, CATCH_UP_POLICIES)
 from cchrc.common.exceptions import (InvalidObject, SensorAlreadyDefined,
-                                     NotAnAveragingSensor, SensorNotDefined)
+                                     NotAnAveragingSensor, SensorNotDefined,
+                                     InvalidSchedulerPolicy, InvalidSensorMode)
 
 class SensorContainer(threading.Thread):
-    def __init__(self):
-        self.__end_thread = False
+    def __init__(self, catch_up=CATCH_UP_LATEST, workers=8):
+        """
+        catch_up is the scheduler's policy for missed ticks
+        workers is the most threads collecting any one sampling interval
+        """
         self.__sensors = {}
         self.__sbsi = defaultdict(list) # sensors by sampling interval
-        self.__silr = defaultdict(int) # sampling interval k was run at v seconds
-        self.__start_time = None
+        self.__roots = {} # root averaging sensor by sensor
+        if catch_up not in CATCH_UP_POLICIES:
+            raise InvalidSchedulerPolicy("Invalid catch up policy '%s'" % catch_up)
+        self.__catch_up = catch_up
+        self.__scheduler = Scheduler('SensorContainer')
+        self.__tick_durations = defaultdict(Histogram)
+        self.__executor = CollectionExecutor('SensorContainer', workers)
         self.log = logging.getLogger('cchrc.common.SensorContainer')
-        threading.Thread.__init__(self)
+        threading.Thread.__init__(self, name='SensorContainer')
 
     def run(self):
-        self.__start_time = int(time.time())
-        while True:
-            if self.__end_thread:
-                return # pragma: no cover
-            elapsed_time = int(time.time()) - self.__start_time
-            for st in self.__sbsi:
-                if ((elapsed_time % st == 0) or
-                    ((elapsed_time - self.__silr[st]) > st)):
-                    self.log.debug("Running '%s second' averaging sensors; "
-                                   "last run %s seconds ago",
-                                   st, elapsed_time - self.__silr[st])
-                    self.__silr[st] = elapsed_time
-                    with futures.ThreadPoolExecutor(len(self.__sbsi[st])) as executor:
-                        for sensor in self.__sbsi[st]:
-			    executor.submit(sensor.collect_reading)
-            # Sleep to the top of the next second
-            cur_time = time.time()
-            time.sleep(math.ceil(cur_time) - cur_time)
+        for st in self.__sbsi:
+            self.__scheduler.add(st, functools.partial(self.__run_interval, st),
+                                 run_at_start=True, catch_up=self.__catch_up,
+                                 name='%s second averaging' % st)
+            lead = lead_time([root.sensor for root in self.__sbsi[st]])
+            if 0 < lead < st:
+                # A prepare that is late is no use, so it is skipped
+                self.__scheduler.add(st, functools.partial(self.__prepare, st),
+                                     offset=st - lead, catch_up=CATCH_UP_SKIP,
+                                     name='%s second prepare' % st)
+        sensors = [s for k, s in self.__sensors.items() if not k[2]]
+        intervals = [s.rescan_interval for s in sensors if s.rescan_interval]
+        if intervals:
+            # Half way between the ticks of the shortest sampling time, so
+            # rescans don't land on reads
+            offset = min(self.__sbsi.keys() or [min(intervals)]) / 2.0
+            self.__scheduler.add(min(intervals),
+                                 functools.partial(self.__rescan, sensors),
+                                 offset=offset, catch_up=CATCH_UP_SKIP,
+                                 name='rescan')
+        self.__scheduler.run()
+        self.__executor.shutdown(wait=False)
+
+    def __rescan(self, sensors, ts):
+        by_type = defaultdict(list)
+        for s in sensors:
+            if s.rescan_interval:
+                by_type[type(s)].append(s)
+        for klass, of_type in by_type.items():
+            try:
+                klass.rescan(of_type)
+            except Exception:
+                self.log.exception("Error rescanning '%s' sensors", klass.sensor_type)
+
+    def __prepare(self, st, ts):
+        prepare_sensors([root.sensor for root in self.__sbsi[st]], self.__executor,
+                        '%s-prepare' % st)
+
+    def __run_interval(self, st, ts):
+        self.log.debug("Running '%s second' averaging sensors for tick %s",
+                       st, ts)
+        roots = dict([(root.sensor, root) for root in self.__sbsi[st]])
+        for group in group_sensors(roots.keys()):
+            # A read may not run into the next tick
+            read = GroupRead(group, self.__executor, st, max_wait=st)
+            self.__executor.submit('%s-wait' % st, self.__collect_group, st, ts, read,
+                                   [roots[s] for s in group])
+
+    def __collect_group(self, st, ts, read, roots):
+        with tracing.span('collect', 'sensor', sensors=[root.sensor for root in roots]):
+            for reading, root in zip(read.readings(), roots):
+                root.add_reading(reading, ts)
+        self.__tick_durations[st].record(get_clock().time() - ts)
+
+    def queue_depths(self):
+        return self.__executor.queue_depths()
+
+    def stats(self):
+        return {'scheduler': self.__scheduler.stats(),
+                'executor': self.__executor.stats(),
+                'timeouts': timeout_stats([s for k, s in self.__sensors.items()
+                                           if not k[2]]),
+                'breakers': breaker_stats([s for k, s in self.__sensors.items()
+                                           if not k[2]]),
+                'read_time': dict([('%s.%s' % k[:2], s.read_time.stats())
+                                   for k, s in self.__sensors.items()
+                                   if not k[2] and s.read_time.count]),
+                # From the tick to the readings being averaged, by interval
+                'tick_duration': dict([(str(st), h.stats())
+                                       for st, h in self.__tick_durations.items()])}
 
     def start_averaging_sensors(self):
         self.log.info('Starting')
+        self.__scheduler.open()
         self.start()
 
     def put(self, sobject, group, interval=None):
@@ -74,7 +498,41 @@ class SensorContainer(threading.Thread):
         self.log.info("Adding %s, %s with interval %s" % (group, name, interval))
         self.__sensors[(group, name, interval)] = sobject
         if interval:
-            self.__sbsi[interval/sobject.num_samples].append(sobject)
+            sobject.period = max(1, interval/sobject.num_samples)
+            self.__build_tree(sobject.sensor)
+
+    def __build_tree(self, sensor):
+        """
+        Arranges all the averaging sensors of one sensor into a tree, so
+        the sensor is only read at the finest period any of them needs
+        (the root), and every coarser average is built from the buckets
+        of the finest average whose period divides its own.
+        """
+        nodes = sorted([s for k, s in self.__sensors.items()
+                        if k[2] and s.sensor is sensor],
+                       key=lambda s: s.period)
+        base = reduce(gcd, [n.period for n in nodes])
+        if sensor in self.__roots:
+            old_root = self.__roots[sensor]
+            self.__sbsi[old_root.period].remove(old_root)
+            if not self.__sbsi[old_root.period]:
+                del self.__sbsi[old_root.period]
+        if nodes[0].period == base:
+            root = nodes.pop(0)
+        else:
+            # Nobody averages at the base period, so the root only
+            # passes readings on.
+            root = AveragingSensor(sensor, 1)
+            root.period = base
+        root.children = []
+        placed = [root]
+        for node in nodes:
+            node.children = []
+            parent = [p for p in placed if node.period % p.period == 0][-1]
+            parent.adopt(node)
+            placed.append(node)
+        self.__roots[sensor] = root
+        self.__sbsi[base].append(root)
 
     def get(self, group, name, interval=None):
         try:
@@ -90,7 +548,7 @@ class SensorContainer(threading.Thread):
 
     def stop_averaging_sensors(self):
         self.log.info('Stopping')
-        self.__end_thread = True
+        self.__scheduler.stop()
 
 
 class SensorBase(object):
@@ -104,15 +562,74 @@ class SensorBase(object):
     """
     sensor_type = 'base'
     _display_name = None
+    # Arguments every sensor type takes
+    common_kwargs = ['timeout', 'on_timeout', 'ttl', 'lead_time']
+    # A reading is reused by read() for up to this many seconds. Sensor
+    # types can change it, and each sensor can with its ttl argument.
+    ttl = 0.0
+    # Sensors which take a while to convert a value (e.g. a OneWire
+    # temperature) have prepare() called this many seconds before each tick
+    # at which they are read, so the read only fetches the value. Sensor
+    # types set it, and each sensor can with its lead_time argument.
+    lead_time = 0.0
+    # Sensor types whose devices can come and go while CDC runs have
+    # rescan() called this often
+    rescan_interval = 0
+    # The most seconds a read may take. Sensor types can change it, and
+    # each sensor can with its timeout argument.
+    timeout = 10.0
+    # What a read which took too long gives: none (None), or stale (the
+    # last good reading, as a StaleReading)
+    on_timeout = TIMEOUT_NONE
+    # Whether failed reads open a circuit breaker (see CircuitBreaker).
+    # Sensor types can change the breaker's settings here.
+    use_circuit_breaker = True
+    breaker_threshold = 3
+    breaker_backoff = 5.0
+    breaker_max_backoff = 300.0
+
     def __init__(self, name, sensor_id=None, **kwargs):
         if self.__class__ is SensorBase:
             raise NotImplementedError
 
         for key in kwargs.keys():
-            if key not in self.valid_kwargs:
+            if key not in self.valid_kwargs and key not in self.common_kwargs:
                 raise InvalidSensorArg("Arg '%s' is invalid for sensor type '%s'"
                                        % (key, type(self)))
         self.__name = name
+        if 'timeout' in kwargs:
+            try:
+                self.timeout = float(kwargs['timeout'])
+            except ValueError:
+                raise InvalidSensorArg("Invalid timeout '%s' for sensor '%s'"
+                                       % (kwargs['timeout'], name))
+        if 'on_timeout' in kwargs:
+            if kwargs['on_timeout'].lower() not in ON_TIMEOUT_POLICIES:
+                raise InvalidSensorArg("Invalid on_timeout '%s' for sensor '%s'"
+                                       % (kwargs['on_timeout'], name))
+            self.on_timeout = kwargs['on_timeout'].lower()
+        for key in ('ttl', 'lead_time'):
+            if key in kwargs:
+                try:
+                    setattr(self, key, float(kwargs[key]))
+                except ValueError:
+                    raise InvalidSensorArg("Invalid %s '%s' for sensor '%s'"
+                                           % (key, kwargs[key], name))
+        # The last Reading taken by read()
+        self.cached_reading = None
+        self.__flight = None
+        self.__flight_lock = threading.Lock()
+        self.last_good_reading = None
+        # How long reads take (of the sensor's whole group)
+        self.read_time = Histogram()
+        self.timeouts = 0
+        self.still_reading = 0
+        self.stale_readings = 0
+        self.breaker = None
+        if self.use_circuit_breaker:
+            self.breaker = CircuitBreaker(name, self.breaker_threshold,
+                                          self.breaker_backoff,
+                                          self.breaker_max_backoff)
 
     @property
     def name(self):
@@ -122,6 +639,88 @@ class SensorBase(object):
     def name(self, name):
         self.__name = name
 
+    def group_key(self):
+        """
+        Sensors of the same type which return the same key (e.g. all the
+        sensors on one bus) are read together with get_readings().
+        None means the sensor is always read on its own.
+        """
+        return None
+
+    @classmethod
+    def get_readings(klass, sensors):
+        """
+        Reads several sensors of this type at once, and returns their
+        readings in the same order. Sensor types which can read a whole
+        bus faster than one sensor at a time override this.
+        """
+        return [s.get_reading() for s in sensors]
+
+    @classmethod
+    def prepare(klass, sensors):
+        """
+        Starts whatever a group of sensors of this type (see
+        group_sensors()) needs done before they can be read, e.g. a
+        conversion, without waiting for it. Called lead_time seconds before
+        a tick; sensor types with a lead time override this.
+        """
+        pass
+
+    @classmethod
+    def rescan(klass, sensors):
+        """
+        Starts looking, in the background, for the devices of sensors of
+        this type which came or went, every rescan_interval seconds.
+        """
+        pass
+
+    def read(self, max_age=None):
+        """
+        Reads the sensor, and returns a Reading. A reading no older than
+        max_age seconds (default: the sensor's ttl) is reused, and a caller
+        which asks while the sensor is being read waits for that read
+        instead of starting another.
+        """
+        return read_group_readings([self], max_age)[0]
+
+    def _start_read(self, now, max_age=None, deadline=None):
+        """
+        Returns (reading, None) if there is a reading fresh enough to use,
+        or (None, future) if the sensor is already being read; the future's
+        deadline is the monotonic time its reader stops waiting for it, or
+        None. Otherwise returns (None, None), and the caller must read the
+        sensor, by deadline, and call _finish_read().
+        """
+        if max_age is None:
+            max_age = self.ttl
+        with self.__flight_lock:
+            cached = self.cached_reading
+            if cached is not None and now - cached.time < max_age:
+                return cached, None
+            if self.__flight is not None:
+                return None, self.__flight
+            self.__flight = futures.Future()
+            self.__flight.deadline = deadline
+            return None, None
+
+    def _finish_read(self, reading=None, error=None, cache=True):
+        """Hands the reading, or error, to everyone waiting for it"""
+        with self.__flight_lock:
+            flight, self.__flight = self.__flight, None
+            if error is None and cache:
+                self.cached_reading = reading
+        if error is not None:
+            flight.set_exception(error)
+        else:
+            flight.set_result(reading)
+
+    def timed_out_reading(self):
+        """What to record when a read didn't finish in time"""
+        if self.on_timeout == TIMEOUT_STALE and self.last_good_reading is not None:
+            self.stale_readings += 1
+            return StaleReading(self.last_good_reading)
+        return None
+
     def get_reading(self): # pragma: no cover
         """
         Sensor-type-specifc read method
@@ -148,32 +747,260 @@ class AveragingSensor(SensorBase):
     """
     A "sensor" that will record readings when instructed, and return
     an average when asked for its reading.
+
+    Readings are gathered into buckets of one sampling period, and the
+    last num_samples buckets are kept in a ring buffer. Each bucket holds
+    the sum, count, minimum, maximum, sum of squared differences from the
+    mean (as in Welford's method) and last of its readings, and the
+    readings themselves if a median is wanted. Missing readings (None,
+    NaN, or anything that isn't a number) are not counted.
+
+    A window of fewer than running_sum_from buckets is gone over when it
+    is read, so adding a reading to it is only an append, of the reading
+    itself (a bucket is made of it when it is read). A bigger window keeps
+    a running sum and count, updated as each bucket is added, so
+    get_reading() doesn't have to look at the buffer at all.
+
+    The other aggregates (MIN, MAX, STDDEV, MEDIAN, COUNT and LAST) are
+    read through views (see view()), which all share this sensor's buffer.
+    They are computed together, in one pass over the buffer; a big window
+    keeps them until the next bucket is added.
+
+    The averaging sensors of one sensor form a tree (see
+    SensorContainer.put()). Only the root reads the sensor, with one
+    reading per bucket. Every bucket a node closes is passed on to its
+    children, which close their own buckets on their period boundaries.
     """
+    # Windows of at least this many buckets keep a running sum. Below it,
+    # the locking and bookkeeping cost more than going over the window
+    # when it is read (see benchmarks/averaging.py).
+    running_sum_from = 64
+    # The running sum is recomputed from the buffer after this many
+    # trips around it, so floating point error can't build up.
+    resum_every = 64
+    # Having no readings yet isn't a failure
+    use_circuit_breaker = False
 
     def __init__(self, sensor, num_samples=12):
         """
         sensor is a Sensor object
-        time_period is in seconds
-        samples is the number of samples to take in time_period.
+        num_samples is the number of buckets averaged.
         """
         SensorBase.__init__(self, sensor.name)
         self.sensor = sensor
         self.num_samples = num_samples
-        self.readings = deque([], num_samples)
         self.display_name = sensor.name + '_avg'
         self.log = logging.getLogger('cchrc.sensors.AveragingSensor')
+        self.period = None
+        self.children = []
+        self.keep_values = False
+        self.__views = {}
+        self.__parts_per_bucket = 1
+        # The closed buckets, oldest first, except that a small window
+        # keeps the readings given to add_reading() (the root of a tree,
+        # which is given no buckets) as floats, NaN if missing
+        self.__buckets = deque([], num_samples)
+        self.__readings = deque([], num_samples)
+        self.__running = num_samples >= self.running_sum_from
+        self.__sum = 0.0
+        self.__count = 0
+        self.__version = 0
+        self.__summary = None
+        self.__summary_version = -1
+        self.__pending_parts = 0
+        self.__clear_pending()
+        self.__until_resum = num_samples * self.resum_every
+        self.__lock = threading.Lock()
+
+    def adopt(self, child):
+        """Feed child with the buckets of this sensor"""
+        self.children.append(child)
+        child.__parts_per_bucket = child.period // self.period
+
+    def view(self, mode):
+        """
+        A sensor whose reading is the aggregate mode (one of
+        AGGREGATE_MODES) of this sensor's buffer. There is one view per mode.
+        """
+        if mode not in AGGREGATE_MODES:
+            raise InvalidSensorMode("Invalid aggregate mode '%s'" % mode)
+        with self.__lock:
+            if mode not in self.__views:
+                if mode == 'MEDIAN':
+                    self.keep_values = True
+                self.__views[mode] = AggregateView(self, mode)
+            return self.__views[mode]
 
     def get_reading(self):
         """
-        Return current average
+        Return current average of the valid readings, or None if there
+        aren't any
         """
-        if not self.readings:
+        if self.__running:
+            with self.__lock:
+                total, count = self.__sum, self.__count
+        elif self.__readings:
+            # list() copies the deque in one step, without a lock
+            valid = [v for v in list(self.__readings) if v == v] # not NaN
+            total, count = sum(valid), len(valid)
+        else:
+            buckets = list(self.__buckets)
+            total = sum([b[0] for b in buckets])
+            count = sum([b[1] for b in buckets])
+        if not count:
             return None
+        return total / count
+
+    def aggregate(self, mode):
+        """The aggregate mode of the valid readings; None if there aren't any"""
+        if not self.__running:
+            return self.__summarize()[mode]
+        with self.__lock:
+            if self.__summary_version != self.__version:
+                self.__summary = self.__summarize()
+                self.__summary_version = self.__version
+            return self.__summary[mode]
+
+    def add_reading(self, reading, ts=None):
+        """Adds a reading of the sensor, taken at the tick at time ts"""
+        if not self.__running:
+            try:
+                v = float(reading)
+            except (TypeError, ValueError):
+                v = _NAN
+            # deque.append() is atomic, so this needs no lock
+            self.__readings.append(v)
+            if not self.children:
+                return
+        bucket = _bucket(reading)
+        if self.__running:
+            with self.__lock:
+                self.__push(bucket)
+        for child in self.children:
+            child.add_partial(bucket, ts)
+
+    def add_partial(self, bucket, ts=None):
+        """
+        Adds a finer bucket, which ended at time ts.
+        The bucket is closed when ts is on a boundary of this sensor's
+        period, or, without a ts, when enough finer buckets were added.
+        """
+        with self.__lock:
+            self.__add_pending(bucket)
+            self.__pending_parts += 1
+            if ts is not None:
+                if ts % self.period:
+                    return
+            elif self.__pending_parts < self.__parts_per_bucket:
+                return
+            bucket = (self.__pending_sum, self.__pending_count, self.__pending_min,
+                      self.__pending_max, self.__pending_m2, self.__pending_last,
+                      tuple(self.__pending_values))
+            self.__clear_pending()
+            self.__pending_parts = 0
+            self.__push(bucket)
+        for child in self.children:
+            child.add_partial(bucket, ts)
 
-        readings = list(self.readings)
-        return _my_sum(readings)/float(len(readings))
+    def __clear_pending(self):
+        self.__pending_sum = 0.0
+        self.__pending_count = 0
+        self.__pending_min = _INF
+        self.__pending_max = -_INF
+        self.__pending_m2 = 0.0
+        self.__pending_last = 0.0
+        self.__pending_values = []
+
+    def __add_pending(self, bucket):
+        """
+        Merges a finer bucket into the one being built, combining the
+        squared differences as Chan et al. do. The caller must hold the lock.
+        """
+        total, count, lo, hi, m2, last, values = bucket
+        if not count:
+            return
+        n = self.__pending_count
+        if n:
+            delta = total / count - self.__pending_sum / n
+            self.__pending_m2 += m2 + delta * delta * n * count / (n + count)
+        else:
+            self.__pending_m2 = m2
+        self.__pending_sum += total
+        self.__pending_count = n + count
+        if lo < self.__pending_min:
+            self.__pending_min = lo
+        if hi > self.__pending_max:
+            self.__pending_max = hi
+        self.__pending_last = last
+        self.__pending_values.extend(values)
+
+    def __push(self, bucket):
+        """Adds a closed bucket. The caller must hold the lock."""
+        buckets = self.__buckets
+        if not self.__running:
+            buckets.append(bucket)
+            return
+        if len(buckets) == self.num_samples:
+            dropped = buckets[0]
+        else:
+            dropped = _EMPTY_BUCKET
+        buckets.append(bucket)
+        self.__sum += bucket[0] - dropped[0]
+        self.__count += bucket[1] - dropped[1]
+        self.__version += 1
+        self.__until_resum -= 1
+        if not self.__until_resum:
+            self.__sum = math.fsum([b[0] for b in buckets])
+            self.__until_resum = self.num_samples * self.resum_every
+
+    def __summarize(self):
+        """
+        Computes every aggregate in one pass over the buffer, oldest
+        bucket first. The caller must hold the lock if the window keeps a
+        running sum.
+        """
+        n, mean, m2 = 0, 0.0, 0.0
+        lo, hi, last = _INF, -_INF, None
+        values = []
+        buckets = [_bucket(v) for v in list(self.__readings)] + list(self.__buckets)
+        for b_sum, count, b_min, b_max, b_m2, b_last, b_values in buckets:
+            if not count:
+                continue
+            total = n + count
+            delta = b_sum / count - mean
+            mean += delta * count / total
+            m2 += b_m2 + delta * delta * n * count / total
+            n = total
+            lo = min(lo, b_min)
+            hi = max(hi, b_max)
+            last = b_last
+            if self.keep_values:
+                values.extend(b_values)
+        if not n:
+            return {'MIN': None, 'MAX': None, 'STDDEV': None, 'MEDIAN': None,
+                    'COUNT': 0, 'LAST': None}
+        return {'MIN': lo, 'MAX': hi,
+                'STDDEV': math.sqrt(max(m2, 0.0) / (n - 1)) if n > 1 else None,
+                'MEDIAN': _median(values) if values else None,
+                'COUNT': n, 'LAST': last}
 
     def collect_reading(self):
         self.log.debug("Getting reading for sensor '%s'" % self.sensor.name)
-        self.readings.append(self.sensor.get_reading())
+        self.add_reading(self.sensor.read().value)
 
+class AggregateView(SensorBase):
+    """
+    A sensor reading one aggregate (MIN, MAX, ...) of an AveragingSensor.
+    Get them with AveragingSensor.view().
+    """
+    valid_kwargs = []
+    use_circuit_breaker = False
+
+    def __init__(self, source, mode):
+        SensorBase.__init__(self, source.sensor.name)
+        self.source = source
+        self.mode = mode
+        self.display_name = '%s_%s' % (source.sensor.name, mode.lower())
+
+    def get_reading(self):
+        return self.source.aggregate(self.mode)
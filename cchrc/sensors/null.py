@@ -10,6 +10,8 @@ class Sensor(cchrc.sensors.SensorBase):
     """
     sensor_type = 'null'
     valid_kwargs = ['value']
+    # None is what it reads, not a failure
+    use_circuit_breaker = False
 
     def __init__(self, name, sensor_id=None, **kwargs):
         cchrc.sensors.SensorBase.__init__(self, name, **kwargs)
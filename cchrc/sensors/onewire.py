@@ -1,15 +1,15 @@
 # OW Sensor
+from collections import deque
+import json
 import logging
 import os
 import threading
-import time
 
 import ow
 
 import cchrc
-
-class OwfsConnectionAlreadyInitialized(Exception):
-    pass
+from cchrc.common.clock import get_clock
+from cchrc.common.executor import CollectionExecutor
 
 class OwfsIdAlreadyConverted(Exception):
     pass
@@ -26,11 +26,225 @@ def _normalize_owfs_id(sensor_id):
         return ''.join([sensor_id[-2:], '.'] +
                        [sensor_id[x*2:x*2+2] for x in xrange(6,0,-1)])
 
+_worker = None
+_worker_lock = threading.Lock()
+
+def bus_worker():
+    """The executor which does the I/O of every bus, one thread (lane) per bus"""
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            _worker = CollectionExecutor('OneWire', 1)
+        return _worker
+
+class Bus(object):
+    """
+    One OneWire adapter, i.e. one connection= value. Each bus has its own
+    devices, and its own worker thread which does all of its I/O, so buses
+    are read in parallel and a slow bus never holds up another.
+
+    Walking a large network of hubs to find its devices is slow, so the
+    paths found can be kept in a cache file (see load_cache()). Devices are
+    then looked up in the cache first, and the bus is only walked for a
+    device which isn't in it, or isn't where the cache says any more.
+
+    While CDC runs, the bus is walked again now and then in the background
+    (see rescan()), so sensors whose devices were plugged in late are
+    attached, and those whose devices went away are detached.
+    """
+    def __init__(self, connection, index):
+        self.connection = connection
+        # Buses are numbered in the order they were opened, as owfs does
+        self.index = index
+        self.root = '/'
+        # Device paths by id
+        self.devices = {}
+        self.members = []
+        # The time of the last conversion started by Sensor.prepare(), and
+        # for how many seconds after that reads use it instead of converting
+        self.prepared = 0
+        self.prepared_for = 0
+        self.cache_path = None
+        self.scanned = False
+        self.scans = 0
+        self.cache_hits = 0
+        self.rescans = 0
+        self.log = logging.getLogger('cchrc.sensors.onewire.Bus')
+        self.__to_walk = None
+        self.__found = None
+        self.__lock = threading.Lock()
+
+    def load_cache(self, path):
+        """
+        Uses the device cache file at path, a JSON object of connection ->
+        device id -> path which may be shared by several buses
+        """
+        self.cache_path = path
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return
+        try:
+            cached = json.load(f).get(self.connection, {})
+        except (ValueError, AttributeError), ex:
+            self.log.error("Ignoring unreadable OneWire device cache '%s': '%s'",
+                           path, str(ex))
+            return
+        finally:
+            f.close()
+        for sensor_id, device_path in cached.items():
+            self.devices.setdefault(str(sensor_id), str(device_path))
+
+    def save_cache(self):
+        if self.cache_path is None:
+            return
+        cached = {}
+        try:
+            f = open(self.cache_path, 'rb')
+            try:
+                cached = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            pass
+        if not isinstance(cached, dict):
+            cached = {}
+        cached[self.connection] = self.devices
+        tmp_path = self.cache_path + '.tmp'
+        try:
+            f = open(tmp_path, 'wb')
+            try:
+                json.dump(cached, f, indent=1, sort_keys=True)
+            finally:
+                f.close()
+            os.rename(tmp_path, self.cache_path)
+        except (IOError, OSError), ex:
+            self.log.error("Could not save OneWire device cache '%s': '%s'",
+                           self.cache_path, str(ex))
+
+    def find(self, sensor_id):
+        """
+        The ow.Sensor of device sensor_id: where the cache says it is, if
+        it is still there, otherwise wherever walking the bus finds it
+        """
+        if sensor_id in self.devices:
+            try:
+                device = ow.Sensor(self.devices[sensor_id])
+                self.cache_hits += 1
+                return device
+            except ow.exUnknownSensor:
+                pass
+        if not self.scanned:
+            self.scan()
+        if sensor_id not in self.devices:
+            return None
+        return ow.Sensor(self.devices[sensor_id])
+
+    def rescan(self):
+        """
+        Starts walking the bus in the background, and returns at once. The
+        walk is done on the bus's worker a directory at a time, and only one
+        directory is queued at once, so a read never waits behind more than
+        one directory listing.
+        """
+        with self.__lock:
+            if self.__to_walk is not None:
+                return
+            self.__to_walk = deque([self.root])
+            self.__found = {}
+        bus_worker().submit(self.connection, self.__walk_next)
+
+    def __walk_next(self):
+        done = True
+        try:
+            path = self.__to_walk.popleft()
+            try:
+                children = ow.Sensor(path).sensors()
+            except Exception, ex:
+                # e.g. a hub which went away in the middle of the walk
+                self.log.debug("Could not list '%s' on '%s': '%s'", path,
+                               self.connection, str(ex))
+                children = []
+            for c in children:
+                self.__found[os.path.basename(c._path)] = c._path
+                self.__to_walk.append(c._path)
+            if self.__to_walk:
+                bus_worker().submit(self.connection, self.__walk_next)
+                done = False
+            else:
+                self.__rescanned(self.__found)
+        except Exception:
+            self.log.exception("Rescan of '%s' failed", self.connection)
+        finally:
+            # Whether it finished or failed, the next rescan() starts afresh
+            if done:
+                with self.__lock:
+                    self.__to_walk = self.__found = None
+
+    def __rescanned(self, found):
+        """Attaches and detaches sensors after a rescan found the devices found"""
+        added = [i for i in found if self.devices.get(i) != found[i]]
+        removed = [i for i in self.devices if i not in found]
+        self.devices = found
+        self.scanned = True
+        self.rescans += 1
+        for s in self.members:
+            if s.sensor_id not in found:
+                if s.sensor is not None:
+                    s.detach()
+            elif s.sensor is None or s.sensor_id in added:
+                # A sensor which can't be attached now is tried again by
+                # the next rescan
+                try:
+                    s.attach(ow.Sensor(found[s.sensor_id]))
+                except Exception, ex:
+                    self.log.error("Could not attach OW sensor '%s' on '%s': '%s'",
+                                   s.original_sensor_id, self.connection, str(ex))
+        if added or removed:
+            self.log.info("Rescan of '%s' found %d new or moved and %d missing devices",
+                          self.connection, len(added), len(removed))
+            self.save_cache()
+
+    def reopened(self, root):
+        """Notes that owfs was restarted, and the bus is now at root"""
+        self.root = root
+        self.scanned = False
+
+    def run(self, fn, *args):
+        """Runs fn(*args) on the bus's worker, and returns its result"""
+        return get_clock().result(bus_worker().submit(self.connection, fn, *args))
+
+    def scan(self):
+        """Finds the devices on the bus, and saves them to the cache"""
+        start = get_clock().monotonic()
+        self.devices = {}
+        Sensor._get_all(ow.Sensor(self.root), self.devices)
+        self.scanned = True
+        self.scans += 1
+        self.log.info("Found %d devices on '%s' in %.1f seconds",
+                      len(self.devices), self.connection,
+                      get_clock().monotonic() - start)
+        self.save_cache()
+
+    def convert_all(self):
+        """
+        Start a temperature conversion on every device on the bus at
+        once, instead of one conversion (~750ms on a DS18B20) per device.
+        """
+        ow.owfs_put(self.root.rstrip('/') + '/simultaneous/temperature', '1')
+
 class Sensor(cchrc.sensors.SensorBase):
     sensor_type = 'ow'
-    initialized_connection_type = None
-    sensors = {}
-    valid_kwargs = ['connection', 'sa', 'use_cache']
+    # The open buses, by connection
+    buses = {}
+    valid_kwargs = ['connection', 'sa', 'use_cache', 'device_cache', 'rescan']
+    # A bus read takes long enough that readings are worth sharing between
+    # the averaging and file loops
+    ttl = 2.0
+    # Long enough for a simultaneous conversion of DS18B20s at 12 bits
+    lead_time = 1.0
+    # Buses are walked for devices which came or went this often
+    rescan_interval = 300.0
 
     @classmethod
     def _get_all(klass, sensor, sensors):
@@ -38,18 +252,85 @@ class Sensor(cchrc.sensors.SensorBase):
             sensors[os.path.basename(s._path)] = s._path
             klass._get_all(s, sensors)
 
+    @classmethod
+    def prepare(klass, sensors):
+        """Starts the simultaneous conversion ahead of the tick"""
+        if not any([s.sensor_attribute == 'temperature' for s in sensors]):
+            return
+        bus = sensors[0].bus
+        bus.run(klass._prepare_bus, bus, cchrc.sensors.lead_time(sensors))
+
+    @classmethod
+    def rescan(klass, sensors):
+        """Starts a background rescan of the buses of sensors"""
+        for bus in set([s.bus for s in sensors]):
+            bus.rescan()
+
+    @classmethod
+    def _prepare_bus(klass, bus, lead):
+        bus.convert_all()
+        bus.prepared = get_clock().time()
+        # Until a second after the tick, so every group read at the tick
+        # uses it
+        bus.prepared_for = lead + 1
+
+    @classmethod
+    def get_readings(klass, sensors):
+        """
+        Reads a group of sensors on the same bus: one simultaneous
+        conversion for the whole bus, then the latched value of each device.
+        If prepare() started the conversion for this tick, the values are
+        just fetched.
+        """
+        sensors[0].bus.run(klass._read_bus, sensors)
+        return [s.last_sample_value for s in sensors]
+
+    @classmethod
+    def _read_bus(klass, sensors):
+        bus = sensors[0].bus
+        latched = False
+        if any([s.sensor_attribute == 'temperature' for s in sensors]):
+            if get_clock().time() - bus.prepared <= bus.prepared_for:
+                latched = True
+            else:
+                try:
+                    bus.convert_all()
+                    latched = True
+                except Exception, ex:
+                    sensors[0].log.error("Simultaneous conversion failed; "
+                                         "reading sensors one at a time: '%s'"
+                                         % str(ex))
+        for s in sensors:
+            s._read(latched)
+
     @classmethod
     def _initialize_ow(klass, connection_type):
-        ow.init(connection_type)
-        klass.initialized_connection_type = connection_type
-        klass._get_all(ow.Sensor('/'), klass.sensors)
+        """
+        Opens the bus for connection_type, if it isn't open yet, and returns
+        it. owfs opens all of its adapters at once, so it is restarted with
+        every connection; with more than one, bus N's devices are under
+        /bus.N.
+        """
+        if connection_type in klass.buses:
+            return klass.buses[connection_type]
+        log = logging.getLogger('cchrc.sensors.onewire.Sensor')
+        bus = Bus(connection_type, len(klass.buses))
+        buses = sorted(klass.buses.values() + [bus], key=lambda b: b.index)
+        if ow.initialized and klass.buses:
+            log.info("Reopening OneWire connections to add '%s'", connection_type)
+            ow.finish()
+        ow.init(' '.join([b.connection for b in buses]))
+        klass.buses[connection_type] = bus
+        for b in buses:
+            b.reopened('/' if len(buses) == 1 else '/bus.%d' % b.index)
+            for s in b.members:
+                s._open_device()
+        return bus
 
     def __init__(self, name, sensor_id, **kwargs):
         cchrc.sensors.SensorBase.__init__(self, name, **kwargs)
         self.sensor = None
-        self.last_sample_time = 0
         self.last_sample_value = None
-        self.lock = threading.Lock()
         self.log = logging.getLogger('cchrc.sensors.onewire.Sensor')
 
         self.original_sensor_id = sensor_id
@@ -69,37 +350,91 @@ class Sensor(cchrc.sensors.SensorBase):
         # 'trim', 'trimblanket', 'trimvalid', 'type']
         self.sensor_attribute = kwargs.get('sa', 'temperature')
 
-        use_cache = cchrc.common.is_true(kwargs.get('use_cache', 'False'))
+        self.use_cache = cchrc.common.is_true(kwargs.get('use_cache', 'False'))
+        if 'rescan' in kwargs:
+            try:
+                self.rescan_interval = float(kwargs['rescan'])
+            except ValueError:
+                raise cchrc.sensors.InvalidSensorArg("Invalid rescan '%s' for sensor '%s'"
+                                                     % (kwargs['rescan'], name))
 
-        if not ow.initialized:
-            self.log.debug("Initializing OW connection")
-            self._initialize_ow(connection_type)
-        elif (ow.initialized and
-              (Sensor.initialized_connection_type != connection_type)):
-            raise OwfsConnectionAlreadyInitialized("OneWire Connection already initialized to '%s' "
-                                                   "but an attempt was made to initalize to '%s'" %
-                                                   (Sensor.initialized_connection_type, connection_type))
+        self.log.debug("Initializing OW connection")
+        self.bus = self._initialize_ow(connection_type)
+        if 'device_cache' in kwargs and self.bus.cache_path is None:
+            self.bus.load_cache(kwargs['device_cache'])
 
-        # TODO: This can generage a KeyError. Need to catch it
         self.log.info("Initializing OW sensor '%s'" % self.original_sensor_id)
-        self.sensor = ow.Sensor(self.sensors[self.sensor_id])
-        self.sensor.useCache(use_cache)
+        self.latched_attribute = self.sensor_attribute
+        self._open_device()
+        self.bus.members.append(self)
+        self.connection_type = connection_type
 
-    def get_reading(self):
-        self.lock.acquire()
-        self.log.debug("Getting reading for '%s'" % self.sensor_id)
-        if (time.time() - self.last_sample_time) > 2:
-            try:
-                self.last_sample_value = float(getattr(self.sensor, self.sensor_attribute))
-            except ow.exUnknownSensor, ex:
-                self.log.critical("Error getting reading from sensor '%s': '%s'" %
-                                  (self.original_sensor_id, str(ex)))
-                self.last_sample_value = None
-            except Exception, ex:
-                self.log.critical("Unhandlded exception getting reading from sensor '%s': '%s'" %
-                                  self.original_sensor_id, str(ex))
+    def _open_device(self):
+        device = self.bus.find(self.sensor_id)
+        if device is None:
+            self.log.warning("OW sensor '%s' is not on '%s'; it will be read once "
+                             "it is found there", self.original_sensor_id,
+                             self.bus.connection)
+            self.detach()
+        else:
+            self.attach(device)
 
-            self.last_sample_time = time.time()
+    def attach(self, device):
+        """
+        Reads the sensor from the ow.Sensor device. If this raises, the
+        sensor is left as it was.
+        """
+        device.useCache(self.use_cache)
+        # After a simultaneous conversion, 'latesttemp' returns the result
+        # without starting another conversion. Older owfs versions don't
+        # have it, but will use a recent simultaneous conversion anyway.
+        latched_attribute = self.sensor_attribute
+        if (self.sensor_attribute == 'temperature' and
+            'latesttemp' in device.entryList()):
+            latched_attribute = 'latesttemp'
+        if self.sensor is None and self.bus.rescans:
+            self.log.warning("OW sensor '%s' has been found on '%s'",
+                             self.original_sensor_id, self.bus.connection)
+        self.sensor = device
+        self.latched_attribute = latched_attribute
 
-        self.lock.release()
+    def detach(self):
+        """Stops reading the sensor, whose device has gone; it reads None"""
+        if self.sensor is not None:
+            self.log.warning("OW sensor '%s' has gone from '%s'",
+                             self.original_sensor_id, self.bus.connection)
+        self.sensor = None
+
+    def group_key(self):
+        return self.connection_type
+
+    def _read(self, latched=False):
+        """Reads the sensor. Must run on the bus's worker"""
+        self.log.debug("Getting reading for '%s'" % self.sensor_id)
+        if self.sensor is None:
+            self.last_sample_value = None
+            return
+        if latched:
+            attribute = self.latched_attribute
+        else:
+            attribute = self.sensor_attribute
+        # Only the first of a run of failures is logged; the circuit
+        # breaker logs the sensor going away and coming back
+        if self.breaker is None or not self.breaker.failures:
+            log = self.log.critical
+        else:
+            log = self.log.debug
+        try:
+            self.last_sample_value = float(getattr(self.sensor, attribute))
+        except ow.exUnknownSensor, ex:
+            log("Error getting reading from sensor '%s': '%s'" %
+                (self.original_sensor_id, str(ex)))
+            self.last_sample_value = None
+        except Exception, ex:
+            log("Unhandlded exception getting reading from sensor '%s': '%s'" %
+                (self.original_sensor_id, str(ex)))
+            self.last_sample_value = None
+
+    def get_reading(self):
+        self.bus.run(self._read)
         return self.last_sample_value
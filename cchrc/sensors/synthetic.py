@@ -0,0 +1,91 @@
+# Synthetic Sensor
+import math
+import random
+
+import cchrc
+from cchrc.common.clock import get_clock
+
+# How long a read takes: exactly latency, uniform between 0 and twice it,
+# exponential with a mean of latency, or lognormal with a median of latency
+# (a long tail of slow reads)
+DISTRIBUTIONS = ('constant', 'uniform', 'exponential', 'lognormal')
+# What a read gives: value, value plus or minus up to amplitude at random,
+# a sine wave of amplitude around value, or value plus amplitude per read
+GENERATORS = ('constant', 'random', 'sine', 'counter')
+
+class Sensor(cchrc.sensors.SensorBase):
+    """
+    A "sensor" which makes up its readings, taking as long to read and
+    failing as often as it is configured to. Sensors with the same bus are
+    read together, one after another, like the sensors on a onewire bus.
+    Used to benchmark CDC with many sensors (see benchmarks/scale.py).
+    """
+    sensor_type = 'synthetic'
+    valid_kwargs = ['latency', 'distribution', 'failure_rate', 'generator',
+                    'value', 'amplitude', 'period', 'bus', 'seed']
+
+    def __init__(self, name, sensor_id=None, **kwargs):
+        cchrc.sensors.SensorBase.__init__(self, name, **kwargs)
+        self.sensor_id = sensor_id
+        self.latency = self.__float(kwargs, 'latency', 0.0)
+        self.failure_rate = self.__float(kwargs, 'failure_rate', 0.0)
+        self.value = self.__float(kwargs, 'value', 0.0)
+        self.amplitude = self.__float(kwargs, 'amplitude', 1.0)
+        self.period = self.__float(kwargs, 'period', 3600.0)
+        self.distribution = self.__choice(kwargs, 'distribution', DISTRIBUTIONS)
+        self.generator = self.__choice(kwargs, 'generator', GENERATORS)
+        if self.latency < 0 or not 0 <= self.failure_rate <= 1 or self.period <= 0:
+            raise cchrc.sensors.InvalidSensorArg(
+                "Invalid latency, failure_rate or period for sensor '%s'" % name)
+        self.bus = kwargs.get('bus')
+        self.random = random.Random(kwargs.get('seed', name))
+        self.reads = 0
+        self.failures = 0
+
+    def __float(self, kwargs, key, default):
+        try:
+            return float(kwargs.get(key, default))
+        except ValueError:
+            raise cchrc.sensors.InvalidSensorArg("Invalid %s '%s' for sensor '%s'"
+                                                 % (key, kwargs[key], self.name))
+
+    def __choice(self, kwargs, key, choices):
+        value = kwargs.get(key, choices[0]).lower()
+        if value not in choices:
+            raise cchrc.sensors.InvalidSensorArg("Invalid %s '%s' for sensor '%s'"
+                                                 % (key, kwargs[key], self.name))
+        return value
+
+    def group_key(self):
+        return self.bus
+
+    def delay(self):
+        """How long the next read will take"""
+        if not self.latency or self.distribution == 'constant':
+            return self.latency
+        elif self.distribution == 'uniform':
+            return self.random.uniform(0, 2 * self.latency)
+        elif self.distribution == 'exponential':
+            return self.random.expovariate(1 / self.latency)
+        else:
+            return self.latency * self.random.lognormvariate(0, 1)
+
+    def generate(self):
+        if self.generator == 'random':
+            return self.value + self.random.uniform(-self.amplitude, self.amplitude)
+        elif self.generator == 'sine':
+            return self.value + self.amplitude * math.sin(2 * math.pi * get_clock().time()
+                                                          / self.period)
+        elif self.generator == 'counter':
+            return self.value + self.reads * self.amplitude
+        return self.value
+
+    def get_reading(self):
+        delay = self.delay()
+        if delay > 0:
+            get_clock().sleep(delay)
+        self.reads += 1
+        if self.failure_rate and self.random.random() < self.failure_rate:
+            self.failures += 1
+            return None
+        return self.generate()
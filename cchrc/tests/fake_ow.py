@@ -0,0 +1,147 @@
+"""
+A stand-in for the owfs 'ow' module, so the OneWire sensor can be tested
+without an adapter, and without owfs' --tester device.
+
+Devices are kept in a dict of path -> attributes.  A device on a hub
+branch has a path like /1F.000000000001/main/28.000000000001.
+
+Several adapters can be opened at once, as with owfs, by passing init()
+their connections separated by spaces. Each device then belongs to the
+adapter named by its bus attribute, and is also found under /bus.N, N
+being the adapter's place in init(). The module counts bus activity, so
+tests can check how much work a read did:
+
+conversions: temperature conversions (one per 'temperature' read, or one
+             per write to a simultaneous/temperature)
+bus_conversions: conversions by connection, for simultaneous conversions
+reads: attribute reads from devices
+
+Opening, listing and reading the devices of a connection in delays sleeps
+that long, as bus traffic would (None is the delay of devices on no bus).
+"""
+import re
+import time
+
+initialized = False
+connection = None
+connections = []
+devices = {}
+buses = {}
+delays = {}
+conversions = 0
+bus_conversions = {}
+reads = 0
+
+class exUnknownSensor(Exception):
+    pass
+
+def reset(device_attributes=None):
+    """Forget all devices and counters, and add device_attributes"""
+    global initialized, connection, connections, devices, buses, delays
+    global conversions, bus_conversions, reads
+    initialized = False
+    connection = None
+    connections = []
+    devices = {}
+    buses = {}
+    delays = {}
+    conversions = 0
+    bus_conversions = {}
+    reads = 0
+    for path, attributes in (device_attributes or {}).items():
+        add_device(path, **attributes)
+
+def add_device(path, bus=None, **attributes):
+    a = {'temperature': 20.0, 'type': 'DS18B20'}
+    a.update(attributes)
+    a['latesttemp'] = a['temperature']
+    devices[path] = a
+    buses[path] = bus
+
+def remove_device(path):
+    del devices[path]
+
+def init(iface):
+    global initialized, connection, connections
+    initialized = True
+    connection = iface
+    connections = iface.split()
+
+def finish():
+    global initialized
+    initialized = False
+
+def _split_bus(path):
+    """Splits /bus.N/rest into (connection, /rest); (None, path) without a bus"""
+    m = re.match(r'^/bus\.(\d+)(/.*)?$', path)
+    if not m:
+        return None, path
+    return connections[int(m.group(1))], m.group(2) or '/'
+
+def _parent(path):
+    parent = path.rsplit('/', 1)[0] or '/'
+    if parent.endswith('/main') or parent.endswith('/aux'):
+        parent = parent.rsplit('/', 1)[0]
+    return parent
+
+def owfs_get(path):
+    device, attribute = path.rsplit('/', 1)
+    return getattr(Sensor(device), attribute)
+
+def owfs_put(path, value):
+    global conversions
+    bus, path = _split_bus(path)
+    if path == '/simultaneous/temperature':
+        conversions += 1
+        bus_conversions[bus] = bus_conversions.get(bus, 0) + 1
+        for p, a in devices.items():
+            if bus is None or buses[p] == bus:
+                a['latesttemp'] = a['temperature']
+    else:
+        device, attribute = path.rsplit('/', 1)
+        devices[device][attribute] = value
+
+class Sensor(object):
+    def __init__(self, path):
+        bus, device = _split_bus(path)
+        if device != '/' and device not in devices:
+            raise exUnknownSensor(path)
+        self._path = path
+        self._bus = bus
+        self._device = device
+        self._use_cache = True
+        if device != '/':
+            # owfs reads the device's type
+            time.sleep(delays.get(buses[device], 0))
+
+    @property
+    def id(self):
+        return self._path.rsplit('/', 1)[1].split('.')[1]
+
+    def useCache(self, use_cache):
+        self._use_cache = use_cache
+
+    def entryList(self):
+        return sorted(devices[self._device].keys()) + ['id']
+
+    def sensors(self):
+        prefix = self._path[:-len(self._device)] if self._device != '/' else self._path
+        prefix = prefix.rstrip('/')
+        time.sleep(delays.get(self._bus, 0))
+        return [Sensor(prefix + p) for p in sorted(devices)
+                if _parent(p) == self._device and
+                (self._bus is None or buses[p] == self._bus)]
+
+    def __getattr__(self, name):
+        global conversions, reads
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if self._device not in devices:
+            raise exUnknownSensor(self._path)
+        if name not in devices[self._device]:
+            raise AttributeError(name)
+        time.sleep(delays.get(buses[self._device], 0))
+        reads += 1
+        if name == 'temperature':
+            conversions += 1
+        return devices[self._device][name]
@@ -1,4 +1,5 @@
 import csv
+import json
 import os
 import shutil
 import tempfile
@@ -10,18 +11,22 @@ import configobj
 import ow
 from cchrc.sensors.onewire import Sensor as OWSensor
 from cchrc.sensors.null import Sensor as NullSensor
+from cchrc.sensors.synthetic import Sensor as SyntheticSensor
 
 import cchrc
+import cchrc.common.profiler
+from cchrc.common.clock import SimulatedClock, set_clock
 from cchrc.common.exceptions import *
 
 from common import get_file, MyTestSensor
+import fake_ow
 
 class TestSensorBase(unittest.TestCase):
     """Tests the base sensor and its functions"""
 
     def test_list_sensor_types(self):
         """Ensure sensors.list_all() is returning what it should"""
-        self.assertEqual(cchrc.sensors.list_all(), ['null','onewire'])
+        self.assertEqual(cchrc.sensors.list_all(), ['null','onewire','synthetic'])
 
     def test_base_attributes(self):
         """Ensure SensorBase has all needed attributes"""
@@ -77,6 +82,136 @@ class TestAveragingSensor(unittest.TestCase):
         value = avs.get_reading()
         self.assertEqual(int(value), 10)
 
+    def test_averaging_skips_missing_readings(self):
+        """Ensure None, NaN and non-numbers are left out of the average"""
+        avs = cchrc.sensors.AveragingSensor(MyTestSensor('', ''), 5)
+        for r in [1, None, 2, float('nan'), 'N/A']:
+            avs.add_reading(r)
+        self.assertEqual(avs.get_reading(), 1.5)
+
+    def test_averaging_only_missing_readings(self):
+        """Ensure an average of only missing readings is None"""
+        avs = cchrc.sensors.AveragingSensor(MyTestSensor('', ''), 3)
+        for r in [1, None, None, None]:
+            avs.add_reading(r)
+        self.assertEqual(avs.get_reading(), None)
+
+    def test_averaging_window(self):
+        """Ensure only the last num_samples readings are averaged"""
+        avs = cchrc.sensors.AveragingSensor(MyTestSensor('', ''), 3)
+        for r in [100, None, 1, 2, 3]:
+            avs.add_reading(r)
+        self.assertEqual(avs.get_reading(), 2)
+
+    def test_averaging_resum(self):
+        """Ensure the running sum stays exact over many readings"""
+        n = cchrc.sensors.AveragingSensor.running_sum_from
+        avs = cchrc.sensors.AveragingSensor(MyTestSensor('', ''), n)
+        avs.add_reading(1e16)
+        for r in [0.1] * (n * avs.resum_every + n):
+            avs.add_reading(r)
+        self.assertAlmostEqual(avs.get_reading(), 0.1, 12)
+
+    def test_running_sum_window(self):
+        """Ensure a window with a running sum averages and aggregates like a small one"""
+        n = cchrc.sensors.AveragingSensor.running_sum_from
+        small = cchrc.sensors.AveragingSensor(MyTestSensor('', ''), n - 1)
+        running = cchrc.sensors.AveragingSensor(MyTestSensor('', ''), n)
+        results = []
+        for avs in (small, running):
+            views = [avs.view(m) for m in cchrc.sensors.AGGREGATE_MODES]
+            for r in [1000, None, 1000] + [float(x % 7) for x in range(n - 2)]:
+                avs.add_reading(r)
+            results.append([avs.get_reading()] + [v.get_reading() for v in views])
+        self.assertEqual(results[0], results[1])
+
+    def test_aggregates(self):
+        """Ensure the aggregate views of the last num_samples readings are correct"""
+        avs = cchrc.sensors.AveragingSensor(MyTestSensor('', ''), 5)
+        views = [avs.view(m) for m in cchrc.sensors.AGGREGATE_MODES]
+        for r in [100, 4, None, 2, 9, 1]:
+            avs.add_reading(r)
+        self.assertEqual([v.get_reading() for v in views[:2] + views[3:]],
+                         [1, 9, 3, 4, 1])
+        self.assertAlmostEqual(views[2].get_reading(), (38 / 3.0) ** 0.5, 12)
+
+    def test_aggregates_of_nothing(self):
+        """Ensure aggregates of only missing readings are None, and the count 0"""
+        avs = cchrc.sensors.AveragingSensor(MyTestSensor('', ''), 3)
+        avs.add_reading(None)
+        self.assertEqual([avs.aggregate(m) for m in cchrc.sensors.AGGREGATE_MODES],
+                         [None, None, None, None, 0, None])
+
+    def test_one_view_per_mode(self):
+        """Ensure each mode has one view, and an invalid mode raises an error"""
+        avs = cchrc.sensors.AveragingSensor(MyTestSensor('T1', ''))
+        self.assertTrue(avs.view('MAX') is avs.view('MAX'))
+        self.assertEqual(avs.view('MAX').display_name, 'T1_max')
+        self.assertRaises(InvalidSensorMode, avs.view, 'MODE')
+
+class TestAveragingTree(unittest.TestCase):
+    """Tests the tree of averaging sensors sharing one sensor"""
+
+    def setUp(self):
+        self.sc = cchrc.sensors.SensorContainer()
+        self.sensor = MyTestSensor('T1')
+        self.sc.put(self.sensor, 'G')
+
+    def put(self, interval):
+        avs = cchrc.sensors.AveragingSensor(self.sensor)
+        self.sc.put(avs, 'G', interval)
+        return avs
+
+    def test_one_root_per_sensor(self):
+        """Ensure a sensor is only sampled at the finest period needed"""
+        a300 = self.put(300)
+        a60 = self.put(60)
+        sbsi = self.sc._SensorContainer__sbsi
+        self.assertEqual((sbsi.keys(), sbsi[5], a60.children), ([5], [a60], [a300]))
+
+    def test_hidden_root(self):
+        """Ensure a base sampler is added when no average has the base period"""
+        a120 = self.put(120)
+        a180 = self.put(180)
+        root = self.sc._SensorContainer__sbsi[5][0]
+        self.assertTrue(root not in (a120, a180))
+        self.assertEqual(root.children, [a120, a180])
+
+    def test_cascaded_averages(self):
+        """Ensure coarse averages are built from the fine buckets"""
+        a60 = self.put(60)
+        a300 = self.put(300)
+        for ts in range(5, 305, 5):
+            a60.add_reading(ts, ts)
+        self.assertEqual((a60.get_reading(), a300.get_reading()),
+                         (272.5, 152.5))
+
+    def test_cascade_skips_missing_readings(self):
+        """Ensure missing readings are not counted by coarser averages"""
+        a60 = self.put(60)
+        a300 = self.put(300)
+        for ts in range(5, 305, 5):
+            a60.add_reading(ts if ts > 150 else None, ts)
+        self.assertEqual(a300.get_reading(), 227.5)
+
+    def test_cascaded_aggregates(self):
+        """Ensure coarse aggregates are built from the fine buckets"""
+        import math
+        a60 = self.put(60)
+        a300 = self.put(300)
+        a300.view('MEDIAN')
+        readings = [(ts * 7) % 31 for ts in range(5, 305, 5)]
+        for ts, r in zip(range(5, 305, 5), readings):
+            a60.add_reading(r, ts)
+        mean = sum(readings) / 60.0
+        stddev = math.sqrt(sum([(r - mean) ** 2 for r in readings]) / 59)
+        self.assertEqual([a300.aggregate(m) for m in ['MIN', 'MAX', 'MEDIAN',
+                                                      'COUNT', 'LAST']],
+                         [min(readings), max(readings),
+                          sorted(readings)[29] / 2.0 + sorted(readings)[30] / 2.0,
+                          60, readings[-1]])
+        self.assertAlmostEqual(a300.aggregate('STDDEV'), stddev, 12)
+
 class TestNullSensor(unittest.TestCase):
     """Tests the NullSensor"""
 
@@ -90,6 +225,57 @@ class TestNullSensor(unittest.TestCase):
         ns = NullSensor('foo', 'bar', value='TESTVALUE')
         self.assertEqual(ns.get_reading(), 'TESTVALUE')
 
+    def test_no_circuit_breaker(self):
+        """Ensure a NullSensor is read every time, its None not counted as failing"""
+        ns = NullSensor('foo', 'bar')
+        readings = [ns.read(max_age=0).value for _ in range(10)]
+        self.assertEqual((ns.breaker, readings), (None, [None] * 10))
+        self.assertEqual(cchrc.sensors.breaker_stats([ns]), {})
+
+class TestSyntheticSensor(unittest.TestCase):
+    """Tests the SyntheticSensor"""
+
+    def test_default_reading(self):
+        """Ensure SyntheticSensor returns its value, at once"""
+        ss = SyntheticSensor('foo', 'bar', value='21.5')
+        self.assertEqual((ss.get_reading(), ss.delay()), (21.5, 0))
+
+    def test_generators(self):
+        """Ensure the random and counter generators give what they should"""
+        rs = SyntheticSensor('foo', generator='random', value='10', amplitude='2')
+        cs = SyntheticSensor('foo', generator='counter', value='10', amplitude='2')
+        readings = [rs.get_reading() for _ in range(100)]
+        self.assertTrue(8 <= min(readings) < max(readings) <= 12)
+        self.assertEqual([cs.get_reading() for _ in range(3)], [12, 14, 16])
+
+    def test_latency(self):
+        """Ensure read latencies follow the configured distribution"""
+        ss = SyntheticSensor('foo', latency='0.01', distribution='exponential')
+        delays = [ss.delay() for _ in range(2000)]
+        self.assertAlmostEqual(sum(delays) / len(delays), 0.01, 2)
+
+    def test_failure_rate(self):
+        """Ensure about failure_rate of the reads fail, the same for the same seed"""
+        readings = [SyntheticSensor('foo', failure_rate='0.25', seed='1')
+                    for _ in range(2)]
+        for ss in readings:
+            for _ in range(1000):
+                ss.get_reading()
+        self.assertTrue(200 < readings[0].failures < 300)
+        self.assertEqual(readings[0].failures, readings[1].failures)
+
+    def test_bus(self):
+        """Ensure sensors on the same bus are read together"""
+        sensors = [SyntheticSensor('S%d' % i, bus=str(i % 2)) for i in range(4)]
+        self.assertEqual(len(cchrc.sensors.group_sensors(sensors)), 2)
+
+    def test_invalid_args(self):
+        """Ensure invalid arguments raise an error"""
+        for kwargs in [{'latency': 'BARF'}, {'failure_rate': '2'},
+                       {'distribution': 'BARF'}, {'generator': 'BARF'}]:
+            self.assertRaises(cchrc.sensors.InvalidSensorArg, SyntheticSensor, 'foo',
+                              **kwargs)
+
 class TestOwfsSensorUtils(unittest.TestCase):
     """Test the various OWFS sensor functions and utilities"""
 
@@ -112,13 +298,11 @@ class TestOwfsSensor(unittest.TestCase):
 
         # Have to muck with the class so it doesn't think it's
         # already initialized
-        OWSensor.initialized_connection_type = None
-        OWSensor.sensors = {}
+        OWSensor.buses = {}
 
     def test_get_all(self):
         """Ensure _get_all gets all sensors """
         ow.init('--tester=28,28,28,28')
-        OWSensor.initialized_connection_type = '--tester=28,28,28,28'
         sensors = {}
         expected_sensors = {'28.000028D70200': '/28.000028D70200',
                             '28.000028D70300': '/28.000028D70300',
@@ -133,7 +317,7 @@ class TestOwfsSensor(unittest.TestCase):
     def test_initialize_ow(self):
         """Ensure ow module is initialized properly"""
         OWSensor._initialize_ow('--tester=28,28,28,28')
-        self.assertTrue(OWSensor.initialized_connection_type == '--tester=28,28,28,28')
+        self.assertTrue('--tester=28,28,28,28' in OWSensor.buses)
 
     def test_sensor_init(self):
         """Ensure Sensor initializes properly"""
@@ -148,6 +332,317 @@ class TestOwfsSensor(unittest.TestCase):
                                          connection='--tester=28,28,28,28')
         self.assertAlmostEquals(s.get_reading(), 4.2)
 
+class TestOwfsGroupRead(unittest.TestCase):
+    """Test reading OneWire sensors a bus at a time, against a fake ow module"""
+
+    def setUp(self):
+        self.real_ow = cchrc.sensors.onewire.ow
+        cchrc.sensors.onewire.ow = fake_ow
+        fake_ow.reset({'/28.000000000001': {'temperature': 1.5},
+                       '/28.000000000002': {'temperature': 2.5},
+                       '/28.000000000003': {'temperature': 3.5}})
+        OWSensor.buses = {}
+        self.sensors = [OWSensor('T%s' % x, '28.00000000000%s' % x,
+                                 connection='u') for x in [1, 2, 3]]
+
+    def tearDown(self):
+        cchrc.sensors.onewire.ow = self.real_ow
+        OWSensor.buses = {}
+
+    def test_group_read_converts_once(self):
+        """Ensure a group read does one conversion for the whole bus"""
+        readings = OWSensor.get_readings(self.sensors)
+        self.assertEqual((readings, fake_ow.conversions), ([1.5, 2.5, 3.5], 1))
+
+    def test_single_read_converts(self):
+        """Ensure reading sensors one at a time costs a conversion each"""
+        readings = [s.get_reading() for s in self.sensors]
+        self.assertEqual((readings, fake_ow.conversions), ([1.5, 2.5, 3.5], 3))
+
+    def test_group_read_uses_recent_readings(self):
+        """Ensure a group read within the sensors' ttl does not touch the bus"""
+        cchrc.sensors.read_group(self.sensors)
+        cchrc.sensors.read_group(self.sensors)
+        self.assertEqual((fake_ow.conversions, fake_ow.reads), (1, 3))
+
+    def test_group_read_ttl(self):
+        """Ensure a group read past the sensors' ttl reads the bus again"""
+        for s in self.sensors:
+            s.ttl = 0
+        cchrc.sensors.read_group(self.sensors)
+        cchrc.sensors.read_group(self.sensors)
+        self.assertEqual((fake_ow.conversions, fake_ow.reads), (2, 6))
+
+    def test_prepared_read_does_not_convert(self):
+        """Ensure a read after prepare() fetches the latched values"""
+        OWSensor.prepare(self.sensors)
+        readings = OWSensor.get_readings(self.sensors)
+        self.assertEqual((readings, fake_ow.conversions), ([1.5, 2.5, 3.5], 1))
+
+    def test_prepare_uses_sensor_lead_time(self):
+        """Ensure a prepare() is used for as long as the sensors' own lead time"""
+        for s in self.sensors:
+            s.lead_time = 3
+        OWSensor.prepare(self.sensors)
+        self.sensors[0].bus.prepared -= 2.5
+        OWSensor.get_readings(self.sensors)
+        self.assertEqual(fake_ow.conversions, 1)
+
+    def test_prepare_shared_by_groups(self):
+        """Ensure every group read on a bus at the tick uses its prepare()"""
+        OWSensor.prepare(self.sensors)
+        OWSensor.get_readings(self.sensors[:1])
+        OWSensor.get_readings(self.sensors[1:])
+        self.assertEqual(fake_ow.conversions, 1)
+
+    def test_old_prepare_is_not_used(self):
+        """Ensure a prepare() for an earlier tick doesn't stand in for a conversion"""
+        self.sensors[0].bus.prepared = time.time() - 60
+        OWSensor.get_readings(self.sensors)
+        self.assertEqual(fake_ow.conversions, 1)
+
+    def test_second_connection(self):
+        """Ensure a second connection opens its own bus, and keeps the first one's sensors"""
+        for x in [4, 5]:
+            fake_ow.add_device('/28.00000000000%s' % x, bus='s', temperature=x)
+        for p in ['/28.000000000001', '/28.000000000002', '/28.000000000003']:
+            fake_ow.buses[p] = 'u'
+        other = [OWSensor('S%s' % x, '28.00000000000%s' % x, connection='s')
+                 for x in [4, 5]]
+        readings = (cchrc.sensors.read_sensors(self.sensors + other))
+        self.assertEqual((fake_ow.connection, readings, fake_ow.bus_conversions),
+                         ('u s', [1.5, 2.5, 3.5, 4, 5], {'u': 1, 's': 1}))
+        self.assertEqual(other[0].sensor._path, '/bus.1/28.000000000004')
+        self.assertEqual(len(cchrc.sensors.group_sensors(self.sensors + other)), 2)
+
+    def test_buses_read_in_parallel(self):
+        """Ensure a slow bus does not hold up the reads of another"""
+        import threading
+        fake_ow.add_device('/28.000000000004', bus='s')
+        for p in ['/28.000000000001', '/28.000000000002', '/28.000000000003']:
+            fake_ow.buses[p] = 'u'
+        slow = OWSensor('S4', '28.000000000004', connection='s')
+        # Keep the slow bus's worker busy until the other bus has been read
+        gate = threading.Event()
+        busy = cchrc.sensors.onewire.bus_worker().submit(slow.bus.connection,
+                                                         gate.wait, 5)
+        try:
+            readings = OWSensor.get_readings(self.sensors)
+            held_up = busy.done()
+        finally:
+            gate.set()
+        self.assertEqual((readings, held_up), ([1.5, 2.5, 3.5], False))
+
+    def test_group_sensors(self):
+        """Ensure sensors on one bus are grouped, and other sensors are not"""
+        t1, t2 = MyTestSensor('X1'), MyTestSensor('X2')
+        groups = cchrc.sensors.group_sensors([t1] + self.sensors + [t2])
+        self.assertEqual(sorted([len(g) for g in groups]), [1, 1, 3])
+
+    def test_read_sensors_keeps_order(self):
+        """Ensure read_sensors returns readings in the order asked for"""
+        t1 = MyTestSensor('X1', increment_value=7)
+        readings = cchrc.sensors.read_sensors([self.sensors[2], t1,
+                                               self.sensors[0]])
+        self.assertEqual((readings, fake_ow.conversions), ([3.5, 7, 1.5], 1))
+
+class TestOwfsDeviceCache(unittest.TestCase):
+    """Test the cache of OneWire device paths"""
+
+    def setUp(self):
+        self.real_ow = cchrc.sensors.onewire.ow
+        cchrc.sensors.onewire.ow = fake_ow
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache = os.path.join(self.temp_dir, 'ow.json')
+        self.reset()
+
+    def tearDown(self):
+        cchrc.sensors.onewire.ow = self.real_ow
+        OWSensor.buses = {}
+        shutil.rmtree(self.temp_dir)
+
+    def reset(self):
+        """Starts again, as if CDC were restarted"""
+        fake_ow.reset({'/1F.000000000001/main/28.000000000001': {'temperature': 1.5},
+                       '/28.000000000002': {'temperature': 2.5},
+                       '/1F.000000000001': {}})
+        OWSensor.buses = {}
+
+    def sensors(self):
+        return [OWSensor('T%s' % x, '28.00000000000%s' % x, connection='u',
+                         device_cache=self.cache) for x in [1, 2]]
+
+    def test_scan_saves_cache(self):
+        """Ensure the devices found walking the bus are saved"""
+        self.sensors()
+        f = open(self.cache)
+        cached = json.load(f)
+        f.close()
+        self.assertEqual(cached['u']['28.000000000001'],
+                         '/1F.000000000001/main/28.000000000001')
+
+    def test_cached_startup_does_not_scan(self):
+        """Ensure a restart finds the devices in the cache without walking the bus"""
+        self.sensors()
+        self.reset()
+        sensors = self.sensors()
+        bus = sensors[0].bus
+        self.assertEqual((bus.scans, bus.cache_hits), (0, 2))
+        self.assertEqual(cchrc.sensors.read_sensors(sensors), [1.5, 2.5])
+
+    def test_moved_device_scans(self):
+        """Ensure a device which isn't where the cache says is found by walking the bus"""
+        self.sensors()
+        fake_ow.reset({'/28.000000000001': {'temperature': 1.5},
+                       '/28.000000000002': {'temperature': 2.5}})
+        OWSensor.buses = {}
+        sensors = self.sensors()
+        self.assertEqual((sensors[0].bus.scans, sensors[0].sensor._path),
+                         (1, '/28.000000000001'))
+
+    def test_unreadable_cache(self):
+        """Ensure an unreadable cache is ignored, and replaced"""
+        f = open(self.cache, 'w')
+        f.write('not json')
+        f.close()
+        sensors = self.sensors()
+        f = open(self.cache)
+        cached = json.load(f)
+        f.close()
+        self.assertEqual(sensors[0].bus.scans, 1)
+        self.assertTrue('28.000000000002' in cached['u'])
+
+class RescannedSensor(MyTestSensor):
+    """A sensor type which counts its rescans"""
+    rescan_interval = 60
+    rescans = 0
+
+    @classmethod
+    def rescan(klass, sensors):
+        klass.rescans += 1
+
+class TestOwfsRescan(unittest.TestCase):
+    """Test rescanning OneWire buses for devices which come and go"""
+
+    def setUp(self):
+        self.real_ow = cchrc.sensors.onewire.ow
+        cchrc.sensors.onewire.ow = fake_ow
+        fake_ow.reset({'/1F.000000000001/main/28.000000000001': {'temperature': 1.5},
+                       '/1F.000000000001': {}})
+        OWSensor.buses = {}
+
+    def tearDown(self):
+        cchrc.sensors.onewire.ow = self.real_ow
+        OWSensor.buses = {}
+
+    def rescan(self, bus):
+        rescans = bus.rescans
+        bus.rescan()
+        for _ in range(500):
+            if bus.rescans > rescans:
+                return
+            time.sleep(0.01)
+
+    def test_missing_at_startup(self):
+        """Ensure a sensor whose device is missing at startup reads None"""
+        s = OWSensor('T2', '28.000000000002', connection='u')
+        self.assertEqual((s.sensor, s.get_reading()), (None, None))
+
+    def test_late_device_attached(self):
+        """Ensure a device plugged in after startup is attached by a rescan"""
+        s = OWSensor('T2', '28.000000000002', connection='u')
+        fake_ow.add_device('/1F.000000000001/aux/28.000000000002', temperature=2.5)
+        self.rescan(s.bus)
+        self.assertEqual(s.get_reading(), 2.5)
+
+    def test_vanished_device_detached(self):
+        """Ensure a device which went away is detached by a rescan"""
+        s = OWSensor('T1', '28.000000000001', connection='u')
+        fake_ow.remove_device('/1F.000000000001/main/28.000000000001')
+        self.rescan(s.bus)
+        self.assertEqual((s.sensor, s.get_reading()), (None, None))
+        self.assertFalse('28.000000000001' in s.bus.devices)
+
+    def test_attach_failure_does_not_stop_rescan(self):
+        """Ensure a device which can't be attached doesn't stop a rescan, and is tried again"""
+        s2 = OWSensor('T2', '28.000000000002', connection='u')
+        s3 = OWSensor('T3', '28.000000000003', connection='u')
+        fake_ow.add_device('/1F.000000000001/aux/28.000000000002', temperature=2.5)
+        fake_ow.add_device('/1F.000000000001/aux/28.000000000003', temperature=3.5)
+        entry_list = fake_ow.Sensor.entryList
+        failed = []
+
+        def failing_entry_list(device):
+            if device._path.endswith('2') and not failed:
+                failed.append(device._path)
+                raise IOError('bus error')
+            return entry_list(device)
+
+        fake_ow.Sensor.entryList = failing_entry_list
+        try:
+            self.rescan(s2.bus)
+            first = (s2.get_reading(), s3.get_reading())
+            self.rescan(s2.bus)
+        finally:
+            fake_ow.Sensor.entryList = entry_list
+        self.assertEqual(first, (None, 3.5))
+        self.assertEqual(s2.get_reading(), 2.5)
+
+    def test_failed_rescan_can_run_again(self):
+        """Ensure a rescan which fails part way doesn't stop later rescans"""
+        s = OWSensor('T2', '28.000000000002', connection='u')
+        fake_ow.add_device('/1F.000000000001/aux/28.000000000002', temperature=2.5)
+        failures = []
+
+        def failing_save_cache():
+            failures.append(True)
+            raise RuntimeError('disk full')
+
+        s.bus.save_cache = failing_save_cache
+        self.rescan(s.bus)
+        fake_ow.remove_device('/1F.000000000001/aux/28.000000000002')
+        self.rescan(s.bus)
+        self.assertEqual((len(failures), s.bus.rescans), (2, 2))
+        self.assertEqual(s.get_reading(), None)
+
+    def test_reads_during_rescan(self):
+        """Ensure a read doesn't wait for a whole rescan"""
+        for h in range(2, 12):
+            fake_ow.add_device('/1F.%012d' % h)
+            for d in range(3):
+                fake_ow.add_device('/1F.%012d/main/28.%012d' % (h, h * 10 + d))
+        s = OWSensor('T1', '28.000000000001', connection='u')
+        fake_ow.delays[None] = 0.01
+        listings = []
+        list_devices = fake_ow.Sensor.sensors
+
+        def counting_list_devices(device):
+            listings.append(device._path)
+            return list_devices(device)
+
+        fake_ow.Sensor.sensors = counting_list_devices
+        try:
+            s.bus.rescan()
+            reading = s.get_reading()
+            listed = len(listings)
+            self.rescan(s.bus)
+        finally:
+            fake_ow.Sensor.sensors = list_devices
+        self.assertEqual(reading, 1.5)
+        # The read got in between directories, before the walk was over
+        self.assertTrue(listed < len(listings))
+
+    def test_rescan_scheduled(self):
+        """Ensure the SensorContainer rescans sensor types which ask for it"""
+        RescannedSensor.rescans = 0
+        sc = cchrc.sensors.SensorContainer()
+        sc.put(RescannedSensor('R'), 'G')
+        sc.start_averaging_sensors()
+        time.sleep(0.1)
+        jobs = sc.stats()['scheduler']['jobs']
+        sc.stop_averaging_sensors()
+        self.assertEqual((jobs['rescan']['interval'], RescannedSensor.rescans), (60, 0))
+
 class TestUtils(unittest.TestCase):
     """Test various utilities"""
 
@@ -168,7 +663,9 @@ class TestUtils(unittest.TestCase):
         opd = os.path.dirname
         self.assertEqual(cchrc.common.mod.mod_list(os.path.join(opd(opd(__file__)),
                                                                 'common')),
-                         ['datafile', 'exceptions', 'mod'])
+                         ['binfile', 'clock', 'datafile', 'encoder', 'exceptions', 'executor',
+                          'index', 'mod', 'partition', 'profiler', 'rollup', 'scheduler',
+                          'snapshot', 'stats', 'tracing', 'writer'])
 
     def test_mod_nolist(self):
         """Ensure cchrc.common.mod.mod_list is working: no module dir"""
@@ -295,6 +792,780 @@ class TestSensorCollection(unittest.TestCase):
         sc.stop_averaging_sensors()
         self.assertTrue(is_alive)
 
+class TestScheduler(unittest.TestCase):
+    """Test the deadline scheduler"""
+
+    def test_tick_index_alignment(self):
+        """Ensure ticks are aligned to epoch boundaries"""
+        ti = cchrc.common.scheduler._tick_index
+        self.assertEqual((ti(899.9, 300), ti(900, 300), ti(905, 300, 5)),
+                         (2, 3, 3))
+
+    def test_due_ticks_latest(self):
+        """Ensure the latest policy runs the most recent missed tick once"""
+        dt = cchrc.common.scheduler._due_ticks
+        self.assertEqual(dt(5, 8, 'latest', 10), ([8], 3))
+
+    def test_due_ticks_all(self):
+        """Ensure the all policy runs every missed tick, up to the limit"""
+        dt = cchrc.common.scheduler._due_ticks
+        self.assertEqual((dt(5, 8, 'all', 10), dt(5, 8, 'all', 2)),
+                         (([5, 6, 7, 8], 0), ([7, 8], 2)))
+
+    def test_due_ticks_skip(self):
+        """Ensure the skip policy drops late ticks"""
+        dt = cchrc.common.scheduler._due_ticks
+        self.assertEqual((dt(5, 5, 'skip', 10, 0), dt(5, 8, 'skip', 10, 3)),
+                         (([5], 0), ([], 4)))
+
+    def test_due_ticks_early_wakeup(self):
+        """Ensure waking up just before the wall-clock tick still runs it"""
+        dt = cchrc.common.scheduler._due_ticks
+        self.assertEqual(dt(5, 4, 'latest', 10), ([5], 0))
+
+    def test_invalid_policy(self):
+        """Ensure an invalid catch up policy raises an error"""
+        self.assertRaises(InvalidSchedulerPolicy,
+                          cchrc.common.scheduler.Scheduler().add,
+                          60, None, catch_up='BARF')
+
+    def test_run_at_start_and_stop(self):
+        """Ensure a run_at_start job runs immediately, and stop() wakes the scheduler"""
+        import threading
+        fired = []
+        ran = threading.Event()
+        def cb(ts):
+            fired.append(ts)
+            ran.set()
+        sched = cchrc.common.scheduler.Scheduler()
+        sched.add(3600, cb, run_at_start=True)
+        t = threading.Thread(target=sched.run)
+        t.start()
+        ran.wait(5)
+        sched.stop()
+        t.join(5)
+        self.assertFalse(t.isAlive())
+        self.assertEqual([ts % 3600 for ts in fired], [0])
+
+class TestCollectionExecutor(unittest.TestCase):
+    """Test the long-lived collection executor"""
+
+    def setUp(self):
+        self.ex = cchrc.common.executor.CollectionExecutor('Test', 2)
+
+    def tearDown(self):
+        self.ex.shutdown(wait=False)
+
+    def test_submit(self):
+        """Ensure submitted work runs and returns its result"""
+        self.assertEqual(self.ex.submit(5, lambda x: x * 2, 21).result(5), 42)
+
+    def test_workers_are_reused(self):
+        """Ensure a lane never starts more than its share of threads"""
+        fs = [self.ex.submit(5, time.sleep, 0.01) for _ in range(10)]
+        [f.result(5) for f in fs]
+        self.assertEqual(self.ex.stats()['5']['threads'], 2)
+
+    def test_lanes_are_independent(self):
+        """Ensure a blocked lane does not hold up another, and its depth is visible"""
+        import threading
+        gate = threading.Event()
+        for _ in range(4):
+            self.ex.submit(3600, gate.wait, 5)
+        result = self.ex.submit(5, lambda: 'done').result(5)
+        for _ in range(500):
+            if self.ex.stats()['3600']['running'] == 2:
+                break
+            time.sleep(0.01)
+        depths = self.ex.queue_depths()
+        gate.set()
+        self.assertEqual((result, depths[3600]), ('done', 2))
+
+    def test_work_taken_but_not_running(self):
+        """Ensure work submitted while a worker is between taking an item and running it gets a worker"""
+        import Queue
+        import threading
+        taken, resume, gate = threading.Event(), threading.Event(), threading.Event()
+
+        class PausingQueue(Queue.Queue):
+            def get(self, *args, **kwargs):
+                item = Queue.Queue.get(self, *args, **kwargs)
+                if not taken.isSet():
+                    taken.set()
+                    resume.wait(5)
+                return item
+
+        self.ex._CollectionExecutor__lane(5).queue = PausingQueue()
+        self.ex.submit(5, gate.wait, 5)
+        taken.wait(5)
+        f = self.ex.submit(5, lambda: 'done')
+        resume.set()
+        try:
+            self.assertEqual(f.result(2), 'done')
+        finally:
+            gate.set()
+        self.assertEqual(self.ex.stats()['5']['threads'], 2)
+
+class HungSensor(MyTestSensor):
+    """A sensor whose reads block while hang is set"""
+    def __init__(self, *args, **kwargs):
+        MyTestSensor.__init__(self, *args, **kwargs)
+        import threading
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def get_reading(self):
+        self.gate.wait(5)
+        return MyTestSensor.get_reading(self)
+
+class TestReadDeadlines(unittest.TestCase):
+    """Test the deadlines of sensor reads"""
+
+    def setUp(self):
+        self.ex = cchrc.common.executor.CollectionExecutor('Test', 4)
+
+    def tearDown(self):
+        self.ex.shutdown(wait=False)
+
+    def test_timeout_args(self):
+        """Ensure every sensor type takes timeout and on_timeout"""
+        s = NullSensor('N', timeout='2.5', on_timeout='STALE')
+        self.assertEqual((s.timeout, s.on_timeout), (2.5, 'stale'))
+
+    def test_invalid_on_timeout(self):
+        """Ensure an unknown on_timeout policy is rejected"""
+        self.assertRaises(cchrc.sensors.InvalidSensorArg,
+                          MyTestSensor, 'NAME', on_timeout='guess')
+
+    def test_read_in_time(self):
+        """Ensure a read which finishes in time gives its readings"""
+        s = HungSensor('H', timeout=1)
+        read = cchrc.sensors.GroupRead([s], self.ex, 5)
+        self.assertEqual((read.readings(), s.timeouts), ([1], 0))
+
+    def test_late_read_is_none(self):
+        """Ensure a late read gives None, without waiting for it"""
+        s = HungSensor('H', timeout=0.1)
+        s.gate.clear()
+        read = cchrc.sensors.GroupRead([s], self.ex, 5)
+        readings = read.readings()
+        # The sensor is still hung, so its read wasn't waited for
+        still_reading = not read.future.done()
+        s.gate.set()
+        self.assertEqual((readings, still_reading, s.timeouts), ([None], True, 1))
+
+    def test_late_read_is_stale(self):
+        """Ensure a late read gives the last good reading, marked stale"""
+        s = HungSensor('H', timeout=0.1, on_timeout='stale')
+        cchrc.sensors.GroupRead([s], self.ex, 5).readings()
+        s.gate.clear()
+        readings = cchrc.sensors.GroupRead([s], self.ex, 5).readings()
+        s.gate.set()
+        self.assertEqual(readings, [1])
+        self.assertTrue(readings[0].stale)
+
+    def test_stale_reading_written(self):
+        """Ensure a stale reading is written as the last good value, and counted"""
+        temp_dir = tempfile.mkdtemp()
+        try:
+            sc = cchrc.sensors.SensorContainer()
+            s = HungSensor('H', timeout=0.1, on_timeout='stale')
+            sc.put(s, 'TestGroup')
+            d = cchrc.common.datafile.DataFile('TestID', 'TestFile', temp_dir,
+                                               'TestGroup', 5, 'SAMPLE', ['H'], sc)
+            for ts in (1287446400, 1287446405):
+                if ts == 1287446405:
+                    s.gate.clear()
+                snapshot = cchrc.common.snapshot.TickSnapshot(ts, d.sensors)
+                snapshot.acquire(self.ex, 5)
+                d.collect_data(ts, snapshot)
+            s.gate.set()
+            d.close()
+            rows = get_file(temp_dir, 'TestFile').splitlines()[1:]
+        finally:
+            shutil.rmtree(temp_dir)
+        self.assertEqual([r.split(',')[1] for r in rows], ['1', '1.0'])
+        self.assertEqual(d.stats()['stale_values'], 1)
+        self.assertEqual(cchrc.sensors.timeout_stats([s])['sensors']['H']['stale'], 1)
+
+    def test_max_wait(self):
+        """Ensure a read is never waited for longer than max_wait"""
+        s = HungSensor('H', timeout=10)
+        s.gate.clear()
+        read = cchrc.sensors.GroupRead([s], self.ex, 5, max_wait=0.1)
+        read.readings()
+        still_reading = not read.future.done()
+        s.gate.set()
+        self.assertEqual((still_reading, s.timeouts), (True, 1))
+
+    def test_hung_sensor_not_read_again(self):
+        """Ensure a sensor still being read is not read again, and is counted"""
+        s = HungSensor('H', timeout=0.05)
+        s.gate.clear()
+        cchrc.sensors.GroupRead([s], self.ex, 5).readings()
+        second = cchrc.sensors.GroupRead([s], self.ex, 5)
+        readings = second.readings()
+        running = self.ex.stats()['5']['running']
+        s.gate.set()
+        stats = cchrc.sensors.timeout_stats([s])
+        self.assertTrue(second.future is None)
+        self.assertEqual((readings, running), ([None], 1))
+        self.assertEqual(stats['sensors']['H'],
+                         {'timeouts': 1, 'still_reading': 1, 'stale': 0})
+
+    def test_read_in_flight_shared(self):
+        """Ensure a sensor being read in time is not read again, and both reads get its reading"""
+        s = HungSensor('H', timeout=5)
+        s.gate.clear()
+        first = cchrc.sensors.GroupRead([s], self.ex, 5)
+        second = cchrc.sensors.GroupRead([s], self.ex, 5)
+        s.gate.set()
+        self.assertEqual((first.readings(), second.readings()), ([1], [1]))
+        self.assertEqual((second.future, s.still_reading), (None, 0))
+
+    def test_late_result_discarded(self):
+        """Ensure the next read after a late one gives fresh readings"""
+        s = HungSensor('H', timeout=0.05)
+        s.gate.clear()
+        late = cchrc.sensors.GroupRead([s], self.ex, 5)
+        late.readings()
+        s.gate.set()
+        late.future.result(5)
+        self.assertEqual(cchrc.sensors.GroupRead([s], self.ex, 5).readings(), [2])
+
+    def test_snapshot_deadline(self):
+        """Ensure one hung sensor does not hold up the rest of a tick"""
+        hung, ok = HungSensor('H', timeout=0.1), MyTestSensor('OK')
+        hung.gate.clear()
+        snapshot = cchrc.common.snapshot.TickSnapshot(time.time(), [hung, ok])
+        snapshot.acquire(self.ex, 5)
+        readings = snapshot.readings([hung, ok])
+        hung.gate.set()
+        self.assertEqual(readings, [None, 1])
+
+class FailingSensor(MyTestSensor):
+    """A sensor which gives None while failing is set, and counts its reads"""
+    failing = True
+    reads = 0
+
+    def get_reading(self):
+        self.reads += 1
+        if self.failing:
+            return None
+        return MyTestSensor.get_reading(self)
+
+class TestSingleFlight(unittest.TestCase):
+    """Test sharing reads of a sensor between threads"""
+
+    def test_reading_has_time(self):
+        """Ensure a reading carries the time it was taken"""
+        set_clock(SimulatedClock(1287446400))
+        try:
+            r = MyTestSensor('S').read()
+        finally:
+            set_clock(None)
+        self.assertEqual((r.value, r.time), (1, 1287446400))
+
+    def test_ttl(self):
+        """Ensure a reading is reused within the ttl, and not after it"""
+        s = MyTestSensor('S', ttl='0.1')
+        first, second = s.read().value, s.read().value
+        time.sleep(0.15)
+        self.assertEqual((first, second, s.read().value), (1, 1, 2))
+
+    def test_max_age(self):
+        """Ensure a caller can ask for a fresher reading than the ttl"""
+        s = MyTestSensor('S', ttl=60)
+        s.read()
+        self.assertEqual((s.read().value, s.read(max_age=0).value), (1, 2))
+
+    def test_invalid_ttl(self):
+        """Ensure a ttl which isn't a number is rejected"""
+        self.assertRaises(cchrc.sensors.InvalidSensorArg,
+                          MyTestSensor, 'NAME', ttl='soon')
+
+    def test_concurrent_reads_share(self):
+        """Ensure callers asking during a read share it instead of reading again"""
+        import threading
+        s = HungSensor('H')
+        s.gate.clear()
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(s.read()))
+                   for _ in range(4)]
+        for t in threads:
+            t.start()
+        time.sleep(0.1)
+        s.gate.set()
+        for t in threads:
+            t.join(5)
+        self.assertEqual((len(results), s.value, len(set(results))), (4, 1, 1))
+
+    def test_error_is_shared(self):
+        """Ensure a read which fails raises, and is not reused"""
+        s = MyTestSensor('E', ttl=60)
+        s.get_reading = lambda: 1 / 0
+        self.assertRaises(ZeroDivisionError, s.read)
+        self.assertTrue(s.cached_reading is None)
+
+class PreparedSensor(MyTestSensor):
+    """A sensor with a lead time, which records the groups prepared"""
+    lead_time = 1.0
+    prepared = []
+
+    @classmethod
+    def prepare(klass, sensors):
+        klass.prepared.append(sorted([s.name for s in sensors]))
+
+    def group_key(self):
+        return 'bus'
+
+class TestPrepare(unittest.TestCase):
+    """Test preparing sensors with a lead time ahead of the tick"""
+
+    def setUp(self):
+        PreparedSensor.prepared = []
+        self.ex = cchrc.common.executor.CollectionExecutor('Test', 2)
+
+    def tearDown(self):
+        self.ex.shutdown(wait=False)
+
+    def test_lead_time_arg(self):
+        """Ensure a sensor's lead time can be set, and the longest is used"""
+        sensors = [MyTestSensor('A', lead_time='2.5'), PreparedSensor('B')]
+        self.assertEqual(cchrc.sensors.lead_time(sensors), 2.5)
+
+    def test_prepare_sensors(self):
+        """Ensure only sensors with a lead time are prepared, a group at a time, once"""
+        a, b = PreparedSensor('A'), PreparedSensor('B')
+        cchrc.sensors.prepare_sensors([a, MyTestSensor('C'), b, a], self.ex, 5)
+        self.ex.shutdown(wait=True)
+        self.assertEqual(PreparedSensor.prepared, [['A', 'B']])
+
+    def test_prepare_errors_are_logged(self):
+        """Ensure an error preparing sensors doesn't escape"""
+        s = PreparedSensor('A')
+        s.prepare = lambda sensors: 1 / 0
+        cchrc.sensors.prepare_group([s])
+
+    def test_runner_schedules_prepare(self):
+        """Ensure the DataFileRunner prepares sensors with a lead time before the tick"""
+        temp_dir = tempfile.mkdtemp()
+        try:
+            sc = cchrc.sensors.SensorContainer()
+            sc.put(PreparedSensor('P1'), 'G')
+            dfr = cchrc.common.datafile.DataFileRunner()
+            dfr.put(cchrc.common.datafile.DataFile('ID', 'F', temp_dir, 'G', 5,
+                                                   'SAMPLE', ['P1'], sc))
+            dfr.start_data_files()
+            time.sleep(0.1)
+            jobs = dfr.stats()['scheduler']['jobs']
+            dfr.stop_data_files()
+        finally:
+            shutil.rmtree(temp_dir)
+        self.assertTrue('5 second files prepare' in jobs)
+
+class TestCircuitBreaker(unittest.TestCase):
+    """Test the circuit breaker of sensors which keep failing"""
+
+    def test_opens_after_threshold(self):
+        """Ensure the circuit opens after threshold failures, and stops reads"""
+        s = FailingSensor('F')
+        for _ in range(10):
+            cchrc.sensors.read_group([s])
+        stats = s.breaker.stats()
+        self.assertEqual((s.reads, stats['state'], stats['skipped'], stats['opened']),
+                         (3, 'open', 7, 1))
+
+    def test_half_open_probe(self):
+        """Ensure an open circuit lets one read through once the backoff is over"""
+        clock = SimulatedClock(1287446400)
+        set_clock(clock)
+        try:
+            s = FailingSensor('F')
+            for _ in range(3):
+                cchrc.sensors.read_group([s])
+            clock.sleep(s.breaker.backoff)
+            s.failing = False
+            readings = [cchrc.sensors.read_group([s]), cchrc.sensors.read_group([s])]
+        finally:
+            set_clock(None)
+        self.assertEqual((readings, s.breaker.state, s.breaker.failures),
+                         ([[1], [2]], 'closed', 0))
+
+    def test_backoff_doubles(self):
+        """Ensure each failed probe doubles the backoff, up to its maximum"""
+        b = cchrc.sensors.CircuitBreaker('F', threshold=1, backoff=1, max_backoff=3)
+        b.failure()
+        waits = []
+        for _ in range(3):
+            self.assertTrue(b.allow(cchrc.common.clock.monotonic() + 10))
+            b.failure()
+            waits.append(b._CircuitBreaker__wait)
+        self.assertEqual(waits, [2, 3, 3])
+
+    def test_errors_are_failures(self):
+        """Ensure a read which raises counts as a failure"""
+        s = MyTestSensor('E')
+        s.get_reading = lambda: 1 / 0
+        self.assertRaises(ZeroDivisionError, cchrc.sensors.read_group, [s])
+        self.assertEqual(s.breaker.failures, 1)
+
+    def test_open_sensor_in_group(self):
+        """Ensure a sensor with an open circuit doesn't stop its group being read"""
+        bad, good = FailingSensor('F'), MyTestSensor('G')
+        for _ in range(3):
+            cchrc.sensors.read_group([bad])
+        self.assertEqual(cchrc.sensors.read_group([bad, good]), [None, 1])
+
+    def test_averaging_sensor_has_no_breaker(self):
+        """Ensure averaging sensors, which may have no readings yet, have no breaker"""
+        avs = cchrc.sensors.AveragingSensor(MyTestSensor('T'), 2)
+        self.assertEqual((avs.breaker, avs.view('MIN').breaker), (None, None))
+
+class TestStats(unittest.TestCase):
+    """Test the runtime statistics"""
+
+    def test_histogram(self):
+        """Ensure a histogram counts values in power of two buckets"""
+        h = cchrc.common.stats.Histogram()
+        for v in [0.001] * 90 + [0.1] * 10:
+            h.record(v)
+        stats = h.stats()
+        self.assertEqual((stats['count'], stats['max'], stats['p99']), (100, 0.1, 0.1))
+        self.assertTrue(0.001 <= stats['p50'] < 0.002)
+        self.assertEqual(sorted(stats['buckets'].values()), [10, 90])
+
+    def test_histogram_out_of_range(self):
+        """Ensure tiny, negative and huge values go in the end buckets"""
+        h = cchrc.common.stats.Histogram()
+        for v in [-1, 0, 1e-9, 1e9]:
+            h.record(v)
+        self.assertEqual((h.buckets[0], h.buckets[-1]), (3, 1))
+
+    def test_empty_histogram(self):
+        """Ensure an empty histogram has no percentiles"""
+        stats = cchrc.common.stats.Histogram().stats()
+        self.assertEqual((stats['count'], stats['p50'], stats['mean']), (0, None, None))
+
+    def test_read_time(self):
+        """Ensure the time taken by each read is recorded"""
+        s = MyTestSensor('T')
+        for _ in range(3):
+            cchrc.sensors.read_group([s])
+        self.assertEqual(s.read_time.count, 3)
+
+    def test_job_lateness(self):
+        """Ensure the lateness of every tick is recorded"""
+        import threading
+        ran = threading.Event()
+        sched = cchrc.common.scheduler.Scheduler()
+        job = sched.add(3600, lambda ts: ran.set(), run_at_start=True)
+        t = threading.Thread(target=sched.run)
+        t.start()
+        ran.wait(5)
+        sched.stop()
+        t.join(5)
+        self.assertEqual(job.stats()['lateness']['count'], 1)
+
+    def test_lane_max_queued(self):
+        """Ensure the deepest a lane's queue has been is recorded"""
+        import threading
+        ex = cchrc.common.executor.CollectionExecutor('Test', 1)
+        gate = threading.Event()
+        try:
+            fs = [ex.submit(5, gate.wait, 5) for _ in range(4)]
+            gate.set()
+            [f.result(5) for f in fs]
+            self.assertTrue(ex.stats()['5']['max_queued'] >= 3)
+        finally:
+            ex.shutdown(wait=False)
+
+    def test_stats_server(self):
+        """Ensure stats are served as JSON on a Unix domain socket"""
+        import socket
+        temp_dir = tempfile.mkdtemp()
+        path = os.path.join(temp_dir, 'cdc.sock')
+        server = cchrc.common.stats.StatsServer(path, lambda: {'a': 1})
+        server.start()
+        try:
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            s.connect(path)
+            data = ''
+            while True:
+                chunk = s.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+            s.close()
+            server.stop()
+            self.assertEqual(json.loads(data), {'a': 1})
+            self.assertFalse(os.path.exists(path))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_merge(self):
+        """Ensure the stats of several histograms can be put together"""
+        a, b = cchrc.common.stats.Histogram(), cchrc.common.stats.Histogram()
+        for v in [0.001] * 90:
+            a.record(v)
+        for v in [0.1] * 10:
+            b.record(v)
+        merged = cchrc.common.stats.merge([a.stats(), b.stats(),
+                                           cchrc.common.stats.Histogram().stats()])
+        self.assertEqual((merged.count, merged.min, merged.max, merged.percentile(99)),
+                         (100, 0.001, 0.1, 0.1))
+        self.assertEqual(merged.buckets, [x + y for x, y in zip(a.buckets, b.buckets)])
+
+    def test_dump(self):
+        """Ensure stats are written to a file as JSON"""
+        temp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(temp_dir, 'stats.json')
+            cchrc.common.stats.dump({'a': [1, 2]}, path)
+            self.assertEqual(json.load(open(path)), {'a': [1, 2]})
+        finally:
+            shutil.rmtree(temp_dir)
+
+def _spin(stop):
+    while not stop.is_set():
+        sum(xrange(1000))
+
+class TestProfiler(unittest.TestCase):
+    """Test the sampling profiler"""
+
+    def test_thread_profile(self):
+        """Ensure a sample counts the running function and everything under it"""
+        import sys
+        p = cchrc.common.profiler.ThreadProfile('T')
+        def inner():
+            p.add(sys._getframe())
+        inner()
+        inner()
+        own = [k for k in p.own if k.endswith('(inner)')]
+        self.assertEqual((p.samples, len(own), p.own[own[0]]), (2, 1, 2))
+        self.assertTrue([k for k in p.total if 'test_thread_profile' in k])
+
+    def test_profiles_every_thread(self):
+        """Ensure other threads are profiled, and the reports are written"""
+        import threading
+        temp_dir = tempfile.mkdtemp()
+        stop = threading.Event()
+        t = threading.Thread(target=_spin, args=(stop,), name='Spinner')
+        t.start()
+        try:
+            prof = cchrc.common.profiler.Profiler(0.2, os.path.join(temp_dir, 'p'), 0.005)
+            prof.start()
+            prof.join(5)
+            stop.set()
+            t.join(5)
+            files = os.listdir(os.path.join(temp_dir, 'p'))
+            merged = get_file(temp_dir, 'p', 'merged.txt')
+            self.assertTrue('thread-Spinner-%s.txt' % t.ident in files)
+            self.assertTrue('thread-Spinner-%s.folded' % t.ident in files)
+            self.assertTrue('(_spin)' in merged)
+        finally:
+            stop.set()
+            shutil.rmtree(temp_dir)
+
+    def test_stop_early(self):
+        """Ensure a profile stopped early is still written"""
+        temp_dir = tempfile.mkdtemp()
+        try:
+            prof = cchrc.common.profiler.Profiler(3600, temp_dir)
+            prof.start()
+            time.sleep(0.05)
+            prof.stop()
+            self.assertTrue('merged.txt' in os.listdir(temp_dir))
+        finally:
+            shutil.rmtree(temp_dir)
+
+class TestTracing(unittest.TestCase):
+    """Test the trace of the collection loops"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, 'trace.json')
+
+    def tearDown(self):
+        cchrc.common.tracing.stop()
+        shutil.rmtree(self.temp_dir)
+
+    def test_off(self):
+        """Ensure nothing is recorded when tracing is off"""
+        self.assertTrue(cchrc.common.tracing.span('read', 'sensor') is
+                        cchrc.common.tracing._NULL_SPAN)
+
+    def test_trace(self):
+        """Ensure the reads and averaging of a running SensorContainer are traced"""
+        clock = SimulatedClock(1287446400)
+        set_clock(clock)
+        try:
+            cchrc.common.tracing.start(self.path)
+            sc = cchrc.sensors.SensorContainer()
+            sc.put(MyTestSensor('T'), 'TestGroup')
+            cchrc.common.datafile.DataFile('A', 'Average', self.temp_dir, 'TestGroup',
+                                           60, 'AVERAGE', ['T'], sc)
+            with clock.held():
+                sc.start_averaging_sensors()
+            clock.sleep(30)
+            sc.stop_averaging_sensors()
+            sc.join(5)
+            cchrc.common.tracing.stop()
+        finally:
+            set_clock(None)
+        events = json.load(open(self.path))
+        names = dict((e['tid'], e['args']['name']) for e in events if e['ph'] == 'M')
+        spans = [e for e in events if e['ph'] == 'X']
+        reads = [e for e in spans if e['name'] == 'read']
+        collects = [e for e in spans if e['name'] == 'collect']
+        self.assertEqual((reads[0]['args'], collects[0]['args']),
+                         ({'sensors': ['T']}, {'sensors': ['T']}))
+        self.assertTrue(names[collects[0]['tid']].startswith('SensorContainer'))
+        # The readings are averaged once the read is done
+        self.assertTrue(collects[0]['ts'] + collects[0]['dur'] >=
+                        reads[0]['ts'] + reads[0]['dur'])
+
+    def test_rotation(self):
+        """Ensure the trace file is rotated, keeping the given number of old files"""
+        tracer = cchrc.common.tracing.Tracer(self.path, max_bytes=500, backups=2,
+                                             flush_interval=0.01)
+        tracer.start()
+        for _ in range(20):
+            for _ in range(5):
+                tracer.add(('read', 'sensor', time.time(), 0.001, {}))
+            time.sleep(0.02)
+        tracer.stop()
+        files = sorted(os.listdir(self.temp_dir))
+        self.assertEqual((files, tracer.events),
+                         (['trace.json', 'trace.json.1', 'trace.json.2'], 100))
+        for f in files:
+            self.assertTrue(isinstance(json.load(open(os.path.join(self.temp_dir, f))),
+                                       list))
+
+class TestSimulatedClock(unittest.TestCase):
+    """Test running on a simulated clock"""
+    start = 1287446400
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.clock = SimulatedClock(self.start)
+        set_clock(self.clock)
+
+    def tearDown(self):
+        set_clock(None)
+        shutil.rmtree(self.temp_dir)
+
+    def test_sleep(self):
+        """Ensure sleeping on a simulated clock moves it on in one step"""
+        self.clock.sleep(3600)
+        self.assertEqual((self.clock.time(), self.clock.advances),
+                         (self.start + 3600, 1))
+
+    def test_scheduler(self):
+        """Ensure a scheduler fires every tick of an hour on a simulated clock"""
+        import threading
+        fired = []
+        sched = cchrc.common.scheduler.Scheduler()
+        sched.add(60, fired.append)
+        sched.open()
+        t = threading.Thread(target=sched.run)
+        t.start()
+        self.clock.sleep(3660)
+        sched.stop()
+        t.join(5)
+        self.assertEqual(fired[:60], [self.start + 60 * i for i in range(1, 61)])
+
+    def test_executor(self):
+        """Ensure work queued behind work sleeping on a simulated clock still runs"""
+        ex = cchrc.common.executor.CollectionExecutor('Test', 1)
+        try:
+            fs = [ex.submit(5, self.clock.sleep, s) for s in (10, 20)]
+            [self.clock.result(f) for f in fs]
+        finally:
+            ex.shutdown(wait=False)
+        self.assertEqual((self.clock.time(), self.clock.advances), (self.start + 30, 2))
+
+    def run_day(self, base_dir):
+        """Runs a day of collection to a sampled and an averaged file"""
+        os.mkdir(base_dir)
+        DF = cchrc.common.datafile.DataFile
+        sc = cchrc.sensors.SensorContainer()
+        dfr = cchrc.common.datafile.DataFileRunner()
+        sc.put(MyTestSensor('T1'), 'TestGroup')
+        sc.put(MyTestSensor('T2', increment_value=5), 'TestGroup')
+        dfr.put(DF('S', 'Sample', base_dir, 'TestGroup', 300, 'SAMPLE', ['T1'], sc))
+        dfr.put(DF('A', 'Average', base_dir, 'TestGroup', 3600, 'AVERAGE', ['T2'], sc))
+        with self.clock.held():
+            sc.start_averaging_sensors()
+            dfr.start_data_files()
+        # Until the last tick of the day is written
+        self.clock.sleep(86400 + 300)
+        sc.stop_averaging_sensors()
+        dfr.stop_data_files()
+        sc.join(5)
+        dfr.join(5)
+        # The clock can move on a tick or two before the runners stop
+        return (get_file(base_dir, 'Sample').splitlines()[:289],
+                get_file(base_dir, 'Average').splitlines()[:25])
+
+    def test_flush_interval(self):
+        """Ensure a buffered row is written after FlushInterval, with no row after it"""
+        DF = cchrc.common.datafile.DataFile
+        sc = cchrc.sensors.SensorContainer()
+        dfr = cchrc.common.datafile.DataFileRunner()
+        sc.put(MyTestSensor('T1'), 'TestGroup')
+        dfr.put(DF('S', 'Sample', self.temp_dir, 'TestGroup', 3600, 'SAMPLE',
+                   ['T1'], sc, flush_rows=100, flush_interval=60))
+        with self.clock.held():
+            dfr.start_data_files()
+        self.clock.sleep(3600 + 90)
+        written = get_file(self.temp_dir, 'Sample').splitlines()
+        dfr.stop_data_files()
+        dfr.join(5)
+        self.assertEqual(len(written), 2)
+
+    def test_shared_slow_read(self):
+        """Ensure a data file and an average reading a slow sensor at one tick share the read"""
+        DF = cchrc.common.datafile.DataFile
+        clock = self.clock
+        class SlowSensor(MyTestSensor):
+            def get_reading(self):
+                self.read_at.append(clock.time())
+                clock.sleep(3)
+                return MyTestSensor.get_reading(self)
+        s = SlowSensor('T1', timeout=4)
+        s.read_at = []
+        sc = cchrc.sensors.SensorContainer()
+        dfr = cchrc.common.datafile.DataFileRunner()
+        sc.put(s, 'TestGroup')
+        dfr.put(DF('S', 'Sample', self.temp_dir, 'TestGroup', 60, 'SAMPLE', ['T1'], sc))
+        dfr.put(DF('A', 'Average', self.temp_dir, 'TestGroup', 60, 'AVERAGE', ['T1'], sc))
+        with self.clock.held():
+            sc.start_averaging_sensors()
+            dfr.start_data_files()
+        self.clock.sleep(600 + 30)
+        sc.stop_averaging_sensors()
+        dfr.stop_data_files()
+        sc.join(5)
+        dfr.join(5)
+        rows = get_file(self.temp_dir, 'Sample').splitlines()[1:11]
+        self.assertEqual([r.split(',')[1] for r in rows if r.endswith('N/A')], [])
+        self.assertEqual(len(rows), 10)
+        # Read once a tick, by whichever got there first
+        self.assertEqual(len(s.read_at), len(set(s.read_at)))
+        self.assertEqual((s.still_reading, s.timeouts), (0, 0))
+
+    def test_day(self):
+        """Ensure a simulated day of collection writes every tick, the same every time"""
+        first = self.run_day(os.path.join(self.temp_dir, '1'))
+        self.clock = SimulatedClock(self.start)
+        set_clock(self.clock)
+        second = self.run_day(os.path.join(self.temp_dir, '2'))
+        sample, average = first
+        self.assertEqual(first, second)
+        self.assertEqual((len(sample), len(average)), (289, 25))
+        self.assertTrue(sample[-1].endswith(',288'))
+
 class TestFileAuxOperations(unittest.TestCase):
     """Test operation of auxillary DataFile operations"""
     import cchrc.common.datafile
@@ -346,6 +1617,388 @@ class TestFileAuxOperations(unittest.TestCase):
         self.assertTrue(all([ope(path + '.' + str(x)) for x in [1,2,3]]))
         shutil.rmtree(temp_dir)
 
+class TestRowEncoder(unittest.TestCase):
+    """Test encoding of data file rows"""
+
+    def setUp(self):
+        self.RE = cchrc.common.encoder.RowEncoder
+
+    def test_default_formats(self):
+        """Ensure values without a format are written like the csv module does"""
+        self.assertEqual(self.RE([None] * 4).encode('TS', [1, 7.5, 0.1, 'a,b']),
+                         'TS,1,7.5,0.1,"a,b"\r\n')
+
+    def test_column_formats(self):
+        """Ensure each column is written with its own format"""
+        self.assertEqual(self.RE(['%.3f', '%.1f']).encode('TS', [1, 2.25]),
+                         'TS,1.000,2.2\r\n')
+
+    def test_none_is_na(self):
+        """Ensure None is written as N/A, with and without formats"""
+        self.assertEqual((self.RE(['%.3f', '%.3f']).encode('TS', [None, 2]),
+                          self.RE([None, '%.3f']).encode('TS', [None, 2])),
+                         ('TS,N/A,2.000\r\n', 'TS,N/A,2.000\r\n'))
+
+    def test_none_is_na_with_any_format(self):
+        """Ensure None is written as N/A under %s, %r and %d formats"""
+        self.assertEqual(self.RE(['%s', '%r', '%d']).encode('TS', [None, None, None]),
+                         'TS,N/A,N/A,N/A\r\n')
+        self.assertEqual(self.RE(['%s', '%d']).encode('TS', [None, 2]),
+                         'TS,N/A,2\r\n')
+
+    def test_header_quoting(self):
+        """Ensure column names are quoted when needed"""
+        self.assertEqual(self.RE([None]).encode_header(['Timestamp', 'T1, "5cm"']),
+                         'Timestamp,"T1, ""5cm"""\r\n')
+
+    def test_invalid_format(self):
+        """Ensure an invalid format raises an error"""
+        self.assertRaises(MalformedConfigFile, self.RE, ['%.3q'])
+
+class TestBinaryFile(unittest.TestCase):
+    """Test the binary data file format"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, 'TestFile')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write(self, types, rows, extra=''):
+        encoder = cchrc.common.binfile.BinaryEncoder(types)
+        f = open(self.path, 'wb')
+        f.write(encoder.encode_header(['Timestamp'] + ['T%d' % x for x in
+                                                       xrange(len(types))]))
+        for ts, values in rows:
+            f.write(encoder.encode(ts, values))
+        f.write(extra)
+        f.close()
+        return cchrc.common.binfile.BinaryReader(self.path)
+
+    def test_round_trip(self):
+        """Ensure rows read back as written, with None for missing readings"""
+        rows = [(1287446400.0, [1.5, None, 3.0]), (1287446405.0, [None, 2.25, 'x'])]
+        reader = self.write(['float64', 'float32', 'float64'], rows)
+        self.assertEqual((reader.header, list(reader), reader[-1]),
+                         (['Timestamp', 'T0', 'T1', 'T2'],
+                          [(1287446400.0, [1.5, None, 3.0]),
+                           (1287446405.0, [None, 2.25, None])],
+                          (1287446405.0, [None, 2.25, None])))
+
+    def test_nan_is_null(self):
+        """Ensure NaN is written as null whether or not the row has a None"""
+        inf = float('inf')
+        rows = [(0.0, [float('nan'), 1.0]), (5.0, [float('nan'), None]),
+                (10.0, [inf, -inf])]
+        reader = self.write(['float64', 'float32'], rows)
+        self.assertEqual(list(reader), [(0.0, [None, 1.0]), (5.0, [None, None]),
+                                        (10.0, [inf, -inf])])
+
+    def test_records_are_fixed_width(self):
+        """Ensure every record is the same size, and the first is aligned"""
+        reader = self.write(['float32'] * 9, [(0.0, [1.0] * 9)])
+        self.assertEqual((reader.offset % 8, reader.record.size), (0, 8 + 2 + 36))
+
+    def test_partial_record_ignored(self):
+        """Ensure a partly written last record is not read"""
+        reader = self.write(['float64'], [(0.0, [1.0])], extra='\x00' * 5)
+        self.assertEqual(len(reader), 1)
+
+    def test_not_a_binary_file(self):
+        """Ensure reading a file which is not binary raises an error"""
+        open(self.path, 'w').write('Timestamp,T1\r\n')
+        self.assertRaises(NotABinaryFile, cchrc.common.binfile.BinaryReader,
+                          self.path)
+
+    def test_to_csv(self):
+        """Ensure a binary file converts to the CSV DataFile would have written"""
+        from StringIO import StringIO
+        ts = time.mktime((2010, 12, 15, 0, 0, 0, 0, 0, -1))
+        reader = self.write(['float64', 'float64'], [(ts, [1.0, None])])
+        out = StringIO()
+        cchrc.common.binfile.to_csv(reader, out, '%.1f')
+        self.assertEqual(out.getvalue(),
+                         'Timestamp,T0,T1\r\n2010-12-15 00:00:00,1.0,N/A\r\n')
+
+    def test_invalid_value_type(self):
+        """Ensure an invalid value type raises an error"""
+        self.assertRaises(MalformedConfigFile, cchrc.common.binfile.BinaryEncoder,
+                          ['float16'])
+
+class TestPartition(unittest.TestCase):
+    """Test data file partitioning and compression"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, 'TestFile')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_parse_size(self):
+        """Ensure sizes are parsed with and without units"""
+        ps = cchrc.common.partition.parse_size
+        self.assertEqual([ps('100'), ps('2k'), ps('1.5M'), ps(0)],
+                         [100, 2048, 1572864, 0])
+        self.assertRaises(MalformedConfigFile, ps, 'lots')
+
+    def test_period_key(self):
+        """Ensure times in the same period have the same key"""
+        pk = cchrc.common.partition.period_key
+        ts = time.mktime((2010, 12, 15, 10, 0, 0, 0, 0, -1))
+        self.assertEqual([pk(ts, 'hourly') == pk(ts + 3599, 'hourly'),
+                          pk(ts, 'hourly') == pk(ts + 3600, 'hourly'),
+                          pk(ts, 'daily') == pk(ts + 3600, 'daily'),
+                          pk(ts, 'none')],
+                         [True, False, True, None])
+
+    def test_archive_file(self):
+        """Ensure archived files are named by time, without overwriting"""
+        ts = time.mktime((2010, 12, 15, 10, 0, 0, 0, 0, -1))
+        paths = []
+        for x in xrange(2):
+            open(self.path, 'w').write(str(x))
+            paths.append(cchrc.common.partition.archive_file(self.path, ts))
+        self.assertEqual([os.path.basename(p) for p in paths],
+                         ['TestFile.20101215-100000', 'TestFile.20101215-100000-1'])
+
+    def test_compress_gzip(self):
+        """Ensure a partition is replaced by its gzipped copy"""
+        import gzip
+        open(self.path, 'w').write('a,b\r\n' * 100)
+        path = cchrc.common.partition.compress_later(self.path, 'gzip').result()
+        self.assertEqual((os.path.exists(self.path), gzip.open(path).read()),
+                         (False, 'a,b\r\n' * 100))
+
+class TestIndex(unittest.TestCase):
+    """Test sparse data file indexes and time range extraction"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, 'TestFile')
+        self.ts = time.mktime((2010, 12, 15, 10, 0, 0, 0, 0, -1))
+        self.sc = cchrc.sensors.SensorContainer()
+        self.sc.put(MyTestSensor('T1'), 'TestGroup')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def data_file(self, **kw):
+        return cchrc.common.datafile.DataFile('TestID', 'TestFile', self.temp_dir,
+                                              'TestGroup', 5, 'SAMPLE', ['T1'],
+                                              self.sc, **kw)
+
+    def extract(self, start, end):
+        return list(cchrc.common.index.extract(self.path, self.ts + start,
+                                               self.ts + end))
+
+    def test_index_entries(self):
+        """Ensure every Nth row is indexed at its offset"""
+        d = self.data_file(index_every=3)
+        for x in xrange(7):
+            d.collect_data(self.ts + 5 * x)
+        d.close()
+        data = get_file(self.path)
+        self.assertEqual([(ts - self.ts, data[offset:offset + 19]) for ts, offset in
+                          cchrc.common.index.read_index(self.path + '.idx')],
+                         [(0, '2010-12-15 10:00:00'), (15, '2010-12-15 10:00:15'),
+                          (30, '2010-12-15 10:00:30')])
+
+    def test_lost_rows_are_unindexed(self):
+        """Ensure index entries for rows which never reached the file are removed"""
+        d = self.data_file(index_every=1, flush_rows=10)
+        d.collect_data(self.ts)
+        d.out._BufferedFile__rows = []
+        d.index.close()
+        d = self.data_file(index_every=1)
+        self.assertEqual(cchrc.common.index.read_index(self.path + '.idx'), [])
+
+    def test_seek_offset(self):
+        """Ensure the scan for a range starts at the last indexed row before it"""
+        d = self.data_file(index_every=2)
+        for x in xrange(6):
+            d.collect_data(self.ts + 5 * x)
+        d.close()
+        offset = cchrc.common.index.seek_offset(self.path, self.ts + 17)
+        self.assertEqual((get_file(self.path)[offset:offset + 19],
+                          cchrc.common.index.seek_offset(self.path, self.ts)),
+                         ('2010-12-15 10:00:10', None))
+
+    def test_extract(self):
+        """Ensure only the rows in range are extracted"""
+        d = self.data_file(index_every=2)
+        for x in xrange(6):
+            d.collect_data(self.ts + 5 * x)
+        d.close()
+        self.assertEqual(self.extract(10, 20),
+                         ['Timestamp,T1\r\n', '2010-12-15 10:00:10,3\r\n',
+                          '2010-12-15 10:00:15,4\r\n'])
+
+    def test_extract_partitions(self):
+        """Ensure rows are extracted across partitions, compressed or not"""
+        for x, kw in enumerate([{}, {'file_format': 'binary'}]):
+            d = self.data_file(rotate='hourly', compress='gzip', **kw)
+            for y in xrange(2):
+                d.collect_data(self.ts + 3600 * (2 * x + y))
+            d.close()
+            cchrc.common.partition.compressor().submit('compress', int).result()
+        self.assertEqual(self.extract(0, 4 * 3600),
+                         ['Timestamp,T1\r\n', '2010-12-15 10:00:00,1\r\n',
+                          '2010-12-15 11:00:00,2\r\n',
+                          '2010-12-15 12:00:00,3.0\r\n', '2010-12-15 13:00:00,4.0\r\n'])
+
+    def test_extract_rotated_files(self):
+        """Ensure rows are extracted from files rotated when their columns changed"""
+        self.sc.put(MyTestSensor('T2'), 'TestGroup')
+        d = self.data_file()
+        d.collect_data(self.ts)
+        d.close()
+        d = cchrc.common.datafile.DataFile('TestID', 'TestFile', self.temp_dir,
+                                           'TestGroup', 5, 'SAMPLE', ['T2'], self.sc)
+        d.collect_data(self.ts + 5)
+        d.close()
+        self.assertEqual(self.extract(0, 10),
+                         ['Timestamp,T1\r\n', '2010-12-15 10:00:00,1\r\n',
+                          'Timestamp,T2\r\n', '2010-12-15 10:00:05,1\r\n'])
+
+class TestRollup(unittest.TestCase):
+    """Test hourly, daily and monthly summaries of data files"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, 'TestFile')
+        self.ts = time.mktime((2010, 12, 15, 22, 0, 0, 0, 0, -1))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def rollup(self, **kw):
+        return cchrc.common.rollup.Rollup(self.path, ['T1', 'T2'],
+                                          ['daily', 'hourly'], **kw)
+
+    def rows(self, period):
+        return get_file(self.path + '.' + period).splitlines()
+
+    def test_summaries(self):
+        """Ensure each closed period gets a row, and longer periods are built from shorter"""
+        r = self.rollup(formats=['%.1f', None])
+        for x, values in enumerate([[1, None], [3, None], [5, 2.5], [7, None], [9, 1]]):
+            r.add(self.ts + 1800 * x, values)
+        r.close()
+        self.assertEqual((self.rows('hourly'), self.rows('daily')),
+                         (['Timestamp,Rows,T1_min,T1_mean,T1_max,T2_min,T2_mean,T2_max',
+                           '2010-12-15 22:00:00,2,1.0,2.0,3.0,N/A,N/A,N/A',
+                           '2010-12-15 23:00:00,2,5.0,6.0,7.0,2.5,2.5,2.5'],
+                          ['Timestamp,Rows,T1_min,T1_mean,T1_max,T2_min,T2_mean,T2_max',
+                           '2010-12-15 00:00:00,4,1.0,4.0,7.0,2.5,2.5,2.5']))
+
+    def test_checkpoint(self):
+        """Ensure an open bucket survives a restart"""
+        r = self.rollup()
+        r.add(self.ts, [1, 2])
+        r.close()
+        r = self.rollup()
+        r.add(self.ts + 60, [3, 4])
+        r.add(self.ts + 3600, [0, 0])
+        r.close()
+        self.assertEqual(self.rows('hourly')[1:], ['2010-12-15 22:00:00,2,1.0,2.0,3.0,2.0,3.0,4.0'])
+
+    def test_replay(self):
+        """Ensure rows written after the last checkpoint are replayed from the data file"""
+        sc = cchrc.sensors.SensorContainer()
+        sc.put(MyTestSensor('T1'), 'TestGroup')
+        def data_file():
+            return cchrc.common.datafile.DataFile('TestID', 'TestFile', self.temp_dir,
+                                                  'TestGroup', 5, 'SAMPLE', ['T1'], sc,
+                                                  rollups=['hourly'],
+                                                  rollup_checkpoint=3600)
+        d = data_file()
+        d.collect_data(self.ts)
+        d.rollup.checkpoint()
+        d.collect_data(self.ts + 5)
+        d.out.close()
+        d = data_file()
+        d.collect_data(self.ts + 3600)
+        d.close()
+        self.assertEqual(self.rows('hourly')[1:], ['2010-12-15 22:00:00,2,1.0,1.5,2.0'])
+
+    def test_changed_columns(self):
+        """Ensure summaries start again when the columns change"""
+        r = self.rollup()
+        r.add(self.ts, [1, 2])
+        r.add(self.ts + 3600, [1, 2])
+        r.close()
+        r = cchrc.common.rollup.Rollup(self.path, ['T3'], ['hourly'])
+        r.add(self.ts + 3601, [5])
+        r.close()
+        self.assertEqual((self.rows('hourly'), r.stats()['rows_written']),
+                         (['Timestamp,Rows,T3_min,T3_mean,T3_max'], {'hourly': 0}))
+
+    def test_invalid_period(self):
+        """Ensure an invalid period raises an error"""
+        self.assertRaises(MalformedConfigFile, cchrc.common.rollup.Rollup,
+                          self.path, ['T1'], ['weekly'])
+
+class TestBufferedFile(unittest.TestCase):
+    """Test buffered writing of data files"""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, 'TestFile')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_rows_are_buffered(self):
+        """Ensure rows are only written once flush_rows are waiting"""
+        bf = cchrc.common.writer.BufferedFile(self.path, flush_rows=3)
+        bf.write('a\n')
+        bf.write('b\n')
+        before = get_file(self.path)
+        bf.write('c\n')
+        self.assertEqual((before, get_file(self.path), bf.stats()['flushes']),
+                         ('', 'a\nb\nc\n', 1))
+
+    def test_flush_interval(self):
+        """Ensure rows are written once the oldest is flush_interval old"""
+        bf = cchrc.common.writer.BufferedFile(self.path, flush_rows=100,
+                                              flush_interval=0.01)
+        bf.write('a\n')
+        time.sleep(0.02)
+        bf.write('b\n')
+        self.assertEqual(get_file(self.path), 'a\nb\n')
+
+    def test_flush_waiting(self):
+        """Ensure flush_waiting writes out waiting rows, and does nothing without any"""
+        bf = cchrc.common.writer.BufferedFile(self.path, flush_rows=100)
+        bf.flush_waiting()
+        bf.write('a\n')
+        bf.flush_waiting()
+        self.assertEqual((get_file(self.path), bf.stats()['flushes']), ('a\n', 1))
+
+    def test_fsync_every_row(self):
+        """Ensure the every-row policy writes and syncs each row"""
+        bf = cchrc.common.writer.BufferedFile(self.path, flush_rows=100,
+                                              fsync='every-row')
+        bf.write('a\n')
+        bf.write('b\n')
+        self.assertEqual((get_file(self.path), bf.stats()['fsyncs']),
+                         ('a\nb\n', 2))
+
+    def test_close_flushes(self):
+        """Ensure closing writes out waiting rows"""
+        bf = cchrc.common.writer.BufferedFile(self.path, flush_rows=100)
+        bf.write('a\n')
+        bf.close()
+        self.assertEqual((get_file(self.path), bf.stats()['bytes_written']),
+                         ('a\n', 2))
+
+    def test_invalid_fsync_policy(self):
+        """Ensure an invalid fsync policy raises an error"""
+        self.assertRaises(MalformedConfigFile, cchrc.common.writer.BufferedFile,
+                          self.path, fsync='sometimes')
+
 class TestDataFileRunner(unittest.TestCase):
     def __init__(self, *a, **kw):
         self.DF = cchrc.common.datafile.DataFile
@@ -392,6 +2045,80 @@ class TestDataFileRunner(unittest.TestCase):
         self.dfr.stop_data_files()
         self.assertTrue(is_alive)
 
+    def test_stop_with_hung_read(self):
+        """Ensure a hung read does not stop the runner from stopping and writing its rows"""
+        import threading
+
+        class BlockingSensor(MyTestSensor):
+            reads = 0
+            hung, release = threading.Event(), threading.Event()
+
+            @classmethod
+            def get_readings(klass, sensors):
+                klass.reads += 1
+                if klass.reads == 3:
+                    klass.hung.set()
+                    klass.release.wait(30)
+                return MyTestSensor.get_readings(sensors)
+
+        clock = SimulatedClock(1287446400)
+        set_clock(clock)
+        try:
+            dfr = cchrc.common.datafile.DataFileRunner()
+            self.sc.put(BlockingSensor('B'), 'TestGroup')
+            dfr.put(self.DF('TestID', 'TestFile', self.temp_dir, 'TestGroup',
+                            60, 'SAMPLE', ['B'], self.sc, flush_rows=100))
+            with clock.held():
+                dfr.start_data_files()
+            BlockingSensor.hung.wait(5)
+            dfr.stop_data_files()
+            dfr.join(5)
+            stopped = not dfr.isAlive()
+        finally:
+            BlockingSensor.release.set()
+            set_clock(None)
+        self.assertTrue(stopped)
+        self.assertEqual(len(get_file(self.temp_dir, 'TestFile').splitlines()), 3)
+
+    def test_ticks_written_in_order(self):
+        """Ensure ticks dispatched together are written to a file in tick order"""
+        import datetime
+        import threading
+        d = self.DF('TestID', 'TestFile', self.temp_dir, 'TestGroup',
+                    5, 'SAMPLE', ['T1'], self.sc)
+        self.dfr.put(d)
+        calls, written = [], []
+        started, release, done = threading.Event(), threading.Event(), threading.Event()
+        collect_data = d.collect_data
+        def slow_first(ts, snapshot):
+            calls.append(ts)
+            if len(calls) == 1:
+                started.set()
+                release.wait(5)
+            collect_data(ts, snapshot)
+            written.append(ts)
+            if len(written) == 4:
+                done.set()
+        d.collect_data = slow_first
+        ticks = [1287446400 + 5 * i for i in range(4)]
+        run_tick = self.dfr._DataFileRunner__run_tick
+        try:
+            run_tick(ticks[0], [5])
+            started.wait(5)
+            for ts in ticks[1:]:
+                run_tick(ts, [5])
+            release.set()
+            done.wait(5)
+        finally:
+            release.set()
+            self.dfr._DataFileRunner__executor.shutdown(wait=False)
+        d.close()
+        rows = get_file(self.temp_dir, 'TestFile').splitlines()[1:]
+        self.assertEqual(written, ticks)
+        stamps = [datetime.datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')
+                  for ts in ticks]
+        self.assertEqual([r.split(',')[0] for r in rows], stamps)
+
 class TestDataFileOperations(unittest.TestCase):
     def __init__(self, *a, **kw):
         self.DF = cchrc.common.datafile.DataFile
@@ -453,6 +2180,166 @@ class TestDataFileOperations(unittest.TestCase):
 
         self.assertEqual(data[1:], ['2', '10', '40'])
 
+    def test_collect_data_from_snapshot(self):
+        """Ensure files written from one snapshot share its readings and timestamp"""
+        d1 = self.DF('TestID', 'TestFile', self.temp_dir, 'TestGroup',
+                     5, 'SAMPLE', ["T1","T2"], self.sc)
+        d2 = self.DF('TestID2', 'TestFile2', self.temp_dir, 'TestGroup',
+                     10, 'SAMPLE', ["T2","T3"], self.sc)
+        snapshot = cchrc.common.snapshot.TickSnapshot(1287446400,
+                                                      d1.sensors + d2.sensors)
+        snapshot.read()
+        d1.collect_data(1287446400, snapshot)
+        d2.collect_data(1287446400, snapshot)
+        rows = [list(csv.reader(open(os.path.join(self.temp_dir, f))))[1]
+                for f in ['TestFile', 'TestFile2']]
+        self.assertEqual((rows[0][0] == rows[1][0], rows[0][1:], rows[1][1:]),
+                         (True, ['1', '5'], ['5', '10']))
+
+    def test_runner_reads_once_per_tick(self):
+        """Ensure the DataFileRunner reads each sensor once for all files due at a tick"""
+        dfr = cchrc.common.datafile.DataFileRunner()
+        d1 = self.DF('TestID', 'TestFile', self.temp_dir, 'TestGroup',
+                     5, 'SAMPLE', ["T1","T2"], self.sc)
+        d2 = self.DF('TestID2', 'TestFile2', self.temp_dir, 'TestGroup',
+                     10, 'SAMPLE', ["T1","T2"], self.sc)
+        dfr.put(d1)
+        dfr.put(d2)
+        dfr._DataFileRunner__run_tick(1287446400, [5, 10])
+        dfr._DataFileRunner__executor.shutdown(wait=True)
+        self.assertEqual(get_file(self.temp_dir, 'TestFile').splitlines()[1],
+                         get_file(self.temp_dir, 'TestFile2').splitlines()[1])
+
+    def test_collect_data_formats(self):
+        """Ensure a file's values are written with its formats"""
+        d = self.DF('TestID', 'TestFile', self.temp_dir, 'TestGroup',
+                    5, 'SAMPLE', ["T1","T2","T5"], self.sc,
+                    value_format='%.2f', formats={'T2': '%d'})
+        d.collect_data()
+        self.assertEqual(get_file(self.temp_dir, 'TestFile').splitlines()[1].split(',')[1:],
+                         ['1.00', '5', '20.00'])
+
+    def test_buffered_rows_written_on_close(self):
+        """Ensure buffered rows are written when the file is closed"""
+        d = self.DF('TestID', 'TestFile', self.temp_dir, 'TestGroup',
+                    5, 'SAMPLE', ["T1","T2","T5"], self.sc, flush_rows=10)
+        d.collect_data()
+        before = get_file(self.temp_dir, 'TestFile').count('\n')
+        d.close()
+        self.assertEqual((before, get_file(self.temp_dir, 'TestFile').count('\n')),
+                         (1, 2))
+
+    def test_rotated_file_gets_header(self):
+        """Ensure a new file started by rotation has a header row"""
+        d = self.DF('TestID', 'TestFile', self.temp_dir, 'TestGroup',
+                    5, 'SAMPLE', ["T1","T2","T5"], self.sc)
+        d = self.DF('TestID', 'TestFile', self.temp_dir, 'TestGroup',
+                    5, 'SAMPLE', ["T3","T4","T5"], self.sc)
+        self.assertEqual(get_file(self.temp_dir, 'TestFile'),
+                         'Timestamp,T3,T4,T5 Display\r\n')
+
+    def test_binary_file(self):
+        """Ensure a binary file is appended to, and rotated when its columns change"""
+        for x in xrange(2):
+            d = self.DF('TestID', 'TestFile', self.temp_dir, 'TestGroup',
+                        5, 'SAMPLE', ["T1","T5"], self.sc, file_format='binary')
+            d.collect_data(1287446400 + x)
+            d.close()
+        d = self.DF('TestID', 'TestFile', self.temp_dir, 'TestGroup',
+                    5, 'SAMPLE', ["T1","T5"], self.sc, file_format='binary',
+                    value_type='float32')
+        d.close()
+        reader = cchrc.common.binfile.BinaryReader(os.path.join(self.temp_dir,
+                                                                'TestFile.1'))
+        self.assertEqual((reader.header, list(reader),
+                          len(cchrc.common.binfile.BinaryReader(
+                              os.path.join(self.temp_dir, 'TestFile')))),
+                         (['Timestamp', 'T1', 'T5 Display'],
+                          [(1287446400.0, [1.0, 20.0]), (1287446401.0, [2.0, 40.0])],
+                          0))
+
+    def test_binary_file_replaces_csv(self):
+        """Ensure a CSV file is rotated when the file becomes binary"""
+        self.DF('TestID', 'TestFile', self.temp_dir, 'TestGroup',
+                5, 'SAMPLE', ["T1"], self.sc).close()
+        self.DF('TestID', 'TestFile', self.temp_dir, 'TestGroup',
+                5, 'SAMPLE', ["T1"], self.sc, file_format='binary').close()
+        self.DF('TestID', 'TestFile', self.temp_dir, 'TestGroup',
+                5, 'SAMPLE', ["T1"], self.sc).close()
+        self.assertEqual([get_file(self.temp_dir, f)[:6] for f in
+                          ['TestFile', 'TestFile.1', 'TestFile.2']],
+                         ['Timest', 'CDCBIN', 'Timest'])
+
+    def test_time_partitions(self):
+        """Ensure a new partition is started when the hour changes"""
+        ts = time.mktime((2010, 12, 15, 10, 59, 55, 0, 0, -1))
+        d = self.DF('TestID', 'TestFile', self.temp_dir, 'TestGroup',
+                    5, 'SAMPLE', ["T1"], self.sc, rotate='hourly')
+        for x in xrange(3):
+            d.collect_data(ts + 5 * x)
+        d.close()
+        self.assertEqual((sorted(os.listdir(self.temp_dir)),
+                          get_file(self.temp_dir, 'TestFile.20101215-105955'),
+                          get_file(self.temp_dir, 'TestFile'), d.stats()['partitions']),
+                         (['TestFile', 'TestFile.20101215-105955',
+                           'TestFile.20101215-105955.idx', 'TestFile.idx'],
+                          'Timestamp,T1\r\n2010-12-15 10:59:55,1\r\n',
+                          'Timestamp,T1\r\n2010-12-15 11:00:00,2\r\n'
+                          '2010-12-15 11:00:05,3\r\n', 1))
+
+    def test_time_partition_after_restart(self):
+        """Ensure a file left from an earlier period is partitioned on its next row"""
+        ts = time.mktime((2010, 12, 15, 10, 0, 0, 0, 0, -1))
+        for x in xrange(2):
+            d = self.DF('TestID', 'TestFile', self.temp_dir, 'TestGroup',
+                        5, 'SAMPLE', ["T1"], self.sc, rotate='daily',
+                        file_format='binary')
+            d.collect_data(ts + 86400 * x)
+            d.close()
+        self.assertEqual(sorted(os.listdir(self.temp_dir)),
+                         ['TestFile', 'TestFile.20101215-100000'])
+
+    def test_size_partitions(self):
+        """Ensure a new partition is started before a row would exceed max_size"""
+        ts = time.mktime((2010, 12, 15, 10, 0, 0, 0, 0, -1))
+        d = self.DF('TestID', 'TestFile', self.temp_dir, 'TestGroup',
+                    5, 'SAMPLE', ["T1"], self.sc, max_size=70)
+        for x in xrange(3):
+            d.collect_data(ts + 5 * x)
+        d.close()
+        # The header is 14 bytes and each row 23
+        self.assertEqual((sorted(os.listdir(self.temp_dir)),
+                          get_file(self.temp_dir, 'TestFile').count('\n')),
+                         (['TestFile', 'TestFile.20101215-100000',
+                           'TestFile.20101215-100000.idx', 'TestFile.idx'], 2))
+
+    def test_compressed_partitions(self):
+        """Ensure closed partitions are compressed, and a header change starts a partition"""
+        ts = time.mktime((2010, 12, 15, 10, 0, 0, 0, 0, -1))
+        d = self.DF('TestID', 'TestFile', self.temp_dir, 'TestGroup',
+                    5, 'SAMPLE', ["T1"], self.sc, rotate='hourly', compress='gzip')
+        d.collect_data(ts)
+        d.close()
+        d = self.DF('TestID', 'TestFile', self.temp_dir, 'TestGroup',
+                    5, 'SAMPLE', ["T2"], self.sc, rotate='hourly', compress='gzip')
+        d.close()
+        cchrc.common.partition.compressor().submit('compress', int).result()
+        self.assertEqual(sorted(os.listdir(self.temp_dir)),
+                         ['TestFile', 'TestFile.20101215-100000.gz', 'TestFile.idx'])
+
+    def test_invalid_partitioning(self):
+        """Ensure invalid Rotate and Compress values raise errors"""
+        for kw in [{'rotate': 'weekly'}, {'compress': 'zip'}]:
+            self.assertRaises(MalformedConfigFile, self.DF, 'TestID', 'TestFile',
+                              self.temp_dir, 'TestGroup', 5, 'SAMPLE',
+                              ["T1"], self.sc, **kw)
+
+    def test_invalid_file_format(self):
+        """Ensure an invalid file format raises an error"""
+        self.assertRaises(MalformedConfigFile, self.DF, 'TestID', 'TestFile',
+                          self.temp_dir, 'TestGroup', 5, 'SAMPLE',
+                          ["T1"], self.sc, file_format='xml')
+
     def test_invalid_sensor(self):
         """Ensure asking for an invalid sensor raises and error"""
         self.assertRaises(MalformedConfigFile, self.DF, 'TestID', 'TestFile',
@@ -474,6 +2361,19 @@ class TestDataFileOperations(unittest.TestCase):
         self.assertTrue(type(d1.sensors[0]) is cchrc.sensors.AveragingSensor
                         and d1.sensors[0] is d2.sensors[0])
 
+    def test_aggregate_modes(self):
+        """Ensure every mode of a sensor in a file shares one averaging sensor"""
+        d = self.DF('TestID', 'TestFile', self.temp_dir, 'TestGroup',
+                    5, 'AVERAGE', ["T1", "T1/MIN", "T1/MAX", "T1/STDDEV"], self.sc)
+        d.sensors[0].add_reading(2)
+        d.sensors[0].add_reading(4)
+        d.collect_data()
+        self.assertEqual((set([s.source for s in d.sensors[1:]]) == set([d.sensors[0]]),
+                          get_file(self.temp_dir, 'TestFile').splitlines()[0],
+                          get_file(self.temp_dir, 'TestFile').splitlines()[1].split(',')[1:]),
+                         (True, 'Timestamp,T1_avg,T1_min,T1_max,T1_stddev',
+                          ['3.0', '2.0', '4.0', repr(2 ** 0.5)]))
+
     def test_use_invalid_dir(self):
         """Ensure using an invalid directory raises an error"""
         self.assertRaises(BaseDirDoesNotExist, self.DF, 'TestID', 'TestFile',
@@ -12,6 +12,7 @@ import configobj
 import daemon
 
 import cchrc
+from cchrc.common import profiler, stats, tracing
 
 class InvalidLoggingDestination(Exception):
     pass
@@ -27,7 +28,11 @@ def get_opts():
       help='Run CDC in test mode. (Sampling every 60 seconds)')
     a('-v', action='count', dest='verbose', help = 'Verbosity. '
       "Default is 'warning'; specify once for 'info' and twice for 'debug'")
-    parser.set_defaults(run_in_foreground=False, test=False, verbose=0)
+    a('-p', '--profile', type='float', dest='profile', metavar='SECONDS',
+      help=("Profile every collection thread for SECONDS seconds, and write "
+            "the reports to a profile-* directory in the LogDir"))
+    parser.set_defaults(run_in_foreground=False, test=False, verbose=0,
+                        profile=0)
 
     opts, args = parser.parse_args()
 
@@ -99,6 +104,26 @@ class Mother(object):
             c.im_self.join()
         self.ended = True
 
+class StatsDumper(object):
+    """On SIGUSR1, writes the runtime stats to a file and logs them"""
+    def __init__(self, sc, dfr, path):
+        self.sc = sc
+        self.dfr = dfr
+        self.path = path
+        self.log = logging.getLogger('cdc.StatsDumper')
+
+    def collect(self):
+        return stats.runtime_stats(self.sc, self.dfr)
+
+    def dump(self, sig, stack_frame):
+        try:
+            s = self.collect()
+            stats.dump(s, self.path)
+            self.log.info("Runtime stats written to '%s':\n%s", self.path,
+                          stats.to_json(s))
+        except Exception:
+            self.log.exception("Could not write the runtime stats")
+
 def go(cfg, opts, log):
 
     if os.path.exists('/var/run/cdc.pid'):
@@ -115,6 +140,12 @@ def go(cfg, opts, log):
     mom = Mother([sc.start_averaging_sensors, dfr.start_data_files],
                  [sc.stop_averaging_sensors, dfr.stop_data_files])
 
+    trace_file = cfg['Main'].get('TraceFile', 'none')
+    if trace_file.lower() != 'none':
+        tracing.start(trace_file,
+                      int(float(cfg['Main'].get('TraceFileSize', 10)) * 1024 * 1024),
+                      int(cfg['Main'].get('TraceFiles', 5)))
+
     log.debug("Starting Mother")
 
     mom.start()
@@ -122,13 +153,36 @@ def go(cfg, opts, log):
     signal.signal(signal.SIGTERM, mom.stop)
     signal.signal(signal.SIGINT, mom.stop)
 
+    log_dir = cfg['Main'].get('LogDir', '/var/log/cdc_data_collector')
+
+    prof = None
+    if opts.profile > 0:
+        prof = profiler.Profiler(opts.profile,
+                                 os.path.join(log_dir, time.strftime('profile-%Y%m%d-%H%M%S')))
+        prof.start()
+
+    dumper = StatsDumper(sc, dfr, os.path.join(log_dir, 'stats.json'))
+    signal.signal(signal.SIGUSR1, dumper.dump)
+
+    server = None
+    socket_path = cfg['Main'].get('StatsSocket', '/var/run/cdc.sock')
+    if socket_path.lower() != 'none':
+        try:
+            server = stats.StatsServer(socket_path, dumper.collect)
+            server.start()
+        except Exception, ex:
+            log.error("Could not serve stats on '%s': '%s'", socket_path, str(ex))
+
     while True:
-        # Putting a 'while True' loop here for "future expansion," such as
-        # printing out system stats on a SIGUSR1 or some such
         log.debug("Waiting for signals")
         signal.pause()
         if mom.ended:
             log.debug("Mother ended. Shutting down")
+            if server is not None:
+                server.stop()
+            if prof is not None and prof.isAlive():
+                prof.stop()
+            tracing.stop()
             os.unlink('/var/run/cdc.pid')
             return
 
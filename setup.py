@@ -7,6 +7,10 @@ setup(
     packages = find_packages(),
     exclude_package_data = {'':['README.rst', 'doc/*']},
     scripts = ['cdc.py'],
+    entry_points = {
+        'console_scripts': ['cdc-bin2csv = cchrc.common.binfile:main',
+                            'cdc-extract = cchrc.common.index:main'],
+    },
 
     # Project uses reStructuredText, so ensure that the docutils get
     # installed or upgraded on the target machine